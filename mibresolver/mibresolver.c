@@ -18,43 +18,139 @@ struct module_state {
       PyObject *error;
 };
 
-static PyObject *resolve(PyObject *self, PyObject *args) {
+/* Enum maps are shared between all OIDs that resolve to the same MIB tree
+ * node. The MIB tree never changes after init_snmp so the node pointer is
+ * a stable key. Callers must treat the returned dicts as read-only. */
+static PyObject *enum_maps = NULL;
+static PyObject *empty_enum_map = NULL;
+
+static PyObject *get_enum_map(struct tree *tp) {
+  PyObject *key;
+  PyObject *enum_map;
+
+  if (tp == NULL || tp->enums == NULL) {
+    Py_INCREF(empty_enum_map);
+    return empty_enum_map;
+  }
+
+  key = PyLong_FromVoidPtr(tp);
+  if (key == NULL) {
+    return NULL;
+  }
+  enum_map = PyDict_GetItem(enum_maps, key);
+  if (enum_map != NULL) {
+    Py_DECREF(key);
+    Py_INCREF(enum_map);
+    return enum_map;
+  }
+
+  enum_map = PyDict_New();
+  if (enum_map == NULL) {
+    Py_DECREF(key);
+    return NULL;
+  }
+  struct enum_list *ep = tp->enums;
+  while (ep) {
+    PyObject *enum_key = PyUnicode_FromFormat("%d", ep->value);
+    PyObject *enum_val = PyUnicode_FromString(ep->label);
+    if (enum_key == NULL || enum_val == NULL ||
+        PyDict_SetItem(enum_map, enum_key, enum_val) != 0) {
+      Py_XDECREF(enum_key);
+      Py_XDECREF(enum_val);
+      Py_DECREF(enum_map);
+      Py_DECREF(key);
+      return NULL;
+    }
+    Py_DECREF(enum_key);
+    Py_DECREF(enum_val);
+    ep = ep->next;
+  }
+
+  if (PyDict_SetItem(enum_maps, key, enum_map) != 0) {
+    Py_DECREF(enum_map);
+    Py_DECREF(key);
+    return NULL;
+  }
+  Py_DECREF(key);
+  return enum_map;
+}
+
+/* Returns a new reference to a (name, enum_map) tuple or None */
+static PyObject *resolve_one(const char *input) {
   oid name[MAX_OID_LEN];
   size_t name_length = MAX_OID_LEN;
-  const char *input;
   char output[MAX_OUTPUT];
   struct tree *tp;
   PyObject *enum_map;
 
-  if (!PyArg_ParseTuple(args, "s", &input)) {
-    return NULL;
-  }
-
   if (read_objid(input, name, &name_length) != 1) {
-    return Py_None;
+    Py_RETURN_NONE;
   }
 
   /* Resolve the OID */
   snprint_objid(output, sizeof(output), name, name_length);
 
   /* Resolve enum values if we have any */
-  enum_map = PyDict_New();
   tp = get_tree(name, name_length, get_tree_head());
-  if (tp->enums) {
-    struct enum_list *ep = tp->enums;
-    while (ep) {
-      PyObject *key = PyUnicode_FromFormat("%d", ep->value);
-      PyObject *val = PyUnicode_FromString(ep->label);
-      PyDict_SetItem(enum_map, key, val);
-      Py_DECREF(key);
-      Py_DECREF(val);
-      ep = ep->next;
+  enum_map = get_enum_map(tp);
+  if (enum_map == NULL) {
+    return NULL;
+  }
+
+  /* 'N' steals the enum_map reference */
+  return Py_BuildValue("(sN)", output, enum_map);
+}
+
+static PyObject *resolve(PyObject *self, PyObject *args) {
+  const char *input;
+
+  if (!PyArg_ParseTuple(args, "s", &input)) {
+    return NULL;
+  }
+  return resolve_one(input);
+}
+
+static PyObject *resolve_many(PyObject *self, PyObject *args) {
+  PyObject *input;
+  PyObject *seq;
+  PyObject *ret;
+  Py_ssize_t i, len;
+
+  if (!PyArg_ParseTuple(args, "O", &input)) {
+    return NULL;
+  }
+
+  seq = PySequence_Fast(input, "resolve_many expects a sequence of OIDs");
+  if (seq == NULL) {
+    return NULL;
+  }
+
+  len = PySequence_Fast_GET_SIZE(seq);
+  ret = PyList_New(len);
+  if (ret == NULL) {
+    Py_DECREF(seq);
+    return NULL;
+  }
+
+  for (i = 0; i < len; i++) {
+    const char *oid_str = PyUnicode_AsUTF8(PySequence_Fast_GET_ITEM(seq, i));
+    PyObject *resolved;
+    if (oid_str == NULL) {
+      Py_DECREF(ret);
+      Py_DECREF(seq);
+      return NULL;
+    }
+    resolved = resolve_one(oid_str);
+    if (resolved == NULL) {
+      Py_DECREF(ret);
+      Py_DECREF(seq);
+      return NULL;
     }
+    /* Steals the reference */
+    PyList_SET_ITEM(ret, i, resolved);
   }
 
-  PyObject* ret = Py_BuildValue("sO", output, enum_map);
-  Py_DECREF(output);
-  Py_DECREF(enum_map);
+  Py_DECREF(seq);
   return ret;
 }
 
@@ -70,6 +166,8 @@ static int module_clear(PyObject *m) {
 
 static PyMethodDef module_funcs[] = {
   { "resolve", resolve, METH_VARARGS, "Try to resolve a given OID." },
+  { "resolve_many", resolve_many, METH_VARARGS,
+    "Try to resolve a list of OIDs, returns a list of results or None." },
   { NULL, NULL, 0, NULL }
 };
 
@@ -99,6 +197,15 @@ PyMODINIT_FUNC PyInit_mibresolver(void) {
     return NULL;
   }
 
+  enum_maps = PyDict_New();
+  empty_enum_map = PyDict_New();
+  if (enum_maps == NULL || empty_enum_map == NULL) {
+    Py_XDECREF(enum_maps);
+    Py_XDECREF(empty_enum_map);
+    Py_DECREF(module);
+    return NULL;
+  }
+
   /* Turn off noisy MIB debug logging */
   netsnmp_register_loghandler(NETSNMP_LOGHANDLER_NONE, 0);
 
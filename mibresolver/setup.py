@@ -1,4 +1,4 @@
 from distutils.core import setup, Extension
 
-setup(name='mibresolver', version='0.1', ext_modules=[
+setup(name='mibresolver', version='0.2', ext_modules=[
   Extension('mibresolver', sources=['mibresolver.c'], libraries=['netsnmp'])])
@@ -6,9 +6,11 @@ import sys
 import snmpexporter
 import snmpexporter.config
 import snmpexporter.prometheus
+import snmpexporter.recording
 
 
-def main(config_file, host, layer, annotate=True):
+def main(config_file, host, layer, annotate=True, snmp_impl='netsnmp',
+         record=None, replay=None, replay_speed=1.0):
   config = snmpexporter.config.load(config_file)
   collections = config['collection']
   overrides = config['override']
@@ -21,8 +23,19 @@ def main(config_file, host, layer, annotate=True):
 
   resolver = snmpexporter.ForkedResolver()
 
-  logging.debug('Initializing Net-SNMP implemention')
-  snmpimpl = snmpexporter.snmpimpl.NetsnmpImpl()
+  if replay:
+    logging.debug('Replaying %s', replay)
+    recording = snmpexporter.recording.Recording.load(replay)
+    host = host or recording.host
+    layer = layer or recording.layer
+    snmpimpl = snmpexporter.recording.ReplayImpl(recording, replay_speed)
+  else:
+    logging.debug('Initializing %s SNMP implemention', snmp_impl)
+    snmpimpl = snmpexporter.snmpimpl.IMPLEMENTATIONS[snmp_impl]()
+
+  if record:
+    recording = snmpexporter.recording.Recording(host, layer)
+    snmpimpl = snmpexporter.recording.RecordingImpl(snmpimpl, recording)
 
   logging.debug('Constructing SNMP target')
   target = snmpexporter.target.SnmpTarget(host, layer, snmp_creds)
@@ -37,6 +50,12 @@ def main(config_file, host, layer, annotate=True):
   target.add_timeouts(timeouts)
   target.add_errors(errors)
 
+  if record:
+    target.done()
+    recording.timeline = target.timeline()
+    recording.save(record)
+    logging.info('Recorded %d requests to %s', len(recording.calls), record)
+
   if not annotate:
     for (oid, vlan), value in sorted(data.items()):
       print(str(vlan if vlan else '').ljust(5), oid.ljust(50), value)
@@ -67,9 +86,24 @@ if __name__ == '__main__':
           help='log level', default='INFO')
   parser.add_argument('--annotate', dest='annotate', default=False, const=True,
           help='annotate the results', action='store_const')
-  parser.add_argument('host', type=str, help='host to scrape')
-  parser.add_argument('layer', type=str, help='layer to use for authentication')
+  parser.add_argument('--snmp-impl', dest='snmp_impl', type=str,
+          help='SNMP implementation to use', default='netsnmp',
+          choices=sorted(snmpexporter.snmpimpl.IMPLEMENTATIONS.keys()))
+  parser.add_argument('--record', dest='record', type=str,
+          help='save the SNMP requests and their results to this file',
+          default=None)
+  parser.add_argument('--replay', dest='replay', type=str,
+          help='answer SNMP requests from a recording instead', default=None)
+  parser.add_argument('--replay-speed', dest='replay_speed', type=float,
+          help='speed up replay by this factor, 0 for no delays',
+          default=1.0)
+  parser.add_argument('host', type=str, nargs='?',
+          help='host to scrape, optional when replaying')
+  parser.add_argument('layer', type=str, nargs='?',
+          help='layer to use for authentication, optional when replaying')
   args = parser.parse_args()
+  if not args.replay and not (args.host and args.layer):
+    parser.error('host and layer are required')
 
   # Logging setup
   root = logging.getLogger()
@@ -80,4 +114,6 @@ if __name__ == '__main__':
   root.addHandler(ch)
   root.setLevel(logging.getLevelName(args.log_level))
 
-  main(args.config_file, args.host, args.layer, annotate=args.annotate)
+  main(args.config_file, args.host, args.layer, annotate=args.annotate,
+       snmp_impl=args.snmp_impl, record=args.record, replay=args.replay,
+       replay_speed=args.replay_speed)
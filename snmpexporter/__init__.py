@@ -1,6 +1,15 @@
 import base64
+from concurrent import futures
+import itertools
 import logging
 import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+import os
+import pickle
+import queue
+import secrets
+import threading
 
 import snmpexporter.target
 import snmpexporter.poller
@@ -8,6 +17,10 @@ import snmpexporter.snmpimpl
 import snmpexporter.annotator
 
 
+class Error(Exception):
+  """Base error class for this module."""
+
+
 class FakeResolver(object):
 
   def resolve(self, oid):
@@ -15,28 +28,152 @@ class FakeResolver(object):
     return 'DUMMY-MIB::' + base64.b64encode(
         oid.encode('utf-8')).decode('utf-8') + '.' + iid, {}
 
+  def resolve_many(self, oids):
+    return [self.resolve(oid) for oid in oids]
+
 
 # TODO(bluecmd): mibresolver and netsnmp are both using the same library.
 # If they are in the same process they will compete about the output format
 # which is a giant pain. We solve this by running them in seperate processes
 # for now.
 class ForkedResolver(object):
+  """MIB resolver running in a forked process.
 
-  def __init__(self):
-    self.lock = multiprocessing.Lock()
+  OIDs are sent in chunks tagged with a request ID, and all chunks of a
+  lookup are queued before waiting for any response. A dispatcher thread
+  hands responses back to the waiting callers, so concurrent callers do not
+  have to wait for each other's round-trips. If the resolver process dies,
+  pending and later lookups fail with Error instead of waiting forever.
+  """
+
+  # Seconds between checks that the resolver process is still alive
+  liveness_interval = 1.0
+
+  def __init__(self, chunk_size=1000, shared_memory=False, backend=None):
+    self.chunk_size = chunk_size
+    self.lock = threading.Lock()
+    self.pending = {}
+    # Why the resolver process is gone, once it is
+    self.failure = None
+    self.request_ids = itertools.count()
     self.request = multiprocessing.Queue()
     self.response = multiprocessing.Queue()
-    self.thread = multiprocessing.Process(target=self.run, daemon=True)
-    self.thread.start()
+    self.process = multiprocessing.Process(
+        target=_run_resolver,
+        args=(self.request, self.response, shared_memory, backend),
+        daemon=True)
+    self.process.start()
+    self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+    self.dispatcher.start()
 
   def resolve(self, oid):
+    return self.resolve_many([oid])[0]
+
+  def resolve_many(self, oids):
+    oids = list(oids)
+    requests = []
+    for i in range(0, len(oids), self.chunk_size):
+      f = futures.Future()
+      with self.lock:
+        if self.failure is not None:
+          raise Error(self.failure)
+        request_id = next(self.request_ids)
+        self.pending[request_id] = f
+      self.request.put((request_id, oids[i:i+self.chunk_size]))
+      requests.append(f)
+
+    results = []
+    for f in requests:
+      results.extend(f.result())
+    return results
+
+  def dispatch(self):
+    while True:
+      try:
+        request_id, kind, payload = self.response.get(
+            timeout=self.liveness_interval)
+      except queue.Empty:
+        if self.process.is_alive():
+          continue
+        self.fail('MIB resolver exited with code %s' % self.process.exitcode)
+        return
+      except (EOFError, OSError) as e:
+        self.fail('Lost connection to MIB resolver: %s' % e)
+        return
+      with self.lock:
+        f = self.pending.pop(request_id)
+      if kind == 'error':
+        f.set_exception(Error('MIB resolver failed: %s' % payload))
+      elif kind == 'shm':
+        f.set_result(_read_shared_memory(*payload))
+      else:
+        f.set_result(payload)
+
+  def fail(self, failure):
     with self.lock:
-      self.request.put(oid)
-      return self.response.get()
+      self.failure = failure
+      pending, self.pending = self.pending, {}
+    logging.error('%s, failing %d pending lookups', failure, len(pending))
+    for f in pending.values():
+      f.set_exception(Error(failure))
+
+
+# Responses smaller than this are not worth a shared memory segment
+SHARED_MEMORY_THRESHOLD = 64 * 1024
 
-  def run(self):
-    logging.debug('Initializing MIB resolver')
+
+def _segment_name():
+  """Returns a new unique name for a shared memory segment."""
+  return 'snmpexporter_%d_%s' % (os.getpid(), secrets.token_hex(8))
+
+
+def _create_segment(name, size):
+  """Creates a shared memory segment owned by whoever opens it next.
+
+  The resource tracker would unlink the segment when this process exits, so
+  it is told to forget it. POSIX segment names get a leading slash, which
+  is how the tracker knows them.
+  """
+  segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+  if os.name == 'posix':
+    resource_tracker.unregister('/' + name, 'shared_memory')
+  return segment
+
+
+def _read_shared_memory(name, size):
+  segment = shared_memory.SharedMemory(name=name)
+  try:
+    return pickle.loads(segment.buf[:size])
+  finally:
+    segment.close()
+    segment.unlink()
+
+
+def _write_shared_memory(data):
+  name = _segment_name()
+  segment = _create_segment(name, len(data))
+  segment.buf[:len(data)] = data
+  segment.close()
+  return name
+
+
+def _run_resolver(request, response, use_shared_memory, backend):
+  logging.debug('Initializing MIB resolver')
+  if backend is None:
     import mibresolver
-    while True:
-      request = self.request.get()
-      self.response.put(mibresolver.resolve(request))
+    backend = mibresolver
+  while True:
+    request_id, oids = request.get()
+    try:
+      results = backend.resolve_many(oids)
+    except Exception as e:
+      logging.exception('MIB resolver failed')
+      response.put((request_id, 'error', repr(e)))
+      continue
+    if use_shared_memory:
+      data = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+      if len(data) >= SHARED_MEMORY_THRESHOLD:
+        response.put(
+            (request_id, 'shm', (_write_shared_memory(data), len(data))))
+        continue
+    response.put((request_id, 'ok', results))
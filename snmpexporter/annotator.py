@@ -3,9 +3,14 @@ import binascii
 import collections
 import logging
 
+from snmpexporter import mibcache
 from snmpexporter import snmp
 
 
+class Error(Exception):
+  """Base error class for this module."""
+
+
 AnnotatedResultEntry = collections.namedtuple('AnnotatedResultEntry',
   ('data', 'mib', 'obj', 'index', 'labels'))
 
@@ -22,43 +27,30 @@ class Annotator(object):
     super(Annotator, self).__init__()
     self.config = config
     self.mibresolver = mibresolver
-    self.mibcache = dict()
+    self.annotation_index = AnnotationIndex(config.get('annotations', []))
+    self.labelification = set(
+      [x + '.' for x in config.get('labelify', [])])
 
   def annotate(self, results):
-    annotations = self.config.get('annotations', [])
-
-    # Calculate map to skip annotation if we're sure we're not going to annotate
-    # TODO(bluecmd): This could be cached
-    annotation_map = {}
-    for annotation in annotations:
-      for annotate in annotation['annotate']:
-        # Support for processing the index (for OIDs that have X.Y where we're
-        # interested in joining on X)
-        if '[' in annotate:
-          annotate, offset = annotate.split('[', 1)
-          offset = int(offset.strip(']'))
-        else:
-          offset = None
-        # Add '.' to not match .1.2.3 if we want to annotate 1.2.30
-        annotation_map[(annotate + '.', offset)] = annotation['with']
-
-    labelification = set(
-      [x + '.' for x in self.config.get('labelify', [])])
-
-    # Pre-fill the OID/Enum cache to allow annotations to get enum values
-    cached_items = []
-    for (oid, ctxt), result in results.items():
-      resolve = self.mibresolver.resolve(oid)
+    # Pre-fill the OID/Enum cache to allow annotations to get enum values.
+    # All OIDs are resolved in one batch to keep resolver round-trips down.
+    # The cache is local to this call so that the annotator can be shared.
+    oids = list(set(oid for oid, _ in results.keys()))
+    resolved = {}
+    for oid, resolve in zip(
+        oids, mibcache.resolve_many(self.mibresolver, oids)):
       if resolve is None:
         logging.warning('Failed to look up OID %s, ignoring', oid)
         continue
-      self.mibcache[oid] = resolve
-      cached_items.append(((oid, ctxt), result))
+      resolved[oid] = resolve
+    cached_items = [((oid, ctxt), result)
+                    for (oid, ctxt), result in results.items()
+                    if oid in resolved]
 
     # Calculate annotator map
     split_oid_map = collections.defaultdict(dict)
     for (oid, ctxt), result in cached_items:
-      name, _ = self.mibcache[oid]
+      name, _ = resolved[oid]
       if '.' not in name:
         continue
       _, index = name.split('.', 1)
@@ -74,7 +66,7 @@ class Annotator(object):
       if not ctxt is None:
         vlan = ctxt
 
-      name, enum = self.mibcache[oid]
+      name, enum = resolved[oid]
       if not '::' in name:
         logging.warning('OID %s resolved to %s (no MIB), ignoring', oid, name)
         continue
@@ -87,10 +79,10 @@ class Annotator(object):
         labels['vlan'] = vlan
       labels.update(
         self.annotated_join(
-          oid, index, ctxt, annotation_map, split_oid_map, results))
+          oid, index, ctxt, split_oid_map, results, resolved))
 
       # Handle labelification
-      if oid[:-(len(index) if index else 0)] in labelification:
+      if oid[:-(len(index) if index else 0)] in self.labelification:
         # Skip empty strings or non-strings that are up for labelification
         if result.value == '' or result.type not in self.LABEL_TYPES:
           continue
@@ -117,41 +109,34 @@ class Annotator(object):
     logging.debug('Annotation completed for %d metrics', len(annotated_results))
     return annotated_results
 
-  def annotated_join(self, oid, index, ctxt, annotation_map, split_oid_map,
-                     results):
-    for key, offset in annotation_map:
-      if oid.startswith(key):
-        break
-    else:
+  def annotated_join(self, oid, index, ctxt, split_oid_map, results,
+                     resolved):
+    rule = self.annotation_index.lookup(oid)
+    if rule is None:
       return {}
 
+    offset, label_paths = rule
     if offset is not None:
       index_parts = index.split('.')
       index = '.'.join(index_parts[:-offset])
     labels = {}
-    for label, annotation_path in annotation_map[(key, offset)].items():
-      # Parse the annotation path
-      annotation_keys = [x.strip() + '.' for x in annotation_path.split('>')]
-
+    for label, annotation_keys in label_paths:
       value = self.jump_to_value(
-        annotation_keys, oid, ctxt, index, split_oid_map, results)
+        annotation_keys, oid, ctxt, index, split_oid_map, results, resolved)
       if value is None:
         continue
 
       labels[label] = value
     return labels
 
-  def jump_to_value(self, keys, oid, ctxt, index, split_oid_map, results):
+  def jump_to_value(self, keys, oid, ctxt, index, split_oid_map, results,
+                    resolved):
     # Jump across the path seperated like:
     # OID.idx:value1
     # OID2.value1:value2
     # OID3.value3:final
     # label=final
-    for key in keys:
-      use_value = key[0] == '$'
-      if use_value:
-        key = key[1:]
-
+    for use_value, key in keys:
       # Try to associate with context first
       part = split_oid_map.get((key, ctxt), None)
       if not part:
@@ -180,7 +165,7 @@ class Annotator(object):
     value = results[(oid, ctxt)].value
 
     # Try enum resolution
-    _, enum = self.mibcache[oid]
+    _, enum = resolved[oid]
     if enum:
       enum_value = enum.get(value, None)
       if enum_value is None:
@@ -193,3 +178,82 @@ class Annotator(object):
   def string_to_label_value(self, value):
     value = [x for x in value if x in self.ALLOWED_CHARACTERS.encode()]
     return bytes(value).decode().strip()
+
+
+class _AnnotationNode(object):
+  __slots__ = ('children', 'rule')
+
+  def __init__(self):
+    self.children = {}
+    self.rule = None
+
+
+class AnnotationIndex(object):
+  """OID prefix trie of the annotation rules.
+
+  The rules are compiled once so that looking up the rule for a result is a
+  walk down the OID arcs instead of a scan over all configured prefixes.
+  """
+
+  def __init__(self, annotations):
+    # Flatten the rules in configuration order. If the same prefix and offset
+    # is configured twice the later labels win, but the rule keeps the
+    # position of the first one.
+    rules = collections.OrderedDict()
+    for annotation in annotations:
+      for annotate in annotation['annotate']:
+        # Support for processing the index (for OIDs that have X.Y where we're
+        # interested in joining on X)
+        if '[' in annotate:
+          annotate, offset = annotate.split('[', 1)
+          offset = int(offset.strip(']'))
+        else:
+          offset = None
+        rules[(annotate, offset)] = annotation['with']
+
+    self.root = _AnnotationNode()
+    for order, ((annotate, offset), labels) in enumerate(rules.items()):
+      node = self.root
+      for arc in annotate.split('.'):
+        node = node.children.setdefault(arc, _AnnotationNode())
+      # When a prefix has rules with different offsets the first one is
+      # the one that will ever match.
+      if node.rule is None:
+        node.rule = (order, offset, self.parse_labels(labels))
+
+  def parse_labels(self, labels):
+    """Parse 'label: [$]OID > [$]OID > ...' into (use_value, OID.) steps."""
+    parsed = []
+    for label, annotation_path in labels.items():
+      if not isinstance(annotation_path, str):
+        raise Error('Label %s has a bad annotation path %r' % (
+          label, annotation_path))
+      keys = []
+      for key in annotation_path.split('>'):
+        key = key.strip()
+        use_value = key.startswith('$')
+        if use_value:
+          key = key[1:]
+        # Every step needs an OID, without empty arcs
+        if '' in key.lstrip('.').split('.'):
+          raise Error('Label %s has a bad annotation path "%s"' % (
+            label, annotation_path))
+        keys.append((use_value, key + '.'))
+      parsed.append((label, keys))
+    return parsed
+
+  def lookup(self, oid):
+    """Return (offset, labels) of the first matching rule or None."""
+    arcs = oid.split('.')
+    node = self.root
+    best = None
+    # A rule for 1.2.3 matches 1.2.3.x but not 1.2.3 itself
+    for arc in arcs[:-1]:
+      node = node.children.get(arc, None)
+      if node is None:
+        break
+      if node.rule is not None and (best is None or node.rule[0] < best[0]):
+        best = node.rule
+    if best is None:
+      return None
+    return best[1], best[2]
@@ -212,6 +212,55 @@ annotator:
       {'interface': 'interface1', 'alias': 'alias1'}))
     self.runTest(expected, result, config)
 
+  def testAnnotationOrder(self):
+    """Test that the first configured matching rule is used."""
+    config = """
+annotator:
+  annotations:
+    - annotate:
+        - .1.2
+      with:
+        interface: .10.1
+    - annotate:
+        - .1.2.3
+      with:
+        alias: .10.2
+"""
+    result = {
+      ('.1.2.3.1', None): snmpResult(1337),
+      ('.10.1.1', None): snmpResult('interface1'),
+      ('.10.2.1', None): snmpResult('alias1'),
+    }
+    expected = self.newExpectedFromResult(result)
+    expected.update(self.createResultEntry(('.1.2.3.1', None), result,
+      {'interface': 'interface1'}))
+    self.runTest(expected, result, config)
+
+  def testAnnotationIndex(self):
+    """Test the compiled annotation rule lookup."""
+    index = annotator.AnnotationIndex([
+      {'annotate': ['.1.2.3', '.1.2[1]'],
+       'with': {'interface': '.10.1', 'alias': ' $.1.2.4 > .10.2 '}},
+      {'annotate': ['1.2.5'], 'with': {'interface': '.10.1'}},
+    ])
+    offset, labels = index.lookup('.1.2.3.1')
+    self.assertIsNone(offset)
+    self.assertEqual(sorted(labels), [
+      ('alias', [(True, '.1.2.4.'), (False, '.10.2.')]),
+      ('interface', [(False, '.10.1.')])])
+    self.assertEqual(index.lookup('.1.2.30.1')[0], 1)
+    self.assertIsNone(index.lookup('.1.2'))
+    self.assertIsNone(index.lookup('.1.3.1'))
+    # Prefixes without a leading dot do not match polled OIDs, so this falls
+    # back to the .1.2 rule
+    self.assertEqual(index.lookup('.1.2.5.1')[0], 1)
+
+  def testAnnotationIndexInvalid(self):
+    for path in ('.10.1 >', '.1.2.4 > > .10.1', '$', '.10..1', '.10.1.', 10):
+      with self.assertRaises(annotator.Error):
+        annotator.AnnotationIndex([
+          {'annotate': ['.1.2.3'], 'with': {'interface': path}}])
+
   def testMultiLevelAnnotation(self):
     """Test multi level annotation."""
     config = """
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+import socket
+
+from snmpexporter import ber
+from snmpexporter import snmp
+from snmpexporter import usm
+
+
+class _Protocol(asyncio.DatagramProtocol):
+
+  def __init__(self, client):
+    self.client = client
+
+  def datagram_received(self, data, addr):
+    self.client.received(data, addr)
+
+  def error_received(self, exc):
+    logging.debug('SNMP socket error: %s', exc)
+
+
+class Client(object):
+  """Asyncio SNMP client multiplexing many requests over UDP sockets.
+
+  Requests are matched to responses by request-id (SNMPv1/v2c) or msgID
+  (SNMPv3), so any number of requests to any number of hosts can be in
+  flight at the same time. max_inflight bounds that number.
+  """
+
+  def __init__(self, max_inflight=500):
+    self.semaphore = asyncio.Semaphore(max_inflight)
+    self.transports = {}
+    self.pending = {}
+    # Request IDs are 31 bit, start somewhere random
+    self.next_id = int.from_bytes(os.urandom(4), 'big') & 0x3fffffff
+    self.addresses = {}
+    self.engines = {}
+    self.engine_locks = {}
+    self.users = {}
+
+  def _request_id(self):
+    self.next_id = (self.next_id + 1) & 0x7fffffff
+    return self.next_id
+
+  async def _transport(self, family):
+    if family not in self.transports:
+      transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+          lambda: _Protocol(self), family=family)
+      # Another coroutine might have been faster
+      if family in self.transports:
+        transport.close()
+      else:
+        self.transports[family] = transport
+    return self.transports[family]
+
+  async def _address(self, host, port):
+    key = (host, port)
+    if key not in self.addresses:
+      infos = await asyncio.get_running_loop().getaddrinfo(
+          host, port, type=socket.SOCK_DGRAM)
+      if not infos:
+        raise snmp.SnmpError('Could not resolve %s' % host)
+      family, _, _, _, address = infos[0]
+      self.addresses[key] = (family, address)
+    return self.addresses[key]
+
+  def received(self, data, addr):
+    try:
+      _, request_id = ber.message_id(data)
+    except (ber.Error, ValueError) as e:
+      logging.debug('Dropping undecodable SNMP message from %s: %s', addr, e)
+      return
+    f = self.pending.get(request_id, None)
+    if f is None or f.done():
+      logging.debug('Dropping unexpected SNMP message from %s', addr)
+      return
+    f.set_result(data)
+
+  async def _roundtrip(self, target, request_id, message, timeout, retries):
+    family, address = await self._address(target.host, target.port)
+    transport = await self._transport(family)
+    async with self.semaphore:
+      for _ in range(retries + 1):
+        f = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = f
+        try:
+          transport.sendto(message, address)
+          return await asyncio.wait_for(f, timeout)
+        except asyncio.TimeoutError:
+          continue
+        finally:
+          del self.pending[request_id]
+    raise snmp.TimeoutError('Timeout talking to %s' % target.host)
+
+  def _user(self, target):
+    key = (target.user, target.sec_level, target.auth_proto, target.auth,
+           target.priv_proto, target.priv)
+    if key not in self.users:
+      try:
+        self.users[key] = usm.User(
+            target.user, sec_level=target.sec_level,
+            auth_proto=target.auth_proto, auth=target.auth,
+            priv_proto=target.priv_proto, priv=target.priv)
+      except usm.Error as e:
+        raise snmp.SnmpError('Bad SNMPv3 credentials for %s: %s' % (
+          target.host, e))
+    return self.users[key]
+
+  async def _engine(self, target, timeout, retries):
+    key = (target.host, target.port)
+    if key in self.engines:
+      return self.engines[key]
+    lock = self.engine_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+      if key not in self.engines:
+        # Discovery: an empty request makes the agent report its engine ID,
+        # boots and time.
+        request_id = self._request_id()
+        message = usm.encode_message(
+            request_id, None, usm.Engine(), b'',
+            ber.Pdu(ber.GET_REQUEST, request_id, 0, 0, []))
+        data = await self._roundtrip(
+            target, request_id, message, timeout, retries)
+        try:
+          response = usm.decode_message(data, None)
+        except (ber.Error, usm.Error, ValueError) as e:
+          raise snmp.SnmpError('Bad discovery response from %s: %s' % (
+            target.host, e))
+        self.engines[key] = usm.Engine(
+            response.engine_id, response.engine_boots, response.engine_time)
+    return self.engines[key]
+
+  async def request(self, target, pdu_type, varbinds, context=None,
+                    timeout=1.0, retries=3, non_repeaters=0,
+                    max_repetitions=0):
+    """Send a request PDU and return the response PDU."""
+    if pdu_type == ber.GET_BULK_REQUEST:
+      error_status, error_index = non_repeaters, max_repetitions
+    else:
+      error_status, error_index = 0, 0
+    varbinds = [(oid, ber.NULL, None) for oid in varbinds]
+    if target.version == 3:
+      pdu = await self._request_v3(
+          target, pdu_type, varbinds, error_status, error_index, context,
+          timeout, retries)
+    else:
+      pdu = await self._request_v2(
+          target, pdu_type, varbinds, error_status, error_index, context,
+          timeout, retries)
+    if pdu.error_status != 0:
+      raise snmp.SnmpError('SNMP error %d at index %d from %s' % (
+        pdu.error_status, pdu.error_index, target.host))
+    return pdu
+
+  async def _request_v2(self, target, pdu_type, varbinds, error_status,
+                        error_index, context, timeout, retries):
+    request_id = self._request_id()
+    community = (
+        '%s@%s' % (target.community, context)) if context else target.community
+    version = ber.VERSION_1 if target.version == 1 else ber.VERSION_2C
+    message = ber.encode_message(version, community, ber.Pdu(
+      pdu_type, request_id, error_status, error_index, varbinds))
+    data = await self._roundtrip(target, request_id, message, timeout, retries)
+    try:
+      _, _, pdu = ber.decode_message(data)
+    except (ber.Error, ValueError) as e:
+      raise snmp.SnmpError('Bad response from %s: %s' % (target.host, e))
+    return pdu
+
+  async def _request_v3(self, target, pdu_type, varbinds, error_status,
+                        error_index, context, timeout, retries):
+    user = self._user(target)
+    engine = await self._engine(target, timeout, retries)
+    context = ('vlan-%s' % context) if context else ''
+    # One resynchronisation if the agent thinks we are outside its time
+    # window (it has rebooted or our estimate drifted).
+    for attempt in range(2):
+      request_id = self._request_id()
+      message = usm.encode_message(
+          request_id, user, engine, context.encode(), ber.Pdu(
+            pdu_type, request_id, error_status, error_index, varbinds))
+      data = await self._roundtrip(
+          target, request_id, message, timeout, retries)
+      try:
+        response = usm.decode_message(data, user)
+      except (ber.Error, ValueError) as e:
+        raise snmp.SnmpError('Bad response from %s: %s' % (target.host, e))
+      except usm.Error as e:
+        raise snmp.SnmpError('Authentication failure from %s: %s' % (
+          target.host, e))
+      pdu = response.pdu
+      if pdu.type != ber.REPORT:
+        if (response.flags & user.flags) != user.flags:
+          raise snmp.SnmpError(
+              'Response from %s has lower security level' % target.host)
+        return pdu
+      report = pdu.varbinds[0][0] if pdu.varbinds else None
+      if report == usm.NOT_IN_TIME_WINDOWS and attempt == 0:
+        logging.debug('Resynchronising engine time with %s', target.host)
+        engine.update(response.engine_boots, response.engine_time)
+        continue
+      if report == usm.UNKNOWN_ENGINE_IDS and attempt == 0:
+        logging.debug('Engine ID of %s changed, rediscovering', target.host)
+        self.engines.pop((target.host, target.port), None)
+        engine = await self._engine(target, timeout, retries)
+        continue
+      raise snmp.SnmpError('SNMPv3 report %s from %s' % (report, target.host))
+
+  def close(self):
+    for transport in self.transports.values():
+      transport.close()
+    self.transports = {}
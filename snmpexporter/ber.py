@@ -0,0 +1,247 @@
+import collections
+import ipaddress
+
+
+# Universal types
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_IDENTIFIER = 0x06
+SEQUENCE = 0x30
+
+# SNMP application types
+IP_ADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+OPAQUE = 0x44
+COUNTER64 = 0x46
+
+# Varbind exceptions
+NO_SUCH_OBJECT = 0x80
+NO_SUCH_INSTANCE = 0x81
+END_OF_MIB_VIEW = 0x82
+
+# PDU types
+GET_REQUEST = 0xa0
+GET_NEXT_REQUEST = 0xa1
+RESPONSE = 0xa2
+SET_REQUEST = 0xa3
+GET_BULK_REQUEST = 0xa5
+REPORT = 0xa8
+
+VERSION_1 = 0
+VERSION_2C = 1
+VERSION_3 = 3
+
+UNSIGNED_TYPES = set([COUNTER32, GAUGE32, TIMETICKS, COUNTER64])
+EXCEPTION_TYPES = set([NO_SUCH_OBJECT, NO_SUCH_INSTANCE, END_OF_MIB_VIEW])
+
+
+Pdu = collections.namedtuple('Pdu', (
+  'type', 'request_id', 'error_status', 'error_index', 'varbinds'))
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class DecodeError(Error):
+  """The data could not be decoded."""
+
+
+def encode_length(length):
+  if length < 0x80:
+    return bytes((length,))
+  encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+  return bytes((0x80 | len(encoded),)) + encoded
+
+
+def encode_tlv(tag, value):
+  return b''.join((bytes((tag,)), encode_length(len(value)), value))
+
+
+def encode_integer(value, tag=INTEGER):
+  bits = value.bit_length() if value >= 0 else (~value).bit_length()
+  return encode_tlv(tag, value.to_bytes(bits // 8 + 1, 'big', signed=True))
+
+
+def encode_octets(value, tag=OCTET_STRING):
+  if isinstance(value, str):
+    value = value.encode()
+  return encode_tlv(tag, bytes(value))
+
+
+def encode_null(tag=NULL):
+  return bytes((tag, 0))
+
+
+def encode_oid(oid):
+  arcs = [int(x) for x in oid.strip('.').split('.')]
+  if len(arcs) < 2:
+    arcs.append(0)
+  encoded = bytearray()
+  for arc in [arcs[0] * 40 + arcs[1]] + arcs[2:]:
+    chunk = [arc & 0x7f]
+    arc >>= 7
+    while arc:
+      chunk.append(0x80 | (arc & 0x7f))
+      arc >>= 7
+    encoded.extend(reversed(chunk))
+  return encode_tlv(OBJECT_IDENTIFIER, bytes(encoded))
+
+
+def encode_sequence(*items, tag=SEQUENCE):
+  return encode_tlv(tag, b''.join(items))
+
+
+def encode_value(tag, value):
+  if tag == INTEGER or tag in UNSIGNED_TYPES:
+    return encode_integer(value, tag)
+  if tag == OCTET_STRING or tag == OPAQUE:
+    return encode_octets(value, tag)
+  if tag == OBJECT_IDENTIFIER:
+    return encode_oid(value)
+  if tag == IP_ADDRESS:
+    return encode_tlv(tag, ipaddress.IPv4Address(value).packed)
+  if tag == NULL or tag in EXCEPTION_TYPES:
+    return encode_null(tag)
+  raise Error('Cannot encode type 0x%02x' % tag)
+
+
+def encode_pdu(pdu):
+  varbinds = [encode_sequence(encode_oid(oid), encode_value(tag, value))
+              for oid, tag, value in pdu.varbinds]
+  return encode_sequence(
+      encode_integer(pdu.request_id),
+      encode_integer(pdu.error_status),
+      encode_integer(pdu.error_index),
+      encode_sequence(*varbinds),
+      tag=pdu.type)
+
+
+def encode_message(version, community, pdu):
+  """Encode a SNMPv1/v2c message."""
+  return encode_sequence(
+      encode_integer(version), encode_octets(community), encode_pdu(pdu))
+
+
+def decode_tlv(data, offset=0):
+  """Returns (tag, start of value, end of value)."""
+  try:
+    tag = data[offset]
+    length = data[offset + 1]
+  except IndexError:
+    raise DecodeError('Truncated TLV at offset %d' % offset)
+  offset += 2
+  if length & 0x80:
+    octets = length & 0x7f
+    if octets == 0 or octets > 4 or offset + octets > len(data):
+      raise DecodeError('Bad length at offset %d' % offset)
+    length = int.from_bytes(data[offset:offset + octets], 'big')
+    offset += octets
+  if offset + length > len(data):
+    raise DecodeError('Truncated value at offset %d' % offset)
+  return tag, offset, offset + length
+
+
+def decode_sequence(data, start, end):
+  """Returns a list of (tag, start, end) of the elements in a sequence."""
+  items = []
+  while start < end:
+    item = decode_tlv(data, start)
+    if item[2] > end:
+      raise DecodeError('Element overflows sequence at offset %d' % start)
+    items.append(item)
+    start = item[2]
+  return items
+
+
+def expect(data, item, tag):
+  if item[0] != tag:
+    raise DecodeError('Expected type 0x%02x, got 0x%02x' % (tag, item[0]))
+  return data[item[1]:item[2]]
+
+
+def decode_integer(value, signed=True):
+  if not value:
+    raise DecodeError('Empty integer')
+  return int.from_bytes(value, 'big', signed=signed)
+
+
+def decode_oid(value):
+  if not value:
+    raise DecodeError('Empty OID')
+  arcs = []
+  arc = 0
+  for octet in value:
+    arc = (arc << 7) | (octet & 0x7f)
+    if not octet & 0x80:
+      arcs.append(arc)
+      arc = 0
+  first = arcs[0]
+  if first < 80:
+    head = [first // 40, first % 40]
+  else:
+    head = [2, first - 80]
+  return '.' + '.'.join(str(x) for x in head + arcs[1:])
+
+
+def decode_value(tag, value):
+  if tag == INTEGER:
+    return decode_integer(value)
+  if tag in UNSIGNED_TYPES:
+    return decode_integer(value, signed=False)
+  if tag == OCTET_STRING or tag == OPAQUE:
+    return bytes(value)
+  if tag == OBJECT_IDENTIFIER:
+    return decode_oid(value)
+  if tag == IP_ADDRESS:
+    return '.'.join(str(x) for x in value)
+  return None
+
+
+def decode_pdu(data, item):
+  tag, start, end = item
+  fields = decode_sequence(data, start, end)
+  if len(fields) != 4:
+    raise DecodeError('PDU has %d fields, expected 4' % len(fields))
+  varbinds = []
+  for varbind in decode_sequence(data, fields[3][1], fields[3][2]):
+    oid_item, value_item = decode_sequence(data, varbind[1], varbind[2])
+    oid = decode_oid(expect(data, oid_item, OBJECT_IDENTIFIER))
+    value_tag = value_item[0]
+    varbinds.append((oid, value_tag, decode_value(
+        value_tag, data[value_item[1]:value_item[2]])))
+  return Pdu(tag,
+             decode_integer(expect(data, fields[0], INTEGER)),
+             decode_integer(expect(data, fields[1], INTEGER)),
+             decode_integer(expect(data, fields[2], INTEGER)),
+             varbinds)
+
+
+def decode_message(data):
+  """Decode a SNMPv1/v2c message, returns (version, community, pdu)."""
+  message = decode_tlv(data)
+  version, community, pdu = decode_sequence(data, message[1], message[2])
+  return (decode_integer(expect(data, version, INTEGER)),
+          bytes(expect(data, community, OCTET_STRING)),
+          decode_pdu(data, pdu))
+
+
+def message_id(data):
+  """Returns (version, id) used to match a response to its request.
+
+  This is the request-id for SNMPv1/v2c and the msgID for SNMPv3, where the
+  PDU itself may be encrypted.
+  """
+  message = decode_tlv(data)
+  version = decode_tlv(data, message[1])
+  second = decode_tlv(data, version[2])
+  version = decode_integer(expect(data, version, INTEGER))
+  if version == VERSION_3:
+    msg_id = decode_tlv(data, second[1])
+    return version, decode_integer(expect(data, msg_id, INTEGER))
+  pdu = decode_tlv(data, second[2])
+  request_id = decode_tlv(data, pdu[1])
+  return version, decode_integer(expect(data, request_id, INTEGER))
@@ -0,0 +1,65 @@
+import unittest
+
+from snmpexporter import ber
+
+
+class TestBer(unittest.TestCase):
+
+  def testLength(self):
+    self.assertEqual(ber.encode_length(0x7f), b'\x7f')
+    self.assertEqual(ber.encode_length(0x80), b'\x81\x80')
+    self.assertEqual(ber.encode_length(0x1234), b'\x82\x12\x34')
+
+  def testInteger(self):
+    for value, encoded in [
+        (0, b'\x02\x01\x00'), (127, b'\x02\x01\x7f'),
+        (128, b'\x02\x02\x00\x80'),
+        (-1, b'\x02\x01\xff'), (-128, b'\x02\x01\x80'),
+        (-129, b'\x02\x02\xff\x7f')]:
+      self.assertEqual(ber.encode_integer(value), encoded)
+      self.assertEqual(ber.decode_integer(encoded[2:]), value)
+
+  def testUnsigned(self):
+    encoded = ber.encode_integer(2**64 - 1, ber.COUNTER64)
+    self.assertEqual(encoded, b'\x46\x09\x00' + b'\xff' * 8)
+    self.assertEqual(
+        ber.decode_value(ber.COUNTER64, encoded[2:]), 2**64 - 1)
+    # Some agents forget the leading zero on unsigned types
+    self.assertEqual(
+        ber.decode_value(ber.COUNTER32, b'\xff\xff\xff\xff'), 2**32 - 1)
+
+  def testOid(self):
+    encoded = ber.encode_oid('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.300')
+    self.assertEqual(
+        encoded, bytes.fromhex('060f2b0601040109092e0103010102822c'))
+    self.assertEqual(ber.decode_oid(encoded[2:]),
+                     '.1.3.6.1.4.1.9.9.46.1.3.1.1.2.300')
+
+  def testMessageRoundtrip(self):
+    pdu = ber.Pdu(ber.RESPONSE, 1234, 0, 0, [
+      ('.1.3.6.1.2.1.1.1.0', ber.OCTET_STRING, b'WS-C2960'),
+      ('.1.3.6.1.2.1.2.2.1.10.1', ber.COUNTER32, 4000000000),
+      ('.1.3.6.1.2.1.4.20.1.1.10.0.0.1', ber.IP_ADDRESS, '10.0.0.1'),
+      ('.1.3.6.1.2.1.1.2.0', ber.OBJECT_IDENTIFIER, '.1.3.6.1.4.1.9'),
+      ('.1.3.6.1.2.1.1.3.0', ber.TIMETICKS, 1337),
+      ('.1.3.6.1.2.1.1.4.0', ber.NO_SUCH_OBJECT, None),
+      ('.1.3.6.1.2.1.2.2.1.2.' + '1' * 200, ber.OCTET_STRING, b'x' * 300),
+    ])
+    message = ber.encode_message(ber.VERSION_2C, 'public', pdu)
+    self.assertEqual(ber.decode_message(message),
+                     (ber.VERSION_2C, b'public', pdu))
+    self.assertEqual(ber.message_id(message), (ber.VERSION_2C, 1234))
+
+  def testTruncated(self):
+    message = ber.encode_message(ber.VERSION_2C, 'public', ber.Pdu(
+      ber.GET_REQUEST, 1, 0, 0, [('.1.3.6.1', ber.NULL, None)]))
+    with self.assertRaises(ber.DecodeError):
+      ber.decode_message(message[:-1])
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
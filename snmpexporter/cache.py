@@ -0,0 +1,67 @@
+import threading
+import time
+
+
+class TtlCache(object):
+  """Key-value cache where entries expire after a number of seconds.
+
+  The entries live in store, which can be any dict-like object. Pass a
+  multiprocessing.Manager().dict() to share the cache between poller
+  processes. Keys and values then have to be picklable.
+
+  If expiries is set, the expiry time of every key is kept there as well,
+  so that expire() does not have to load every value from the store. Share
+  it the same way as store.
+  """
+
+  def __init__(self, ttl, store=None, expiries=None):
+    super(TtlCache, self).__init__()
+    self.ttl = ttl
+    self.store = store if store is not None else {}
+    self.expiries = expiries
+    # Only protects the local counters, the store does its own locking
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    entry = self.store.get(key, None)
+    if entry is not None:
+      expires, value = entry
+      if expires > time.time():
+        with self.lock:
+          self.hits += 1
+        return value
+      self.invalidate(key)
+    with self.lock:
+      self.misses += 1
+    return None
+
+  def set(self, key, value, ttl=None):
+    ttl = self.ttl if ttl is None else ttl
+    if ttl <= 0:
+      return
+    # Wall clock time as the entry may be read by another process
+    expires = time.time() + ttl
+    self.store[key] = (expires, value)
+    if self.expiries is not None:
+      self.expiries[key] = expires
+
+  def invalidate(self, key):
+    self.store.pop(key, None)
+    if self.expiries is not None:
+      self.expiries.pop(key, None)
+
+  def expire(self):
+    """Remove all expired entries."""
+    now = time.time()
+    if self.expiries is None:
+      expiries = [(key, expires) for key, (expires, _) in self.store.items()]
+    else:
+      expiries = list(self.expiries.items())
+    for key, expires in expiries:
+      if expires <= now:
+        self.invalidate(key)
+
+  def __len__(self):
+    return len(self.store)
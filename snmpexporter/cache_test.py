@@ -0,0 +1,58 @@
+import multiprocessing
+import unittest
+
+from snmpexporter import cache
+
+
+class TestTtlCache(unittest.TestCase):
+
+  def testGetSet(self):
+    c = cache.TtlCache(60)
+    self.assertIsNone(c.get('a'))
+    c.set('a', 1)
+    self.assertEqual(c.get('a'), 1)
+    c.invalidate('a')
+    self.assertIsNone(c.get('a'))
+    self.assertEqual((c.hits, c.misses), (1, 2))
+
+  def testExpiry(self):
+    c = cache.TtlCache(60)
+    c.set('a', 1, ttl=-1)
+    self.assertEqual(len(c), 0)
+    c.store['b'] = (0, 2)
+    self.assertIsNone(c.get('b'))
+    self.assertEqual(len(c), 0)
+    c.store['b'] = (0, 2)
+    c.set('c', 3)
+    c.expire()
+    self.assertEqual(list(c.store.keys()), ['c'])
+
+  def testExpiries(self):
+    class Store(dict):
+      def items(self):
+        raise AssertionError('Values loaded to expire entries')
+
+    c = cache.TtlCache(60, Store(), {})
+    c.set('a', 1)
+    c.set('b', 2, ttl=1)
+    c.expiries['b'] = 0
+    c.expire()
+    self.assertEqual(list(c.store.keys()), ['a'])
+    self.assertEqual(list(c.expiries.keys()), ['a'])
+    c.invalidate('a')
+    self.assertEqual(c.expiries, {})
+
+  def testSharedStore(self):
+    with multiprocessing.Manager() as manager:
+      store = manager.dict()
+      cache.TtlCache(60, store).set(('host', 'layer'), ('model', [1, 2]))
+      self.assertEqual(cache.TtlCache(60, store).get(('host', 'layer')),
+                       ('model', [1, 2]))
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,115 @@
+import zlib
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class GzipCompressor(object):
+
+  encoding = 'gzip'
+  levels = range(1, 10)
+
+  def __init__(self, level=6):
+    super(GzipCompressor, self).__init__()
+    # wbits 31 is zlib for "gzip header and trailer"
+    self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+  def compress(self, data):
+    return self.compressor.compress(data)
+
+  def flush(self):
+    return self.compressor.flush()
+
+
+class ZstdCompressor(object):
+
+  encoding = 'zstd'
+  levels = range(1, 23)
+
+  def __init__(self, level=3):
+    super(ZstdCompressor, self).__init__()
+    self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+  def compress(self, data):
+    return self.compressor.compress(data)
+
+  def flush(self):
+    return self.compressor.flush()
+
+
+# Content-Encoding -> compressor, in order of preference
+COMPRESSORS = [('zstd', ZstdCompressor), ('gzip', GzipCompressor)]
+
+
+def available():
+  return [encoding for encoding, _ in COMPRESSORS
+          if encoding != 'zstd' or zstandard is not None]
+
+
+def parse_accept_encoding(header):
+  """Returns {encoding: quality} from an Accept-Encoding header."""
+  encodings = {}
+  for part in (header or '').split(','):
+    fields = [x.strip() for x in part.split(';')]
+    if not fields[0]:
+      continue
+    quality = 1.0
+    for field in fields[1:]:
+      if field.startswith('q='):
+        try:
+          quality = float(field[2:])
+        except ValueError:
+          quality = 0.0
+    encodings[fields[0].lower()] = quality
+  return encodings
+
+
+def negotiate(header, encodings):
+  """Pick one of encodings given an Accept-Encoding header, or None.
+
+  encodings are in order of preference, which breaks ties in quality.
+  """
+  accepted = parse_accept_encoding(header)
+  best = None
+  best_quality = 0.0
+  for encoding in encodings:
+    quality = accepted.get(encoding, accepted.get('*', 0.0))
+    if quality > best_quality:
+      best, best_quality = encoding, quality
+  # The client might explicitly prefer no compression
+  if accepted.get('identity', 0.0) > best_quality:
+    return None
+  return best
+
+
+def compressor_class(encoding):
+  for name, cls in COMPRESSORS:
+    if name == encoding:
+      return cls
+  raise Error('Unsupported encoding %s' % encoding)
+
+
+def compressor(encoding, level=None):
+  """Returns a compressor, level is in the range of the encoding."""
+  cls = compressor_class(encoding)
+  if level is None:
+    return cls()
+  if level not in cls.levels:
+    raise Error('%s level must be %d to %d, not %d' % (
+        encoding, cls.levels[0], cls.levels[-1], level))
+  return cls(level)
+
+
+def compress_chunks(chunks, compressor):
+  """Compresses an iterator of byte chunks, skipping empty output."""
+  for chunk in chunks:
+    data = compressor.compress(chunk)
+    if data:
+      yield data
+  yield compressor.flush()
@@ -0,0 +1,63 @@
+import gzip
+import unittest
+
+from snmpexporter import compression
+
+
+class TestNegotiate(unittest.TestCase):
+
+  def testParse(self):
+    self.assertEqual(
+        compression.parse_accept_encoding('gzip, deflate;q=0.5, br;q=x'),
+        {'gzip': 1.0, 'deflate': 0.5, 'br': 0.0})
+    self.assertEqual(compression.parse_accept_encoding(None), {})
+
+  def testNegotiate(self):
+    offered = ['zstd', 'gzip']
+    self.assertEqual(compression.negotiate('gzip', offered), 'gzip')
+    self.assertEqual(compression.negotiate('gzip, zstd', offered), 'zstd')
+    self.assertEqual(
+        compression.negotiate('gzip, zstd;q=0.5', offered), 'gzip')
+    self.assertEqual(compression.negotiate('*', offered), 'zstd')
+    self.assertIsNone(compression.negotiate('gzip;q=0', offered))
+    self.assertIsNone(compression.negotiate('', offered))
+    self.assertIsNone(compression.negotiate('gzip', []))
+    self.assertIsNone(
+        compression.negotiate('identity, gzip;q=0.5', offered))
+
+
+class TestCompress(unittest.TestCase):
+
+  CHUNKS = [b'ifInOctets{interface="Gi0/%d"} 1\n' % i for i in range(1000)]
+
+  def testGzip(self):
+    compressed = b''.join(compression.compress_chunks(
+      self.CHUNKS, compression.compressor('gzip', 1)))
+    self.assertEqual(gzip.decompress(compressed), b''.join(self.CHUNKS))
+
+  def testZstd(self):
+    if compression.zstandard is None:
+      self.skipTest('zstandard is not installed')
+    compressed = b''.join(compression.compress_chunks(
+      self.CHUNKS, compression.compressor('zstd')))
+    self.assertEqual(
+        compression.zstandard.ZstdDecompressor().decompressobj().decompress(
+          compressed), b''.join(self.CHUNKS))
+
+  def testUnsupported(self):
+    with self.assertRaises(compression.Error):
+      compression.compressor('br')
+
+  def testLevels(self):
+    self.assertEqual(compression.compressor('gzip', 9).encoding, 'gzip')
+    # A good zstd level is too high for gzip
+    with self.assertRaises(compression.Error):
+      compression.compressor('gzip', 19)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
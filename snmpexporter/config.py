@@ -1,17 +1,38 @@
-import os.path
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
 import yaml
 
 
+# Sections every configuration needs to have
+SECTIONS = ('snmp', 'override', 'annotator', 'exporter', 'collection')
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class InvalidConfig(Error):
+  """The configuration is not usable."""
+
+
 class YamlLoader(yaml.SafeLoader):
 
-    def __init__(self, stream):
+    def __init__(self, stream, files=None):
         self._root = os.path.dirname(stream.name)
+        # Every file that makes up the configuration, to notice changes
+        self.files = files if files is not None else [stream.name]
         super(YamlLoader, self).__init__(stream)
 
     def include(self, node):
         filename = os.path.join(self._root, self.construct_scalar(node))
+        self.files.append(filename)
         with open(filename, 'r') as f:
-            return yaml.load(f, YamlLoader)
+            return yaml.load(f, functools.partial(YamlLoader, files=self.files))
 
 
 YamlLoader.add_constructor('!include', YamlLoader.include)
@@ -20,3 +41,110 @@ YamlLoader.add_constructor('!include', YamlLoader.include)
 def load(filename):
   with open(filename, 'r') as f:
     return yaml.load(f, YamlLoader)
+
+
+def load_files(filename):
+  """Returns (config, list of files it was loaded from)."""
+  files = [filename]
+  with open(filename, 'r') as f:
+    config = yaml.load(f, functools.partial(YamlLoader, files=files))
+  return config, files
+
+
+def validate(config):
+  if not isinstance(config, dict):
+    raise InvalidConfig('Configuration is not a mapping')
+  for section in SECTIONS:
+    if section not in config:
+      raise InvalidConfig('Missing section "%s"' % section)
+  for name, collection in (config['collection'] or {}).items():
+    if 'models' not in collection:
+      raise InvalidConfig('Collection "%s" has no models' % name)
+    for regexp in collection['models']:
+      try:
+        re.compile(regexp)
+      except re.error as e:
+        raise InvalidConfig('Collection "%s" has a bad model "%s": %s' % (
+          name, regexp, e))
+    ttl = collection.get('cache-ttl', 0)
+    if not isinstance(ttl, (int, float)) or ttl < 0:
+      raise InvalidConfig('Collection "%s" has a bad cache-ttl "%s"' % (
+        name, ttl))
+
+
+def collections_hash(collections):
+  """Returns a hash of the collections, to key what was derived from them."""
+  return hashlib.sha1(json.dumps(
+    collections, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ConfigWatcher(object):
+  """A configuration file that is parsed once and reloaded when changed.
+
+  Every successful load gets a new generation number, so that users of the
+  configuration can tell when derived state has to be rebuilt. If a changed
+  configuration fails to load the previous one is kept.
+
+  The hash of the collections is computed once per generation, as cached
+  walk plans are keyed by it, see Poller.
+  """
+
+  def __init__(self, filename):
+    super(ConfigWatcher, self).__init__()
+    self.filename = filename
+    self.lock = threading.Lock()
+    self.generation = 0
+    self.config = None
+    self.collections_hash = None
+    self.mtimes = {}
+    self.reload()
+
+  def _mtimes(self, files):
+    mtimes = {}
+    for filename in files:
+      try:
+        mtimes[filename] = os.stat(filename).st_mtime_ns
+      except OSError:
+        mtimes[filename] = None
+    return mtimes
+
+  def snapshot(self):
+    """Returns (generation, config)."""
+    with self.lock:
+      return self.generation, self.config
+
+  def poller_snapshot(self):
+    """Returns (generation, config, hash of its collections)."""
+    with self.lock:
+      return self.generation, self.config, self.collections_hash
+
+  def check(self):
+    """Reload the configuration if any of its files have changed."""
+    with self.lock:
+      files = list(self.mtimes.keys())
+      changed = self._mtimes(files) != self.mtimes
+    if changed:
+      logging.info('Configuration %s changed', self.filename)
+      self.reload()
+
+  def reload(self):
+    """Returns True if a new configuration was loaded."""
+    with self.lock:
+      try:
+        config, files = load_files(self.filename)
+        validate(config)
+      except (OSError, yaml.YAMLError, Error) as e:
+        if self.config is None:
+          raise
+        logging.error('Failed to load %s, keeping generation %d: %s',
+            self.filename, self.generation, e)
+        # Do not try again until the files change again
+        self.mtimes = self._mtimes(self.mtimes.keys())
+        return False
+      self.config = config
+      self.collections_hash = collections_hash(config['collection'])
+      self.mtimes = self._mtimes(files)
+      self.generation += 1
+      logging.info('Loaded %s as generation %d', self.filename,
+          self.generation)
+      return True
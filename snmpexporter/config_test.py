@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from snmpexporter import config
+
+
+MAIN = """
+snmp: !include auth.yaml
+override: {}
+annotator: {}
+exporter: {}
+collection:
+  Default:
+    models: ['.*']
+    oids: ['.1.3.6.1.2.1.2.2.1']
+"""
+
+AUTH = """
+test:
+  version: 2
+  community: %s
+"""
+
+
+class TestConfigWatcher(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, 'snmpexporter.yaml')
+    self.write('snmpexporter.yaml', MAIN)
+    self.write('auth.yaml', AUTH % 'public')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self, name, data):
+    path = os.path.join(self.dir, name)
+    with open(path, 'w') as f:
+      f.write(data)
+    # Make sure the change is visible even on coarse mtime filesystems
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+  def testLoadFiles(self):
+    cfg, files = config.load_files(self.filename)
+    self.assertEqual(cfg['snmp']['test']['community'], 'public')
+    self.assertEqual(files, [
+      self.filename, os.path.join(self.dir, 'auth.yaml')])
+
+  def testReloadOnChange(self):
+    watcher = config.ConfigWatcher(self.filename)
+    generation, cfg = watcher.snapshot()
+    self.assertEqual(generation, 1)
+    self.assertEqual(watcher.poller_snapshot(), (
+        1, cfg, config.collections_hash(cfg['collection'])))
+    watcher.check()
+    self.assertEqual(watcher.snapshot()[0], 1)
+
+    # Changes to included files count too
+    self.write('auth.yaml', AUTH % 'private')
+    watcher.check()
+    generation, cfg = watcher.snapshot()
+    self.assertEqual(generation, 2)
+    self.assertEqual(cfg['snmp']['test']['community'], 'private')
+
+  def testBadConfigKeepsOld(self):
+    watcher = config.ConfigWatcher(self.filename)
+    self.write('snmpexporter.yaml', MAIN.replace('collection:', 'foo:'))
+    self.assertFalse(watcher.reload())
+    generation, cfg = watcher.snapshot()
+    self.assertEqual(generation, 1)
+    self.assertIn('collection', cfg)
+
+  def testValidate(self):
+    with self.assertRaises(config.InvalidConfig):
+      config.validate([])
+    cfg, _ = config.load_files(self.filename)
+    config.validate(cfg)
+    cfg['collection']['Default']['models'] = ['(']
+    with self.assertRaises(config.InvalidConfig):
+      config.validate(cfg)
+    cfg['collection']['Default']['models'] = ['.*']
+    cfg['collection']['Default']['cache-ttl'] = '5m'
+    with self.assertRaises(config.InvalidConfig):
+      config.validate(cfg)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
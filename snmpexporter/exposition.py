@@ -0,0 +1,323 @@
+import collections
+import math
+import struct
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+# A metric family, samples are (labels, value) where labels is a dict
+Family = collections.namedtuple(
+  'Family', ('name', 'help', 'type', 'samples'))
+
+# Size of the encoded chunks written to the client
+CHUNK_SIZE = 64 * 1024
+
+
+def encode_chunks(lines, chunk_size=CHUNK_SIZE):
+  """Turns lines of exposition text into newline terminated UTF-8 chunks.
+
+  Chunks are at least chunk_size bytes, except the last one.
+  """
+  chunk = []
+  size = 0
+  for line in lines:
+    chunk.append(line)
+    size += len(line) + 1
+    if size >= chunk_size:
+      chunk.append('')
+      yield '\n'.join(chunk).encode()
+      chunk = []
+      size = 0
+  if chunk:
+    chunk.append('')
+    yield '\n'.join(chunk).encode()
+
+
+class SharedChunks(object):
+  """Lets several readers stream the same lazily produced chunks.
+
+  Chunks are produced as the fastest reader needs them and kept for the
+  others. Once seal() is called no more readers can be added, and chunks
+  every reader has had are dropped. All readers have to be used from the
+  same thread.
+  """
+
+  def __init__(self, chunks):
+    super(SharedChunks, self).__init__()
+    self.chunks = iter(chunks)
+    # Chunks that are kept, the first one is chunk number start
+    self.buffer = collections.deque()
+    self.start = 0
+    # ChunkReader -> number of the next chunk it reads
+    self.offsets = {}
+    self.sealed = False
+    self.done = False
+    self.error = None
+
+  def reader(self):
+    if self.sealed:
+      raise Error('Readers have to be added before sealing')
+    reader = ChunkReader(self)
+    self.offsets[reader] = 0
+    return reader
+
+  def seal(self):
+    self.sealed = True
+    self._trim()
+
+  def read(self, reader):
+    i = self.offsets[reader]
+    if i == self.start + len(self.buffer):
+      if self.error is not None:
+        raise self.error
+      if self.done:
+        raise StopIteration
+      try:
+        self.buffer.append(next(self.chunks))
+      except StopIteration:
+        self.done = True
+        raise
+      except Exception as e:
+        self.error = e
+        raise
+    self.offsets[reader] = i + 1
+    chunk = self.buffer[i - self.start]
+    self._trim()
+    return chunk
+
+  def remove(self, reader):
+    self.offsets.pop(reader, None)
+    self._trim()
+    if self.sealed and not self.offsets and hasattr(self.chunks, 'close'):
+      # Nobody wants the rest
+      self.chunks.close()
+
+  def _trim(self):
+    if not self.sealed:
+      return
+    first = min(self.offsets.values(), default=self.start + len(self.buffer))
+    while self.start < first:
+      self.buffer.popleft()
+      self.start += 1
+
+
+class ChunkReader(object):
+  """Iterates over the chunks of a SharedChunks."""
+
+  def __init__(self, shared):
+    super(ChunkReader, self).__init__()
+    self.shared = shared
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    try:
+      return self.shared.read(self)
+    except BaseException:
+      self.close()
+      raise
+
+  def close(self):
+    self.shared.remove(self)
+
+
+def escape_label_value(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+    '"', '\\"')
+
+
+def escape_help(value):
+  return value.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def format_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join(
+    '%s="%s"' % (k, escape_label_value(v)) for k, v in labels.items())
+
+
+class TextEncoder(object):
+  """The Prometheus text exposition format, version 0.0.4."""
+
+  content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+  def lines(self, families):
+    for family in families:
+      yield '# HELP %s %s' % (family.name, escape_help(family.help))
+      yield '# TYPE %s %s' % (family.name, family.type)
+      for labels, value in family.samples:
+        yield '%s%s %s' % (family.name, format_labels(labels), value)
+
+  def chunks(self, families):
+    return encode_chunks(self.lines(families))
+
+
+class OpenMetricsEncoder(TextEncoder):
+  """The OpenMetrics text format, version 1.0.0."""
+
+  content_type = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+  def format_value(self, value):
+    try:
+      value = float(value)
+    except ValueError:
+      return None
+    if math.isnan(value):
+      return 'NaN'
+    if math.isinf(value):
+      return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer() and abs(value) < 2**63:
+      return str(int(value))
+    return repr(value)
+
+  def lines(self, families):
+    for family in families:
+      name = family.name
+      sample_name = name
+      if family.type == 'counter':
+        # Counter samples have to end with _total, the family must not
+        if name.endswith('_total'):
+          name = name[:-len('_total')]
+        else:
+          sample_name = name + '_total'
+      yield '# HELP %s %s' % (name, escape_help(family.help))
+      yield '# TYPE %s %s' % (name, family.type)
+      for labels, value in family.samples:
+        value = self.format_value(value)
+        if value is None:
+          continue
+        yield '%s%s %s' % (sample_name, format_labels(labels), value)
+    yield '# EOF'
+
+
+def _varint(value):
+  out = bytearray()
+  while value > 0x7f:
+    out.append(0x80 | (value & 0x7f))
+    value >>= 7
+  out.append(value)
+  return bytes(out)
+
+
+def _field(number, data):
+  """Length-delimited protobuf field."""
+  return b''.join((_varint(number << 3 | 2), _varint(len(data)), data))
+
+
+class ProtobufEncoder(object):
+  """Length-delimited io.prometheus.client.MetricFamily messages.
+
+  The handful of messages needed are encoded by hand, see metrics.proto in
+  prometheus/client_model.
+  """
+
+  content_type = ('application/vnd.google.protobuf; '
+                  'proto=io.prometheus.client.MetricFamily; '
+                  'encoding=delimited')
+
+  TYPES = {'counter': 0, 'gauge': 1, 'untyped': 3}
+  # Field numbers of the value in Metric, by type
+  VALUE_FIELDS = {'counter': 3, 'gauge': 2, 'untyped': 5}
+
+  def family(self, family):
+    value_field = self.VALUE_FIELDS.get(family.type, 5)
+    parts = [
+      _field(1, family.name.encode()),
+      _field(2, family.help.encode()),
+      # type, a varint
+      _varint(3 << 3) + _varint(self.TYPES.get(family.type, 3)),
+    ]
+    for labels, value in family.samples:
+      try:
+        value = float(value)
+      except ValueError:
+        continue
+      metric = [
+        _field(1, _field(1, str(k).encode()) + _field(2, str(v).encode()))
+        for k, v in labels.items()]
+      # The value is field 1, a double, of Counter/Gauge/Untyped
+      metric.append(_field(value_field, b'\x09' + struct.pack('<d', value)))
+      parts.append(_field(4, b''.join(metric)))
+    message = b''.join(parts)
+    return _varint(len(message)) + message
+
+  def chunks(self, families, chunk_size=CHUNK_SIZE):
+    chunk = []
+    size = 0
+    for family in families:
+      data = self.family(family)
+      chunk.append(data)
+      size += len(data)
+      if size >= chunk_size:
+        yield b''.join(chunk)
+        chunk = []
+        size = 0
+    if chunk:
+      yield b''.join(chunk)
+
+
+# In order of preference when the client does not have one
+ENCODERS = [ProtobufEncoder(), TextEncoder()]
+# OpenMetrics names counter samples with a _total suffix. Prometheus
+# prefers it, so offering it renames the series of existing setups, and it
+# has to be enabled explicitly.
+OPENMETRICS_ENCODERS = ENCODERS + [OpenMetricsEncoder()]
+
+
+def encoder_for(content_type):
+  """Returns the encoder of a content type picked by negotiate."""
+  for encoder in OPENMETRICS_ENCODERS:
+    if encoder.content_type == content_type:
+      return encoder
+  raise Error('No encoder for %s' % content_type)
+
+
+def _parse_media_range(part):
+  fields = [x.strip() for x in part.split(';')]
+  params = {}
+  for field in fields[1:]:
+    if '=' in field:
+      key, value = field.split('=', 1)
+      params[key.strip().lower()] = value.strip().strip('"')
+  try:
+    quality = float(params.pop('q', '1'))
+  except ValueError:
+    quality = 0.0
+  return fields[0].lower(), params, quality
+
+
+def _matches(encoder, media_type, params):
+  content_type, content_params, _ = _parse_media_range(encoder.content_type)
+  if media_type in ('*/*', content_type):
+    pass
+  elif media_type.endswith('/*') and (
+      content_type.startswith(media_type[:-1])):
+    pass
+  else:
+    return False
+  # The protobuf format is only usable if the client asks for it exactly
+  if content_type == 'application/vnd.google.protobuf':
+    return (media_type == content_type and
+            params.get('proto') == content_params['proto'] and
+            params.get('encoding') == content_params['encoding'])
+  return True
+
+
+def negotiate(accept, encoders=ENCODERS):
+  """Pick an encoder given an Accept header, falls back to text."""
+  best = None
+  best_quality = 0.0
+  ranges = [_parse_media_range(x) for x in (accept or '').split(',')
+            if x.strip()]
+  for encoder in encoders:
+    quality = max([q for media_type, params, q in ranges
+                   if _matches(encoder, media_type, params)] or [0.0])
+    if quality > best_quality:
+      best, best_quality = encoder, quality
+  if best is None:
+    return TextEncoder()
+  return best
@@ -0,0 +1,167 @@
+import unittest
+
+from snmpexporter import exposition
+
+
+FAMILIES = [
+  exposition.Family('ifInOctets', 'IF-MIB::ifInOctets', 'counter', [
+    ({'interface': 'Gi0/1', 'alias': 'say "hi"\\'}, '1000'),
+  ]),
+  exposition.Family('snmp_export_errors', 'Errors', 'gauge', [
+    ({}, 0), ({}, float('nan')),
+  ]),
+]
+
+
+class TestEncodeChunks(unittest.TestCase):
+
+  def testChunks(self):
+    lines = ['a' * 9] * 25
+    chunks = list(exposition.encode_chunks(lines, chunk_size=100))
+    self.assertEqual([len(x) for x in chunks], [100, 100, 50])
+    self.assertEqual(b''.join(chunks), b'aaaaaaaaa\n' * 25)
+
+  def testEmpty(self):
+    self.assertEqual(list(exposition.encode_chunks([])), [])
+
+
+class TestSharedChunks(unittest.TestCase):
+
+  def testInterleaved(self):
+    produced = []
+
+    def chunks():
+      for x in (b'a', b'b', b'c'):
+        produced.append(x)
+        yield x
+
+    shared = exposition.SharedChunks(chunks())
+    first = shared.reader()
+    second = shared.reader()
+    self.assertEqual(next(first), b'a')
+    self.assertEqual(next(first), b'b')
+    self.assertEqual(list(second), [b'a', b'b', b'c'])
+    self.assertEqual(list(first), [b'c'])
+    self.assertEqual(list(shared.reader()), [b'a', b'b', b'c'])
+    # Every chunk is only produced once
+    self.assertEqual(produced, [b'a', b'b', b'c'])
+
+  def testSealed(self):
+    shared = exposition.SharedChunks(iter([b'a', b'b', b'c']))
+    first = shared.reader()
+    second = shared.reader()
+    self.assertEqual(next(first), b'a')
+    shared.seal()
+    self.assertRaises(exposition.Error, shared.reader)
+    self.assertEqual(list(shared.buffer), [b'a'])
+    self.assertEqual(next(first), b'b')
+    self.assertEqual(next(second), b'a')
+    # Chunks are dropped once every reader had them
+    self.assertEqual(list(shared.buffer), [b'b'])
+    second.close()
+    self.assertEqual(list(shared.buffer), [])
+    self.assertEqual(list(first), [b'c'])
+    self.assertEqual(list(shared.buffer), [])
+    self.assertEqual(shared.offsets, {})
+
+  def testError(self):
+    def chunks():
+      yield b'a'
+      raise ValueError('broken')
+
+    shared = exposition.SharedChunks(chunks())
+    first = shared.reader()
+    self.assertEqual(next(first), b'a')
+    self.assertRaises(ValueError, next, first)
+    # Later readers must not see a truncated response as a complete one
+    second = shared.reader()
+    self.assertEqual(next(second), b'a')
+    self.assertRaises(ValueError, next, second)
+
+
+class TestEncoders(unittest.TestCase):
+
+  def testText(self):
+    self.assertEqual(list(exposition.TextEncoder().lines(FAMILIES)), [
+      '# HELP ifInOctets IF-MIB::ifInOctets',
+      '# TYPE ifInOctets counter',
+      'ifInOctets{interface="Gi0/1",alias="say \\"hi\\"\\\\"} 1000',
+      '# HELP snmp_export_errors Errors',
+      '# TYPE snmp_export_errors gauge',
+      'snmp_export_errors 0',
+      'snmp_export_errors nan',
+    ])
+
+  def testOpenMetrics(self):
+    self.assertEqual(list(exposition.OpenMetricsEncoder().lines(FAMILIES)), [
+      '# HELP ifInOctets IF-MIB::ifInOctets',
+      '# TYPE ifInOctets counter',
+      'ifInOctets_total{interface="Gi0/1",alias="say \\"hi\\"\\\\"} 1000',
+      '# HELP snmp_export_errors Errors',
+      '# TYPE snmp_export_errors gauge',
+      'snmp_export_errors 0',
+      'snmp_export_errors NaN',
+      '# EOF',
+    ])
+
+  def testProtobuf(self):
+    family = exposition.Family('up', 'h', 'gauge', [({'a': 'b'}, 1)])
+    self.assertEqual(
+        b''.join(exposition.ProtobufEncoder().chunks([family])),
+        bytes.fromhex(
+          '1e' '0a027570' '120168' '1801'
+          '2213' '0a060a0161120162' '120909000000000000f03f'))
+
+
+class TestNegotiate(unittest.TestCase):
+
+  def testNegotiate(self):
+    def negotiate(accept):
+      return type(exposition.negotiate(accept)).__name__
+
+    self.assertEqual(negotiate(None), 'TextEncoder')
+    self.assertEqual(negotiate('*/*'), 'TextEncoder')
+    self.assertEqual(negotiate('application/json'), 'TextEncoder')
+    self.assertEqual(negotiate(
+      'application/vnd.google.protobuf;'
+      'proto=io.prometheus.client.MetricFamily;encoding=delimited;q=0.7,'
+      'text/plain;version=0.0.4;q=0.3,*/*;q=0.1'), 'ProtobufEncoder')
+    # Text encoded protobuf is not supported
+    self.assertEqual(negotiate(
+      'application/vnd.google.protobuf;'
+      'proto=io.prometheus.client.MetricFamily;encoding=text'),
+      'TextEncoder')
+
+  def testOpenMetrics(self):
+    self.assertEqual(type(exposition.negotiate(
+      'application/openmetrics-text;version=1.0.0;q=0.5,'
+      'text/plain;version=0.0.4;q=0.4,*/*;q=0.1',
+      exposition.OPENMETRICS_ENCODERS)).__name__, 'OpenMetricsEncoder')
+
+  def testEncoderFor(self):
+    self.assertIsInstance(
+        exposition.encoder_for(exposition.TextEncoder.content_type),
+        exposition.TextEncoder)
+    with self.assertRaises(exposition.Error):
+      exposition.encoder_for('application/json')
+
+  def testPrometheusDefault(self):
+    # The Accept header of a Prometheus scrape
+    encoder = exposition.negotiate(
+      'application/openmetrics-text;version=1.0.0,'
+      'application/openmetrics-text;version=0.0.1;q=0.75,'
+      'text/plain;version=0.0.4;q=0.5,*/*;q=0.1')
+    self.assertEqual(type(encoder).__name__, 'TextEncoder')
+    # Series keep their names
+    names = [line.split('{')[0].split(' ')[0]
+             for line in encoder.lines(FAMILIES) if not line.startswith('#')]
+    self.assertEqual(
+        names, ['ifInOctets', 'snmp_export_errors', 'snmp_export_errors'])
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
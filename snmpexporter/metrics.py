@@ -0,0 +1,259 @@
+"""Metrics of the exporter itself.
+
+A minimal registry of counters, gauges and histograms, rendered in the
+Prometheus text format. Recording a value is a dict lookup and an addition
+under a lock, and rendering only walks the metrics themselves, so the
+metrics are cheap to scrape as often as wanted.
+"""
+import bisect
+import math
+import threading
+import time
+
+from snmpexporter import exposition
+
+
+# Latency buckets in seconds, from a fast annotation to a slow poll
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120)
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+def format_value(value):
+  if isinstance(value, float):
+    if math.isinf(value):
+      return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer():
+      return str(int(value))
+    return repr(value)
+  return str(value)
+
+
+class CounterValue(object):
+
+  def __init__(self, lock):
+    super(CounterValue, self).__init__()
+    self.lock = lock
+    self.value = 0
+
+  def inc(self, amount=1):
+    if amount < 0:
+      raise Error('Counters can only go up')
+    with self.lock:
+      self.value += amount
+
+  def samples(self):
+    return [('', {}, self.value)]
+
+
+class GaugeValue(object):
+
+  def __init__(self, lock):
+    super(GaugeValue, self).__init__()
+    self.lock = lock
+    self.value = 0
+    self.function = None
+
+  def set(self, value):
+    with self.lock:
+      self.value = value
+
+  def inc(self, amount=1):
+    with self.lock:
+      self.value += amount
+
+  def dec(self, amount=1):
+    self.inc(-amount)
+
+  def set_function(self, function):
+    """Read the value from function when rendering instead."""
+    self.function = function
+
+  def samples(self):
+    if self.function is not None:
+      return [('', {}, self.function())]
+    return [('', {}, self.value)]
+
+
+class HistogramValue(object):
+
+  def __init__(self, lock, buckets):
+    super(HistogramValue, self).__init__()
+    self.lock = lock
+    self.buckets = buckets
+    # Observations per bucket, the last one is +Inf
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+
+  def observe(self, value):
+    index = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      self.counts[index] += 1
+      self.sum += value
+
+  def samples(self):
+    with self.lock:
+      counts = list(self.counts)
+      total = self.sum
+    samples = []
+    cumulative = 0
+    for bound, count in zip(self.buckets + (float('inf'),), counts):
+      cumulative += count
+      samples.append(('_bucket', {'le': format_value(float(bound))},
+                      cumulative))
+    samples.append(('_sum', {}, total))
+    samples.append(('_count', {}, cumulative))
+    return samples
+
+
+class Metric(object):
+  """A metric family, with one value per combination of label values."""
+
+  type = None
+  # Class of the value of each combination of label values
+  value_class = None
+
+  def __init__(self, name, help, labels=()):
+    super(Metric, self).__init__()
+    self.name = name
+    self.help = help
+    self.label_names = tuple(labels)
+    self.lock = threading.Lock()
+    # label values -> value
+    self.values = {}
+    if not self.label_names:
+      self.values[()] = self._value()
+
+  def _value(self):
+    return self.value_class(self.lock)
+
+  def labels(self, *values):
+    if len(values) != len(self.label_names):
+      raise Error('%s has labels %s, got %r' % (
+          self.name, ', '.join(self.label_names), values))
+    values = tuple(str(x) for x in values)
+    value = self.values.get(values, None)
+    if value is None:
+      with self.lock:
+        value = self.values.setdefault(values, self._value())
+    return value
+
+  def remove(self, *values):
+    with self.lock:
+      self.values.pop(tuple(str(x) for x in values), None)
+
+  def lines(self):
+    yield '# HELP %s %s' % (self.name, exposition.escape_help(self.help))
+    yield '# TYPE %s %s' % (self.name, self.type)
+    with self.lock:
+      values = sorted(self.values.items())
+    for label_values, value in values:
+      labels = dict(zip(self.label_names, label_values))
+      for suffix, extra, sample in value.samples():
+        if extra:
+          labels_and_extra = dict(labels)
+          labels_and_extra.update(extra)
+        else:
+          labels_and_extra = labels
+        yield '%s%s%s %s' % (
+            self.name, suffix, exposition.format_labels(labels_and_extra),
+            format_value(sample))
+
+
+class Counter(Metric):
+
+  type = 'counter'
+  value_class = CounterValue
+
+  def inc(self, amount=1):
+    self.labels().inc(amount)
+
+
+class Gauge(Metric):
+
+  type = 'gauge'
+  value_class = GaugeValue
+
+  def set(self, value):
+    self.labels().set(value)
+
+  def inc(self, amount=1):
+    self.labels().inc(amount)
+
+  def dec(self, amount=1):
+    self.labels().dec(amount)
+
+  def set_function(self, function):
+    self.labels().set_function(function)
+
+
+class Histogram(Metric):
+
+  type = 'histogram'
+  value_class = HistogramValue
+
+  def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    self.buckets = tuple(sorted(buckets))
+    super(Histogram, self).__init__(name, help, labels)
+
+  def _value(self):
+    return self.value_class(self.lock, self.buckets)
+
+  def observe(self, value):
+    self.labels().observe(value)
+
+
+class Registry(object):
+  """Collects the metrics to render.
+
+  Anything with a function returning lines of the text format can be
+  registered, like MibCache.metrics.
+  """
+
+  def __init__(self):
+    super(Registry, self).__init__()
+    self.collectors = []
+
+  def register(self, collector):
+    self.collectors.append(collector)
+    return collector
+
+  def counter(self, name, help, labels=()):
+    return self._add(Counter(name, help, labels))
+
+  def gauge(self, name, help, labels=()):
+    return self._add(Gauge(name, help, labels))
+
+  def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return self._add(Histogram(name, help, labels, buckets))
+
+  def _add(self, metric):
+    self.register(metric.lines)
+    return metric
+
+  def lines(self):
+    for collector in self.collectors:
+      for line in collector():
+        yield line
+
+
+def timed(chunks, histogram):
+  """Yields chunks, observing the time spent producing them when done.
+
+  Only the time spent in the wrapped iterator counts, not the time the
+  consumer takes between chunks.
+  """
+  chunks = iter(chunks)
+  elapsed = 0.0
+  while True:
+    start = time.perf_counter()
+    try:
+      chunk = next(chunks)
+    except StopIteration:
+      histogram.observe(elapsed + time.perf_counter() - start)
+      return
+    elapsed += time.perf_counter() - start
+    yield chunk
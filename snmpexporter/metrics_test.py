@@ -0,0 +1,82 @@
+import unittest
+
+from snmpexporter import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+  def testCounter(self):
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'Test counter', ('layer',))
+    counter.labels('access').inc()
+    counter.labels('access').inc(2)
+    counter.labels('dist').inc(0.5)
+    with self.assertRaises(metrics.Error):
+      counter.labels('access').inc(-1)
+    with self.assertRaises(metrics.Error):
+      counter.labels('access', 'extra')
+    self.assertEqual(list(registry.lines()), [
+      '# HELP test_total Test counter',
+      '# TYPE test_total counter',
+      'test_total{layer="access"} 3',
+      'test_total{layer="dist"} 0.5',
+    ])
+
+  def testGauge(self):
+    registry = metrics.Registry()
+    gauge = registry.gauge('test_tasks', 'Test gauge')
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    self.assertEqual(list(registry.lines())[-1], 'test_tasks 1')
+    gauge.set_function(lambda: 42)
+    self.assertEqual(list(registry.lines())[-1], 'test_tasks 42')
+
+  def testHistogram(self):
+    registry = metrics.Registry()
+    histogram = registry.histogram(
+        'test_seconds', 'Test histogram', ('stage',), buckets=(0.1, 1))
+    histogram.labels('poll').observe(0.05)
+    histogram.labels('poll').observe(0.1)
+    histogram.labels('poll').observe(0.5)
+    histogram.labels('poll').observe(3)
+    self.assertEqual(list(registry.lines()), [
+      '# HELP test_seconds Test histogram',
+      '# TYPE test_seconds histogram',
+      'test_seconds_bucket{stage="poll",le="0.1"} 2',
+      'test_seconds_bucket{stage="poll",le="1"} 3',
+      'test_seconds_bucket{stage="poll",le="+Inf"} 4',
+      'test_seconds_sum{stage="poll"} 3.65',
+      'test_seconds_count{stage="poll"} 4',
+    ])
+
+  def testRegister(self):
+    registry = metrics.Registry()
+    registry.register(lambda: iter(['other_metric 1']))
+    registry.counter('test_total', 'Test counter').inc()
+    self.assertEqual(list(registry.lines()), [
+      'other_metric 1',
+      '# HELP test_total Test counter',
+      '# TYPE test_total counter',
+      'test_total 1',
+    ])
+
+  def testRemove(self):
+    counter = metrics.Counter('test_total', 'Test', ('target',))
+    counter.labels('a').inc()
+    counter.remove('a')
+    self.assertEqual(list(counter.lines())[2:], [])
+
+  def testTimed(self):
+    histogram = metrics.Histogram('test_seconds', 'Test', buckets=(1,))
+    self.assertEqual(list(metrics.timed(iter([b'a', b'b']), histogram)),
+                     [b'a', b'b'])
+    self.assertEqual(list(histogram.lines())[-1], 'test_seconds_count 1')
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,131 @@
+import collections
+import logging
+import threading
+
+
+def resolve_many(resolver, oids):
+  """Resolve a list of OIDs in one call if the resolver supports it."""
+  if hasattr(resolver, 'resolve_many'):
+    return resolver.resolve_many(oids)
+  return [resolver.resolve(oid) for oid in oids]
+
+
+class MibCache(object):
+  """Process-wide OID resolution cache in front of a MIB resolver.
+
+  Entries are keyed by the column prefix of the OID (the OID minus the index
+  the resolver reported) rather than the full instance OID, so a table column
+  costs one resolver call no matter how many rows it has.
+
+  A column prefix is only trusted for index arcs we have seen the resolver
+  agree with. This matters for OIDs that are not described by any loaded MIB:
+  they resolve to their closest known ancestor (e.g. enterprises.9.9.1234.1),
+  and blindly reusing that prefix would swallow known OIDs deeper down. If
+  the resolver put OID.X.Y under column OID, then nothing below OID.X is
+  known to the MIB tree and every OID.X.* will resolve the same way.
+  """
+
+  def __init__(self, resolver, max_size=10000):
+    super(MibCache, self).__init__()
+    self.resolver = resolver
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    # column prefix -> (label, enum, set of verified first index arcs)
+    self.columns = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def resolve(self, oid):
+    with self.lock:
+      resolved = self._lookup(oid)
+      if resolved is not None:
+        self.hits += 1
+        return resolved
+      self.misses += 1
+
+    resolved = self.resolver.resolve(oid)
+    if resolved is None:
+      return None
+
+    with self.lock:
+      self._insert(oid, *resolved)
+    return resolved
+
+  def resolve_many(self, oids):
+    resolved = [None] * len(oids)
+    missing = []
+    with self.lock:
+      for i, oid in enumerate(oids):
+        cached = self._lookup(oid)
+        if cached is None:
+          missing.append(i)
+        else:
+          resolved[i] = cached
+      self.hits += len(oids) - len(missing)
+      self.misses += len(missing)
+
+    if not missing:
+      return resolved
+
+    backend = resolve_many(self.resolver, [oids[i] for i in missing])
+    with self.lock:
+      for i, result in zip(missing, backend):
+        if result is None:
+          continue
+        self._insert(oids[i], *result)
+        resolved[i] = result
+    return resolved
+
+  def _lookup(self, oid):
+    pos = len(oid)
+    while pos > 0:
+      prefix = oid[:pos]
+      column = self.columns.get(prefix, None)
+      if column is not None:
+        label, enum, arcs = column
+        index = oid[pos+1:]
+        if index.split('.', 1)[0] not in arcs:
+          return None
+        self.columns.move_to_end(prefix)
+        return ('.'.join((label, index)) if index else label), enum
+      pos = oid.rfind('.', 0, pos)
+    return None
+
+  def _insert(self, oid, name, enum):
+    label, index = name.split('.', 1) if '.' in name else (name, '')
+    if index:
+      if not oid.endswith('.' + index):
+        logging.debug('Not caching %s, index of %s does not match', oid, name)
+        return
+      prefix = oid[:-(len(index) + 1)]
+    else:
+      prefix = oid
+
+    column = self.columns.get(prefix, None)
+    if column is None or column[0] != label:
+      column = (label, enum, set())
+      self.columns[prefix] = column
+    column[2].add(index.split('.', 1)[0])
+    self.columns.move_to_end(prefix)
+
+    while len(self.columns) > self.max_size:
+      self.columns.popitem(last=False)
+      self.evictions += 1
+
+  def metrics(self):
+    yield '# HELP snmp_export_resolver_cache_hits_total MIB resolver cache hits'
+    yield '# TYPE snmp_export_resolver_cache_hits_total counter'
+    yield 'snmp_export_resolver_cache_hits_total %s' % self.hits
+    yield ('# HELP snmp_export_resolver_cache_misses_total '
+           'MIB resolver cache misses')
+    yield '# TYPE snmp_export_resolver_cache_misses_total counter'
+    yield 'snmp_export_resolver_cache_misses_total %s' % self.misses
+    yield ('# HELP snmp_export_resolver_cache_evictions_total '
+           'MIB resolver cache evictions')
+    yield '# TYPE snmp_export_resolver_cache_evictions_total counter'
+    yield 'snmp_export_resolver_cache_evictions_total %s' % self.evictions
+    yield ('# HELP snmp_export_resolver_cache_columns '
+           'Number of OID columns in the MIB resolver cache')
+    yield '# TYPE snmp_export_resolver_cache_columns gauge'
+    yield 'snmp_export_resolver_cache_columns %s' % len(self.columns)
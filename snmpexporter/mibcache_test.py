@@ -0,0 +1,118 @@
+import unittest
+
+from snmpexporter import mibcache
+
+
+MIB_TREE = {
+    '.1.2': 'treeNode',
+    '.1.2.3': 'testInteger1',
+    '.1.2.4': 'testInteger2',
+    '.10.3': 'enumString',
+}
+
+ENUMS = {
+    '.10.3': {'10': 'enumValue'},
+}
+
+
+class CountingResolver(object):
+  """Resolves to the deepest known node, like net-snmp does."""
+
+  def __init__(self):
+    self.calls = []
+
+  def resolve(self, oid):
+    self.calls.append(oid)
+    best = None
+    for key in MIB_TREE:
+      if (oid == key or oid.startswith(key + '.')) and (
+          best is None or len(key) > len(best)):
+        best = key
+    if best is None:
+      return None
+    index = oid[len(best)+1:]
+    name = 'DUMMY-MIB::' + MIB_TREE[best]
+    return ('.'.join((name, index)) if index else name), ENUMS.get(best, {})
+
+
+class TestMibCache(unittest.TestCase):
+
+  def setUp(self):
+    self.resolver = CountingResolver()
+    self.cache = mibcache.MibCache(self.resolver, max_size=10)
+
+  def testSameOid(self):
+    self.assertEqual(self.cache.resolve('.1.2.3.1'),
+                     ('DUMMY-MIB::testInteger1.1', {}))
+    self.assertEqual(self.cache.resolve('.1.2.3.1'),
+                     ('DUMMY-MIB::testInteger1.1', {}))
+    self.assertEqual(self.resolver.calls, ['.1.2.3.1'])
+    self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+  def testMultiArcIndex(self):
+    self.cache.resolve('.1.2.3.1.5')
+    self.assertEqual(self.cache.resolve('.1.2.3.1.6.7'),
+                     ('DUMMY-MIB::testInteger1.1.6.7', {}))
+    self.assertEqual(self.resolver.calls, ['.1.2.3.1.5'])
+
+  def testNewFirstArcIsVerified(self):
+    self.cache.resolve('.1.2.3.1')
+    self.assertEqual(self.cache.resolve('.1.2.3.2'),
+                     ('DUMMY-MIB::testInteger1.2', {}))
+    self.assertEqual(self.resolver.calls, ['.1.2.3.1', '.1.2.3.2'])
+
+  def testAncestorDoesNotSwallowKnownChildren(self):
+    # .1.2.9 is unknown and resolves to the tree node itself
+    self.assertEqual(self.cache.resolve('.1.2.9.1'),
+                     ('DUMMY-MIB::treeNode.9.1', {}))
+    self.assertEqual(self.cache.resolve('.1.2.9.2'),
+                     ('DUMMY-MIB::treeNode.9.2', {}))
+    self.assertEqual(self.cache.resolve('.1.2.4.1'),
+                     ('DUMMY-MIB::testInteger2.1', {}))
+    self.assertEqual(self.resolver.calls, ['.1.2.9.1', '.1.2.4.1'])
+
+  def testEnumsAreShared(self):
+    _, enum = self.cache.resolve('.10.3.1')
+    _, cached_enum = self.cache.resolve('.10.3.1')
+    self.assertEqual(enum, {'10': 'enumValue'})
+    self.assertIs(enum, cached_enum)
+
+  def testUnresolvable(self):
+    self.assertIsNone(self.cache.resolve('.2.2.4.1'))
+    self.assertIsNone(self.cache.resolve('.2.2.4.1'))
+    self.assertEqual(len(self.cache.columns), 0)
+
+  def testEviction(self):
+    cache = mibcache.MibCache(self.resolver, max_size=1)
+    cache.resolve('.1.2.3.1')
+    cache.resolve('.1.2.4.1')
+    cache.resolve('.1.2.3.1')
+    self.assertEqual(cache.evictions, 2)
+    self.assertEqual(list(cache.columns.keys()), ['.1.2.3'])
+
+  def testResolveMany(self):
+    self.cache.resolve('.1.2.3.1')
+    self.assertEqual(
+        self.cache.resolve_many(['.1.2.3.1', '.2.2.4.1', '.1.2.4.1']),
+        [('DUMMY-MIB::testInteger1.1', {}), None,
+         ('DUMMY-MIB::testInteger2.1', {})])
+    self.assertEqual(self.resolver.calls, ['.1.2.3.1', '.2.2.4.1', '.1.2.4.1'])
+    self.assertEqual(self.cache.resolve_many(['.1.2.4.1']),
+                     [('DUMMY-MIB::testInteger2.1', {})])
+    self.assertEqual(len(self.resolver.calls), 3)
+
+  def testMetrics(self):
+    self.cache.resolve('.1.2.3.1')
+    self.cache.resolve('.1.2.3.1')
+    metrics = list(self.cache.metrics())
+    self.assertIn('snmp_export_resolver_cache_hits_total 1', metrics)
+    self.assertIn('snmp_export_resolver_cache_misses_total 1', metrics)
+    self.assertIn('snmp_export_resolver_cache_columns 1', metrics)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,25 +1,199 @@
 #!/usr/bin/env python2
+import asyncio
 import collections
+import concurrent.futures
+import copy
 import logging
 import re
+import threading
+import time
 
+from snmpexporter import cache
+from snmpexporter import config
+from snmpexporter import resultset
 from snmpexporter import snmp
 
 
+SYSUPTIME_OID = '.1.3.6.1.2.1.1.3.0'
+# sysUpTime is in TimeTicks, hundredths of a second, which wrap at 2^32
+TICKS_PER_SECOND = 100
+TICKS_WRAP = 2**32
+
+
+class VlanBackoff(object):
+  """Remembers VLAN contexts that time out so they can be skipped.
+
+  A VLAN that times out is skipped for BASE seconds, doubling for every
+  consecutive failure up to MAX. The state is keyed by target, so one switch
+  with a broken VLAN does not affect another. Pass a
+  multiprocessing.Manager().dict() as state to share it between poller
+  processes, otherwise every process finds out about a dead VLAN by itself.
+  """
+
+  BASE = 60
+  MAX = 3600
+
+  def __init__(self, state=None):
+    super(VlanBackoff, self).__init__()
+    self.lock = threading.Lock()
+    # (host, layer, vlan) -> (consecutive failures, skip until)
+    self.state = state if state is not None else {}
+
+  def skip(self, target, vlan):
+    with self.lock:
+      _, until = self.state.get((target.host, target.layer, vlan), (0, 0))
+    return time.time() < until
+
+  def failed(self, target, vlan):
+    key = (target.host, target.layer, vlan)
+    with self.lock:
+      failures, _ = self.state.get(key, (0, 0))
+      delay = min(self.BASE * 2 ** failures, self.MAX)
+      # Wall clock time as the state may be read by another process
+      self.state[key] = (failures + 1, time.time() + delay)
+    logging.debug('VLAN %s on %s timed out, skipping it for %d seconds',
+        vlan, target.host, delay)
+
+  def succeeded(self, target, vlan):
+    with self.lock:
+      self.state.pop((target.host, target.layer, vlan), None)
+
+
+class MaxRepetitions(object):
+  """Learns the GETBULK max-repetitions that work per host and subtree.
+
+  Walks lower max_size when a device times out (see NetsnmpImpl.walk), and
+  the size a walk ended up with is remembered for the next walk of the same
+  subtree. After every walk that did not have to lower it, the size grows by
+  INCREASE until it is back at the configured max_size. This is AIMD: a
+  timeout divides the size, successes add to it.
+
+  The learned sizes live in a TtlCache that can be shared between processes.
+  """
+
+  INCREASE = 4
+
+  def __init__(self, cache):
+    super(MaxRepetitions, self).__init__()
+    self.cache = cache
+
+  def get(self, target, oid):
+    learned = self.cache.get((target.full_host, oid))
+    if learned is None:
+      return target.max_size
+    return min(learned, target.max_size)
+
+  def update(self, target, oid, used, size):
+    """A walk started with max_size used and completed with size."""
+    learned = size if size < used else size + self.INCREASE
+    if learned >= target.max_size:
+      self.cache.invalidate((target.full_host, oid))
+    else:
+      self.cache.set((target.full_host, oid), learned)
+
+
+# Shared by all pollers in this process
+vlan_backoff = VlanBackoff()
+max_repetitions = MaxRepetitions(cache.TtlCache(24 * 3600))
+# Results of subtrees in collections with a cache-ttl, every entry is set
+# with the TTL of its collection
+subtree_cache = cache.TtlCache(0)
+
+
+class BlockingCalls(object):
+  """Runs the poll coroutines of Poller with a blocking SNMP implementation.
+
+  The SNMP calls return before the coroutines get to wait for anything, so
+  the coroutines run to completion without an event loop, see run_blocking.
+  Parallel walks run in threads.
+  """
+
+  def __init__(self, snmpimpl):
+    super(BlockingCalls, self).__init__()
+    self.snmpimpl = snmpimpl
+
+  async def call(self, method, target, *args):
+    return getattr(self.snmpimpl, method)(target, *args)
+
+  async def map(self, function, items, parallel):
+    """Returns [await function(item) for item in items]."""
+    if parallel > 1 and len(items) > 1:
+      with concurrent.futures.ThreadPoolExecutor(
+          max_workers=min(parallel, len(items))) as executor:
+        return list(executor.map(
+            lambda item: run_blocking(function(item)), items))
+    return [await function(item) for item in items]
+
+
+class AsyncCalls(object):
+  """Runs the poll coroutines of Poller on an event loop.
+
+  The SNMP implementation has coroutine versions of its methods, like
+  AsyncioImpl, and parallel walks are gathered on the loop.
+  """
+
+  def __init__(self, snmpimpl):
+    super(AsyncCalls, self).__init__()
+    self.snmpimpl = snmpimpl
+
+  async def call(self, method, target, *args):
+    return await getattr(self.snmpimpl, method + '_async')(target, *args)
+
+  async def map(self, function, items, parallel):
+    """Returns [await function(item) for item in items]."""
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def run(item):
+      async with semaphore:
+        return await function(item)
+
+    return list(await asyncio.gather(*[run(item) for item in items]))
+
+
+def run_blocking(coro):
+  """Runs a coroutine that never has to wait, returning its result."""
+  try:
+    coro.send(None)
+  except StopIteration as e:
+    return e.value
+  coro.close()
+  raise RuntimeError('Poll waited without an event loop')
+
+
 class Poller(object):
 
-  def __init__(self, collections, overrides, snmpimpl):
+  # How far off sysUpTime can be from what it was when last seen plus the
+  # time passed since, before the target is considered restarted. Seconds,
+  # and a fraction of the time passed for clock drift.
+  UPTIME_SLACK = 30
+  UPTIME_DRIFT = 0.001
+
+  def __init__(self, collections, overrides, snmpimpl, backoff=None,
+               plan_cache=None, repetitions=None, subtrees=None,
+               collections_hash=None):
     super(Poller, self).__init__()
-    self.model_oid_cache = {}
-    self.model_oid_cache_incarnation = 0
+    self.backoff = backoff if backoff is not None else vlan_backoff
+    self.repetitions = (
+        repetitions if repetitions is not None else max_repetitions)
+    self.subtrees = subtrees if subtrees is not None else subtree_cache
+    # Model and walk parameters per target, see walk_plan
+    self.plan_cache = plan_cache
     self.snmpimpl = snmpimpl
     self.collections = collections
     self.overrides = overrides
+    # Cached plans are only valid for the collections they were made from.
+    # Pass the hash of ConfigWatcher rather than hashing them every poll.
+    self.collections_hash = collections_hash
+    if plan_cache is not None and collections_hash is None:
+      self.collections_hash = config.collections_hash(collections)
 
   def assemble_walk_parameters(self, target, model):
     oids = set()
     vlan_aware_oids = set()
     options = dict()
+    # OID -> seconds its results can be reused. An OID in several
+    # collections uses the shortest TTL, no TTL meaning 0.
+    ttls = dict()
     for collection_name, collection in self.collections.items():
       for regexp in collection['models']:
         layers = collection.get('layers', None)
@@ -37,31 +211,129 @@ class Poller(object):
             vlan_aware_oids.update(set(collection['oids']))
           else:
             oids.update(set(collection['oids']))
-    return (list(oids), list(vlan_aware_oids), options)
+          ttl = collection.get('cache-ttl', 0)
+          for oid in collection['oids']:
+            ttls[oid] = min(ttls.get(oid, ttl), ttl)
+    ttls = {oid: ttl for oid, ttl in ttls.items() if ttl > 0}
+    return (list(oids), list(vlan_aware_oids), options, ttls)
+
+  def walk_plan(self, target):
+    """Returns (model, (global_oids, vlan_oids, options, ttls)).
+
+    The plan is cached in plan_cache if set. Detecting the model can take
+    several requests with long timeouts, so instead a cached plan is
+    checked with a single get of sysUpTime. If the device has rebooted it
+    might have been replaced or upgraded, and the model is detected again,
+    see restarted.
+    """
+    return run_blocking(
+        self._walk_plan(BlockingCalls(self.snmpimpl), target))
+
+  async def walk_plan_async(self, target):
+    return await self._walk_plan(AsyncCalls(self.snmpimpl), target)
+
+  async def _walk_plan(self, calls, target):
+    if self.plan_cache is None:
+      model = await self._model(calls, target)
+      return model, self.assemble_walk_parameters(target, model)
+
+    key = (target.full_host, target.layer, self.collections_hash)
+    uptime = await self._uptime(calls, target)
+    restarted = self.restarted(target, uptime, time.time())
+    cached = self.plan_cache.get(key)
+    if cached is not None:
+      if restarted:
+        logging.info('%s has been restarted, detecting model again',
+            target.host)
+        self.plan_cache.invalidate(key)
+      else:
+        logging.debug('Using cached walk plan for %s', target.host)
+        return cached
+
+    model = await self._model(calls, target)
+    plan = self.assemble_walk_parameters(target, model)
+    if model:
+      self.plan_cache.set(key, (model, plan))
+    return model, plan
+
+  def restarted(self, target, uptime, now):
+    """Returns whether target restarted since its uptime was last seen.
+
+    The uptime, and when it was seen, is remembered in plan_cache on every
+    poll. Unless the target restarted, its uptime now is the last one plus
+    the time passed since, modulo the wrap of TimeTicks after 497 days.
+    """
+    key = ('uptime', target.full_host)
+    last = self.plan_cache.get(key)
+    if uptime is None:
+      return False
+    self.plan_cache.set(key, (uptime, now))
+    if last is None:
+      return False
+    last_uptime, last_seen = last
+    passed = max(0, now - last_seen)
+    expected = (last_uptime + int(passed * TICKS_PER_SECOND)) % TICKS_WRAP
+    off = abs(uptime - expected)
+    off = min(off, TICKS_WRAP - off)
+    return off > (
+        self.UPTIME_SLACK + passed * self.UPTIME_DRIFT) * TICKS_PER_SECOND
+
+  async def _model(self, calls, target):
+    start = time.monotonic()
+    try:
+      return await calls.call('model', target)
+    finally:
+      target.add_span('model', time.monotonic() - start)
+
+  async def _uptime(self, calls, target):
+    start = time.monotonic()
+    try:
+      result = await calls.call('get', target, SYSUPTIME_OID)
+    finally:
+      target.add_span('uptime', time.monotonic() - start, SYSUPTIME_OID)
+    for value in result.values():
+      try:
+        return int(value.value)
+      except ValueError:
+        # Not supported, the cache TTL will have to do
+        return None
+    return None
 
   def process_overrides(self, results):
-    if not self.overrides:
-      return results
-    overridden_oids = set(self.overrides.keys())
-
-    overriden_results = results
-    for (oid, vlan), result in results.items():
-      root = '.'.join(oid.split('.')[:-1])
-      if root in overridden_oids:
-        overriden_results[(oid, vlan)] = snmp.ResultTuple(
-            result.value, self.overrides[root])
-    return overriden_results
+    if self.overrides:
+      results.override_types(self.overrides)
+    return results
 
   def poll(self, target):
-    results, errors, timeouts = self._walk(target)
-    results = results if results else {}
+    """Returns (results, timeouts, errors)."""
+    return run_blocking(self._poll_target(BlockingCalls(self.snmpimpl), target))
+
+  async def poll_async(self, target):
+    """Like poll, with an SNMP implementation that has *_async methods.
+
+    Walks of the target are gathered on the running event loop instead of
+    using threads, so any number of polls can run on the same loop.
+    """
+    return await self._poll_target(AsyncCalls(self.snmpimpl), target)
+
+  async def _poll_target(self, calls, target):
+    results, errors, timeouts = await self._walk(calls, target)
     logging.debug('Done SNMP poll (%d objects) for "%s"',
-        len(list(results.keys())), target.host)
+        len(results), target.host)
     return results, timeouts, errors
 
-  def _walk(self, target):
+  def _parallel(self, options, option):
+    """How many walks an option allows at the same time."""
+    parallel = max(1, int(options.get(option, 1)))
+    if parallel > 1 and not getattr(self.snmpimpl, 'concurrent_walks', True):
+      logging.debug('%s cannot walk in parallel, ignoring %s',
+          type(self.snmpimpl).__name__, option)
+      parallel = 1
+    return parallel
+
+  async def _walk(self, calls, target):
     try:
-      model = self.snmpimpl.model(target)
+      model, plan = await self._walk_plan(calls, target)
     except snmp.TimeoutError as e:
       logging.exception('Could not determine model of %s:', target.host)
       raise
@@ -73,63 +345,121 @@ class Poller(object):
       raise
 
     logging.debug('Object %s is model %s', target.host, model)
-    global_oids, vlan_oids, options = self.assemble_walk_parameters(
-        target, model)
+    global_oids, vlan_oids, options, ttls = plan
 
     # Apply walk options
     target.max_size = min(
         options.get('max-size', target.max_size), target.max_size)
     logging.debug('Using max_size %d for %s', target.max_size, target.host)
+    # Number of OID subtrees walked concurrently against the target
+    parallel_walks = self._parallel(options, 'max-parallel-walks')
+    # Number of VLAN contexts polled concurrently
+    parallel_vlans = self._parallel(options, 'max-parallel-vlans')
 
     timeouts = 0
     errors = 0
 
     # 'None' is global (no VLAN aware)
     vlans = set([None])
-    try:
-      if vlan_oids:
-        vlans.update(self.snmpimpl.vlans(target))
-    except snmp.Error as e:
-      errors += 1
-      logging.warning('Could not list VLANs: %s', str(e))
+    if vlan_oids:
+      start = time.monotonic()
+      try:
+        vlans.update(await calls.call('vlans', target))
+      except snmp.Error as e:
+        errors += 1
+        logging.warning('Could not list VLANs: %s', str(e))
+      target.add_span('vlans', time.monotonic() - start,
+                      varbinds=len(vlans) - 1)
 
     to_poll = []
     for vlan in list(vlans):
+      if vlan and self.backoff.skip(target, vlan):
+        logging.debug('Skipping VLAN %s on %s, it timed out recently',
+            vlan, target.host)
+        timeouts += 1
+        continue
       oids = vlan_oids if vlan else global_oids
-      to_poll.append((target, vlan, oids))
+      to_poll.append((target, vlan, oids, ttls, parallel_walks))
+
+    polled = await calls.map(
+        lambda data: self._poll(calls, data), to_poll, parallel_vlans)
 
-    results = {}
-    for part_results, part_errors, part_timeouts in map(self._poll, to_poll):
+    results = resultset.ResultSet()
+    for part_results, part_errors, part_timeouts in polled:
       results.update(self.process_overrides(part_results))
       errors += part_errors
       timeouts += part_timeouts
     return results, errors, timeouts
 
-  def _poll(self, data):
-    # TODO(bluecmd): Might want to have some sort of concurrency here
-    # as experience tells me this can be slow to do for all VLANs.
-    target, vlan, oids = data
+  async def _poll(self, calls, data):
+    target, vlan, oids, ttls, parallel_walks = data
+    oids = [oid for oid in oids if self._valid_oid(oid)]
+    walks = []
+    if vlan and oids:
+      # A VLAN context that does not answer will time out on every OID, so
+      # walk one OID first and give up on the VLAN if that times out.
+      walks.append(await self._walk_oid(
+          calls, target, oids[0], vlan, ttls.get(oids[0])))
+      oids = oids[1:]
+      if walks[0][2]:
+        self.backoff.failed(target, vlan)
+        oids = []
+      else:
+        self.backoff.succeeded(target, vlan)
+    walks.extend(await calls.map(
+        lambda oid: self._walk_oid(calls, target, oid, vlan, ttls.get(oid)),
+        oids, parallel_walks))
+
     errors = 0
     timeouts = 0
-    results = {}
-    for oid in oids:
-      logging.debug('Collecting %s on %s @ %s', oid, target.host, vlan)
-      if not oid.startswith('.1'):
-        logging.warning(
-            'OID %s does not start with .1, please verify configuration', oid)
-        continue
-      try:
-        results.update(
-            {(k, vlan): v for k, v in self.snmpimpl.walk(
-              target, oid, vlan).items()})
-      except snmp.TimeoutError as e:
-        timeouts += 1
-        if vlan:
-          logging.debug(
-              'Timeout, is switch configured for VLAN SNMP context? %s', e)
-        else:
-          logging.debug('Timeout, slow switch? %s', e)
-      except snmp.Error as e:
-        errors += 1
-        logging.warning('SNMP error for OID %s@%s: %s', oid, vlan, str(e))
+    results = resultset.ResultSet()
+    for oid_results, oid_errors, oid_timeouts in walks:
+      results.update(oid_results)
+      errors += oid_errors
+      timeouts += oid_timeouts
     return results, errors, timeouts
+
+  def _valid_oid(self, oid):
+    if not oid.startswith('.1'):
+      logging.warning(
+          'OID %s does not start with .1, please verify configuration', oid)
+      return False
+    return True
+
+  async def _walk_oid(self, calls, target, oid, vlan, ttl=None):
+    """Walk a subtree, reusing the results for ttl seconds if set."""
+    key = (target.full_host, target.layer, oid, vlan)
+    if ttl:
+      results = self.subtrees.get(key)
+      if results is not None:
+        logging.debug('Using cached %s on %s @ %s', oid, target.host, vlan)
+        return results, 0, 0
+    logging.debug('Collecting %s on %s @ %s', oid, target.host, vlan)
+    # The walk lowers max_size on timeouts, so give it its own target.
+    # Concurrent walks, and dead VLAN contexts, should not affect each other.
+    walk_target = copy.copy(target)
+    max_size = self.repetitions.get(target, oid)
+    walk_target.max_size = max_size
+    walk_target.requests = 0
+    start = time.monotonic()
+    try:
+      results = resultset.ResultSet.from_walk(
+          oid, vlan, await calls.call('walk', walk_target, oid, vlan))
+      self.repetitions.update(target, oid, max_size, walk_target.max_size)
+      target.max_repetitions[oid] = walk_target.max_size
+      if ttl:
+        self.subtrees.set(key, results, ttl)
+      walked = (results, 0, 0)
+    except snmp.TimeoutError as e:
+      if vlan:
+        logging.debug(
+            'Timeout, is switch configured for VLAN SNMP context? %s', e)
+      else:
+        logging.debug('Timeout, slow switch? %s', e)
+      walked = (resultset.ResultSet(), 0, 1)
+    except snmp.Error as e:
+      logging.warning('SNMP error for OID %s@%s: %s', oid, vlan, str(e))
+      walked = (resultset.ResultSet(), 1, 0)
+    target.add_span('walk', time.monotonic() - start, oid, vlan,
+                    len(walked[0]), walk_target.requests, walk_target.max_size)
+    return walked
@@ -0,0 +1,323 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from snmpexporter import cache
+from snmpexporter import poller
+from snmpexporter import snmp
+from snmpexporter import target
+
+
+COLLECTIONS = {
+  'Default': {
+    'models': ['.*'],
+    'oids': ['.1.1', '.1.2', '.1.3', '.1.4'],
+  },
+  'Vlan': {
+    'models': ['.*'],
+    'vlan_aware': True,
+    'oids': ['.1.5', '.1.6'],
+  },
+}
+
+
+class FakeSnmpImpl(object):
+
+  def __init__(self, delay=0.0, vlans=(), dead_vlans=()):
+    self.delay = delay
+    self.vlan_list = list(vlans)
+    self.dead_vlans = set(dead_vlans)
+    self.lock = threading.Lock()
+    self.active = 0
+    self.max_active = 0
+    self.walks = []
+    self.models = 0
+    self.uptime = 1000000
+    # Walks with a larger max_size time out, like a Nexus does
+    self.fragment_size = None
+    self.sizes = []
+
+  def model(self, target):
+    self.models += 1
+    return 'WS-C3560X-48P'
+
+  def get(self, target, oid):
+    return {oid: snmp.ResultTuple(str(self.uptime), 'TICKS')}
+
+  def vlans(self, target):
+    return self.vlan_list
+
+  def walk(self, target, oid, vlan=None):
+    with self.lock:
+      self.walks.append((oid, vlan))
+      self.sizes.append(target.max_size)
+      if self.fragment_size and target.max_size > self.fragment_size:
+        target.max_size = max(1, target.max_size // 16)
+      self.active += 1
+      self.max_active = max(self.max_active, self.active)
+    target.requests += 2
+    try:
+      time.sleep(self.delay)
+      if oid == '.1.3' or vlan in self.dead_vlans:
+        raise snmp.TimeoutError('Timeout')
+      if oid == '.1.4':
+        raise snmp.SnmpError('Error')
+      return {oid + '.1': snmp.ResultTuple('1', 'INTEGER')}
+    finally:
+      with self.lock:
+        self.active -= 1
+
+
+class FakeAsyncSnmpImpl(FakeSnmpImpl):
+  """FakeSnmpImpl with the coroutine methods of AsyncioImpl."""
+
+  def __init__(self, delay=0.0):
+    super(FakeAsyncSnmpImpl, self).__init__()
+    self.walk_delay = delay
+    self.waiting = 0
+    self.max_waiting = 0
+
+  async def model_async(self, target):
+    return self.model(target)
+
+  async def get_async(self, target, oid):
+    return self.get(target, oid)
+
+  async def vlans_async(self, target):
+    return self.vlans(target)
+
+  async def walk_async(self, target, oid, vlan=None):
+    self.waiting += 1
+    self.max_waiting = max(self.max_waiting, self.waiting)
+    try:
+      await asyncio.sleep(self.walk_delay)
+    finally:
+      self.waiting -= 1
+    return self.walk(target, oid, vlan)
+
+
+class TestPoller(unittest.TestCase):
+
+  def setUp(self):
+    self.target = target.SnmpTarget(
+        'dummy', 'test', {'test': {'version': 2, 'community': 'public'}})
+    self.repetitions = poller.MaxRepetitions(cache.TtlCache(60))
+
+  def collections(self, **options):
+    collections = {k: dict(v) for k, v in COLLECTIONS.items()}
+    collections['Default']['options'] = options
+    return collections
+
+  def poller(self, impl, plan_cache=None, **options):
+    return poller.Poller(
+        self.collections(**options), {}, impl, backoff=poller.VlanBackoff(),
+        plan_cache=plan_cache, repetitions=self.repetitions)
+
+  def testSequential(self):
+    impl = FakeSnmpImpl(delay=0.01)
+    results, timeouts, errors = self.poller(impl).poll(self.target)
+    self.assertEqual(impl.max_active, 1)
+    self.assertEqual(
+        sorted(results.keys()), [('.1.1.1', None), ('.1.2.1', None)])
+    self.assertEqual((timeouts, errors), (1, 1))
+
+  def testParallelWalks(self):
+    impl = FakeSnmpImpl(delay=0.05)
+    results, timeouts, errors = self.poller(
+        impl, **{'max-parallel-walks': 2}).poll(self.target)
+    self.assertEqual(impl.max_active, 2)
+    self.assertEqual(len(impl.walks), 4)
+    self.assertEqual(
+        sorted(results.keys()), [('.1.1.1', None), ('.1.2.1', None)])
+    self.assertEqual((timeouts, errors), (1, 1))
+
+  def testParallelWalksNotSupported(self):
+    impl = FakeSnmpImpl(delay=0.05)
+    impl.concurrent_walks = False
+    results, _, _ = self.poller(
+        impl, **{'max-parallel-walks': 2}).poll(self.target)
+    self.assertEqual(impl.max_active, 1)
+    self.assertEqual(len(results), 2)
+
+  def testParallelVlans(self):
+    impl = FakeSnmpImpl(delay=0.05, vlans=[10, 20, 30])
+    results, timeouts, errors = self.poller(
+        impl, **{'max-parallel-vlans': 4}).poll(self.target)
+    # Global OIDs and the first OID of every VLAN run at the same time
+    self.assertEqual(impl.max_active, 4)
+    self.assertEqual(len(results), 2 + 3 * 2)
+    self.assertIn(('.1.6.1', 30), results)
+
+  def testParallelVlansNotSupported(self):
+    impl = FakeSnmpImpl(delay=0.05, vlans=[10, 20, 30])
+    impl.concurrent_walks = False
+    results, _, _ = self.poller(
+        impl, **{'max-parallel-vlans': 4}).poll(self.target)
+    self.assertEqual(impl.max_active, 1)
+    self.assertEqual(len(results), 2 + 3 * 2)
+
+  def testSharedVlanBackoff(self):
+    # Like a Manager dict shared between poller processes
+    state = {}
+    impl = FakeSnmpImpl(vlans=[10, 20], dead_vlans=[20])
+    poller.Poller(self.collections(), {}, impl,
+                  backoff=poller.VlanBackoff(state),
+                  repetitions=self.repetitions).poll(self.target)
+    impl.walks = []
+    poller.Poller(self.collections(), {}, impl,
+                  backoff=poller.VlanBackoff(state),
+                  repetitions=self.repetitions).poll(self.target)
+    self.assertEqual([oid for oid, vlan in impl.walks if vlan == 20], [])
+
+  def testPollAsync(self):
+    impl = FakeAsyncSnmpImpl(delay=0.05)
+    p = self.poller(impl, **{'max-parallel-walks': 2})
+
+    async def poll_all():
+      return await asyncio.gather(
+          *[p.poll_async(self.makeTarget()) for _ in range(3)])
+
+    polled = asyncio.run(poll_all())
+    # Two walks at a time per target, and all targets at the same time
+    self.assertEqual(impl.max_waiting, 6)
+    for results, timeouts, errors in polled:
+      self.assertEqual(
+          sorted(results.keys()), [('.1.1.1', None), ('.1.2.1', None)])
+      self.assertEqual((timeouts, errors), (1, 1))
+
+  def testDeadVlanBackoff(self):
+    impl = FakeSnmpImpl(vlans=[10, 20], dead_vlans=[20])
+    p = self.poller(impl)
+    results, timeouts, errors = p.poll(self.target)
+    # Only the first OID is tried in a VLAN that times out
+    self.assertEqual(len([oid for oid, vlan in impl.walks if vlan == 20]), 1)
+    self.assertEqual((timeouts, errors), (2, 1))
+    self.assertIn(('.1.6.1', 10), results)
+
+    # Next poll skips the VLAN altogether, but still counts the timeout
+    impl.walks = []
+    results, timeouts, errors = p.poll(self.target)
+    self.assertEqual([oid for oid, vlan in impl.walks if vlan == 20], [])
+    self.assertEqual((timeouts, errors), (2, 1))
+
+    # Once the backoff has passed it is tried again
+    key = (self.target.host, self.target.layer, 20)
+    p.backoff.state[key] = (1, 0)
+    impl.dead_vlans = set()
+    results, timeouts, errors = p.poll(self.target)
+    self.assertIn(('.1.6.1', 20), results)
+    self.assertNotIn(key, p.backoff.state)
+
+  def testPlanCache(self):
+    impl = FakeSnmpImpl()
+    plan_cache = cache.TtlCache(60)
+    model, plan = self.poller(impl, plan_cache).walk_plan(self.target)
+    self.assertEqual(model, 'WS-C3560X-48P')
+    self.assertEqual(sorted(plan[0]), ['.1.1', '.1.2', '.1.3', '.1.4'])
+    self.assertEqual(
+        self.poller(impl, plan_cache).walk_plan(self.target), (model, plan))
+    self.assertEqual(impl.models, 1)
+
+    # A configuration change gives a new plan
+    _, new_plan = self.poller(
+        impl, plan_cache, **{'max-size': 1}).walk_plan(self.target)
+    self.assertEqual(new_plan[2], {'max-size': 1})
+    self.assertEqual(impl.models, 2)
+
+    # So does a restart of the device
+    impl.uptime = 10
+    self.poller(impl, plan_cache).walk_plan(self.target)
+    self.assertEqual(impl.models, 3)
+    impl.uptime = 20
+    self.poller(impl, plan_cache).walk_plan(self.target)
+    self.assertEqual(impl.models, 3)
+
+  def testRestarted(self):
+    p = self.poller(FakeSnmpImpl(), cache.TtlCache(60))
+    # Seen at 10 seconds of uptime
+    self.assertFalse(p.restarted(self.target, 1000, 0))
+    # An hour later, up for an hour more
+    self.assertFalse(p.restarted(self.target, 361000, 3600))
+    # And another hour later it has been up for 20 minutes, more than the
+    # uptime first seen but less than the one expected
+    self.assertTrue(p.restarted(self.target, 120000, 7200))
+    # A minute before TimeTicks wrap, and a minute after
+    p = self.poller(FakeSnmpImpl(), cache.TtlCache(60))
+    self.assertFalse(p.restarted(self.target, 2**32 - 6000, 10000))
+    self.assertFalse(p.restarted(self.target, 6000, 10120))
+    # No uptime is not a restart
+    self.assertFalse(p.restarted(self.target, None, 10200))
+
+  def testMaxRepetitions(self):
+    impl = FakeSnmpImpl()
+    impl.fragment_size = 20
+    collections = {'Default': {'models': ['.*'], 'oids': ['.1.1']}}
+    p = poller.Poller(collections, {}, impl, repetitions=self.repetitions)
+    started = []
+    completed = []
+    for _ in range(4):
+      target = self.makeTarget()
+      impl.sizes = []
+      p.poll(target)
+      started.append(impl.sizes[0])
+      completed.append(target.max_repetitions['.1.1'])
+      self.assertEqual(target.max_size, 256)
+    # Learns 16 the hard way, then grows until it times out again
+    self.assertEqual(started, [256, 16, 20, 24])
+    self.assertEqual(completed, [16, 16, 20, 1])
+
+  def testSubtreeCache(self):
+    impl = FakeSnmpImpl()
+    collections = {
+      'Default': {'models': ['.*'], 'oids': ['.1.1', '.1.2']},
+      'Inventory': {
+        'models': ['.*'], 'cache-ttl': 60, 'oids': ['.1.2', '.1.7']},
+    }
+    subtrees = cache.TtlCache(0)
+    p = poller.Poller(collections, {}, impl, repetitions=self.repetitions,
+        subtrees=subtrees)
+    self.assertEqual(p.walk_plan(self.target)[1][3], {'.1.7': 60})
+    for _ in range(2):
+      results, _, _ = p.poll(self.makeTarget())
+      self.assertIn(('.1.7.1', None), results)
+    # .1.2 is also in a collection without a TTL, so it is always walked
+    self.assertEqual(sorted(oid for oid, _ in impl.walks),
+        ['.1.1', '.1.1', '.1.2', '.1.2', '.1.7'])
+
+    # Walked again once expired
+    key = ('dummy:161', 'test', '.1.7', None)
+    subtrees.store[key] = (0, subtrees.store[key][1])
+    impl.walks = []
+    p.poll(self.makeTarget())
+    self.assertIn(('.1.7', None), impl.walks)
+
+  def testSpans(self):
+    impl = FakeSnmpImpl(vlans=[10])
+    self.poller(impl).poll(self.target)
+    spans = {(x.step, x.oid, x.vlan): x for x in self.target.spans}
+    self.assertEqual(sorted(spans, key=str), sorted([
+      ('model', None, None), ('vlans', None, None),
+      ('walk', '.1.1', None), ('walk', '.1.2', None),
+      ('walk', '.1.3', None), ('walk', '.1.4', None),
+      ('walk', '.1.5', 10), ('walk', '.1.6', 10),
+    ], key=str))
+    self.assertEqual(spans[('vlans', None, None)].varbinds, 1)
+    walk = spans[('walk', '.1.1', None)]
+    self.assertEqual((walk.varbinds, walk.requests, walk.max_repetitions),
+                     (1, 2, 256))
+    # Failed walks are timed too
+    self.assertEqual(spans[('walk', '.1.3', None)].varbinds, 0)
+    self.assertEqual(self.target.requests, 0)
+
+  def makeTarget(self):
+    return target.SnmpTarget(
+        'dummy', 'test', {'test': {'version': 2, 'community': 'public'}})
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -2,10 +2,13 @@ import collections
 import datetime
 import logging
 
+from snmpexporter import exposition
+
 
 Metric = collections.namedtuple(
   'Metrics', ('name', 'type', 'labels', 'value'))
 
+
 class Exporter(object):
 
   NUMERIC_TYPES = set([
@@ -18,32 +21,77 @@ class Exporter(object):
     self.convert = config.get('convert', {})
     if set(self.convert.values()) - set(CONVERTERS.keys()):
       raise Exception('At least one export converter was not found')
+    # Export the time spent on every model lookup and subtree walk
+    self.walk_timings = config.get('walk-timings', False)
 
   def export(self, target, results):
+    """Returns the results as lines in the Prometheus text format."""
+    return exposition.TextEncoder().lines(self.families(target, results))
+
+  def families(self, target, results):
+    """Returns the results as exposition.Family for any encoder."""
     grouped_metrics = collections.defaultdict(dict)
     cmetrics = 0
     for result in results.values():
       grouped_metrics[(result.mib, result.obj)][result.index] = (
           self._export(target, result))
     for (mib, obj), metrics in grouped_metrics.items():
-      for x in self.format_metrics(mib, obj, metrics):
-        yield x
-        cmetrics += 1
+      family = self.family(mib, obj, metrics)
+      if family is None:
+        continue
+      yield family
+      # Counted as lines of text format, HELP and TYPE included
+      cmetrics += 2 + len(family.samples)
 
     # Export statistics
-    yield '# HELP snmp_export_latency Latency breakdown for SNMP poll'
-    yield '# TYPE snmp_export_latency gauge'
-    for (step, latency) in target.timeline():
-      yield 'snmp_export_latency{step="%s"} %s' % (step, latency)
-    yield '# HELP snmp_export_errors Errors for SNMP poll'
-    yield '# TYPE snmp_export_errors gauge'
-    yield 'snmp_export_errors %s' % target.errors
-    yield '# HELP snmp_export_timeouts Timeouts for SNMP poll'
-    yield '# TYPE snmp_export_timeouts gauge'
-    yield 'snmp_export_timeouts %s' % target.timeouts
-    yield '# HELP snmp_exported_metrics_count Number of exported SNMP metrics'
-    yield '# TYPE snmp_exported_metrics_count gauge'
-    yield 'snmp_exported_metrics_count %s' % cmetrics
+    yield exposition.Family(
+        'snmp_export_latency', 'Latency breakdown for SNMP poll', 'gauge',
+        [({'step': step}, latency) for step, latency in target.timeline()])
+    yield exposition.Family(
+        'snmp_export_errors', 'Errors for SNMP poll', 'gauge',
+        [({}, target.errors)])
+    yield exposition.Family(
+        'snmp_export_timeouts', 'Timeouts for SNMP poll', 'gauge',
+        [({}, target.timeouts)])
+    yield exposition.Family(
+        'snmp_export_max_repetitions',
+        'GETBULK max-repetitions used to walk a subtree', 'gauge',
+        [({'oid': oid}, size)
+         for oid, size in sorted(target.max_repetitions.items())])
+    if self.walk_timings:
+      for family in self.span_families(target):
+        yield family
+    yield exposition.Family(
+        'snmp_exported_metrics_count', 'Number of exported SNMP metrics',
+        'gauge', [({}, cmetrics)])
+
+  def span_families(self, target):
+    """Families of the time spent per request, see SnmpTarget.spans."""
+    seconds = {}
+    walks = {}
+    for span in target.spans:
+      labels = (('step', span.step), ('oid', span.oid), ('vlan', span.vlan))
+      seconds[labels] = seconds.get(labels, 0) + span.seconds
+      if span.step == 'walk':
+        walks[labels[1:]] = span
+    yield exposition.Family(
+        'snmp_export_span_seconds',
+        'Time spent on a request of the SNMP poll', 'gauge',
+        [(_labels(labels), value) for labels, value in seconds.items()])
+    yield exposition.Family(
+        'snmp_export_walk_varbinds', 'Values returned by a subtree walk',
+        'gauge', [(_labels(labels), span.varbinds)
+                  for labels, span in walks.items()])
+    yield exposition.Family(
+        'snmp_export_walk_requests', 'SNMP requests sent to walk a subtree',
+        'gauge', [(_labels(labels), span.requests)
+                  for labels, span in walks.items()])
+    yield exposition.Family(
+        'snmp_export_walk_max_repetitions',
+        'GETBULK max-repetitions a subtree walk ended with', 'gauge',
+        [(_labels(labels), span.max_repetitions)
+         for labels, span in walks.items()
+         if span.max_repetitions is not None])
 
   def _export(self, target, result):
     if result.data.type == 'COUNTER64' or result.data.type == 'COUNTER':
@@ -67,9 +115,14 @@ class Exporter(object):
     return True
 
   def format_metrics(self, mib, obj, metrics):
+    family = self.family(mib, obj, metrics)
+    if family is None:
+      return []
+    return exposition.TextEncoder().lines([family])
+
+  def family(self, mib, obj, metrics):
     if not metrics:
-      return
-    out = []
+      return None
     converter = None
     if obj in self.config['convert']:
       converter = CONVERTERS[self.config['convert'][obj]]
@@ -85,23 +138,23 @@ class Exporter(object):
         metrics_type = 'gauge'
         converter = lambda x: float(x)
     if metrics_type != 'counter' and metrics_type != 'gauge':
-      return []
-    out.append('# HELP {0} {1}::{0}'.format(obj, mib))
-    out.append('# TYPE {0} {1}'.format(obj, metrics_type))
+      return None
+    samples = []
     for i in sorted(metrics.keys()):
       metric = metrics[i]
       if metric.type != metrics_type and converter is None:
         # This happens if we have a collision somewhere ('local' is common)
         # Just ignore this for now.
         continue
-
-      label_list = ['{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
-                    for k, v in metric.labels.items()]
-      label_string = ','.join(label_list)
-      instance = ''.join([obj, '{', label_string, '}'])
       value = converter(metric.value) if converter is not None else metric.value
-      out.append('{0} {1}'.format(instance, value))
-    return out
+      samples.append((metric.labels, value))
+    return exposition.Family(
+        obj, '{0}::{1}'.format(mib, obj), metrics_type, samples)
+
+
+def _labels(pairs):
+  """Labels of the pairs that have a value."""
+  return {name: value for name, value in pairs if value is not None}
 
 
 def bytes_to_datetime(b):
@@ -1,4 +1,5 @@
 import prometheus
+import target
 import unittest
 
 
@@ -8,6 +9,66 @@ class TestBytesToDatetime(unittest.TestCase):
     self.assertEqual(prometheus.bytes_to_datetime(time_data), 1543501031.0)
 
 
+class TestFormatMetrics(unittest.TestCase):
+  def testFormat(self):
+    exporter = prometheus.Exporter({'convert': {}})
+    metrics = {
+      '2': prometheus.Metric('ifInOctets', 'counter', {'index': '2'}, '20'),
+      '1': prometheus.Metric('ifInOctets', 'counter', {'index': '1'}, '10'),
+    }
+    self.assertEqual(list(exporter.format_metrics(
+      'IF-MIB', 'ifInOctets', metrics)), [
+        '# HELP ifInOctets IF-MIB::ifInOctets',
+        '# TYPE ifInOctets counter',
+        'ifInOctets{index="1"} 10',
+        'ifInOctets{index="2"} 20',
+      ])
+
+  def testBlob(self):
+    exporter = prometheus.Exporter({'convert': {}})
+    metrics = {
+      '1': prometheus.Metric('ifDescr', 'blob', {'index': '1'}, 'Gi0/1'),
+    }
+    self.assertEqual(list(exporter.format_metrics(
+      'IF-MIB', 'ifDescr', metrics)), [])
+
+
+class TestWalkTimings(unittest.TestCase):
+
+  def families(self, config):
+    snmp_target = target.SnmpTarget(
+        'dummy', 'test', {'test': {'version': 2, 'community': 'public'}})
+    snmp_target.add_span('model', 0.5)
+    snmp_target.add_span('walk', 1.5, '.1.1', None, 10, 2, 256)
+    snmp_target.add_span('walk', 0.25, '.1.2', 10, 1, 1, 16)
+    exporter = prometheus.Exporter(config)
+    return {x.name: x.samples for x in exporter.families(snmp_target, {})}
+
+  def testDisabled(self):
+    self.assertNotIn(
+        'snmp_export_span_seconds', self.families({'convert': {}}))
+
+  def testEnabled(self):
+    families = self.families({'convert': {}, 'walk-timings': True})
+    self.assertEqual(families['snmp_export_span_seconds'], [
+      ({'step': 'model'}, 0.5),
+      ({'step': 'walk', 'oid': '.1.1'}, 1.5),
+      ({'step': 'walk', 'oid': '.1.2', 'vlan': 10}, 0.25),
+    ])
+    self.assertEqual(families['snmp_export_walk_varbinds'], [
+      ({'oid': '.1.1'}, 10),
+      ({'oid': '.1.2', 'vlan': 10}, 1),
+    ])
+    self.assertEqual(families['snmp_export_walk_requests'], [
+      ({'oid': '.1.1'}, 2),
+      ({'oid': '.1.2', 'vlan': 10}, 1),
+    ])
+    self.assertEqual(families['snmp_export_walk_max_repetitions'], [
+      ({'oid': '.1.1'}, 256),
+      ({'oid': '.1.2', 'vlan': 10}, 16),
+    ])
+
+
 def main():
   unittest.main()
 
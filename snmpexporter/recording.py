@@ -0,0 +1,191 @@
+"""Recording of the SNMP requests of a poll, to replay them later.
+
+RecordingImpl wraps a SNMP implementation and remembers every model(),
+vlans(), get() and walk() with its result and how long it took. The
+recording is saved as a gzipped pickle, with walk results stored as
+ResultSets to keep production-sized captures small.
+
+ReplayImpl answers the same requests from a recording, for any target,
+taking the recorded time divided by speed. A speed of 0 answers at once,
+which is what profiling the annotator and exporter wants.
+
+Recordings are pickles, only load ones you made yourself.
+"""
+import collections
+import gzip
+import pickle
+import threading
+import time
+
+from snmpexporter import resultset
+from snmpexporter import snmp
+from snmpexporter import snmpimpl
+
+
+# Bumped when the file layout changes
+FORMAT_VERSION = 1
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class InvalidRecording(Error):
+  """The file is not a recording this version can replay."""
+
+
+class Call(object):
+  """A recorded request, result is an exception if it failed."""
+
+  def __init__(self, method, args, seconds, result, max_size=None,
+               requests=None):
+    super(Call, self).__init__()
+    self.method = method
+    self.args = args
+    self.seconds = seconds
+    self.result = result
+    # The GETBULK size the walk ended up with
+    self.max_size = max_size
+    # SNMP requests it took
+    self.requests = requests
+
+
+class Recording(object):
+
+  def __init__(self, host=None, layer=None):
+    super(Recording, self).__init__()
+    self.host = host
+    self.layer = layer
+    self.recorded = time.time()
+    self.calls = []
+    # Steps of the target timeline as (step, seconds)
+    self.timeline = []
+
+  def save(self, filename):
+    with gzip.open(filename, 'wb') as f:
+      pickle.dump((FORMAT_VERSION, self), f, pickle.HIGHEST_PROTOCOL)
+
+  @classmethod
+  def load(cls, filename):
+    try:
+      with gzip.open(filename, 'rb') as f:
+        version, recording = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError) as e:
+      raise InvalidRecording('Could not read %s: %s' % (filename, e))
+    if version != FORMAT_VERSION:
+      raise InvalidRecording('%s has format %s, expected %s' % (
+          filename, version, FORMAT_VERSION))
+    return recording
+
+
+class RecordingImpl(snmpimpl.SnmpImpl):
+  """Records the requests made through another SNMP implementation."""
+
+  def __init__(self, impl, recording):
+    super(RecordingImpl, self).__init__()
+    self.impl = impl
+    self.recording = recording
+    self.lock = threading.Lock()
+
+  def _call(self, method, target, *args):
+    start = time.monotonic()
+    requests = target.requests
+    try:
+      result = getattr(self.impl, method)(target, *args)
+    except snmp.Error as e:
+      self._add(Call(method, args, time.monotonic() - start, e,
+                     target.max_size, target.requests - requests))
+      raise
+    stored = result
+    if method == 'walk':
+      stored = resultset.ResultSet.from_walk(args[0], args[1], result)
+    self._add(Call(method, args, time.monotonic() - start, stored,
+                   target.max_size, target.requests - requests))
+    return result
+
+  @property
+  def concurrent_walks(self):
+    return getattr(self.impl, 'concurrent_walks', True)
+
+  def _add(self, call):
+    with self.lock:
+      self.recording.calls.append(call)
+
+  def model(self, target):
+    return self._call('model', target)
+
+  def vlans(self, target):
+    return self._call('vlans', target)
+
+  def get(self, target, oid):
+    return self._call('get', target, oid)
+
+  def walk(self, target, oid, vlan=None):
+    return self._call('walk', target, oid, vlan)
+
+
+class ReplayImpl(snmpimpl.SnmpImpl):
+  """Answers requests from a recording, whatever the target is.
+
+  A request made more than once during recording is answered in the same
+  order, the last answer is repeated after that. Gets and walks that were
+  never recorded are answered like an agent without the OIDs would, for
+  instance the sysUpTime get of the walk plan cache.
+
+  Answers are counted for the max_targets targets replayed most recently,
+  a target seen again after that starts over from the first answers.
+  """
+
+  max_targets = 1000
+
+  def __init__(self, recording, speed=1.0):
+    super(ReplayImpl, self).__init__()
+    self.speed = speed
+    self.lock = threading.Lock()
+    # (method, args) -> [calls]
+    self.calls = {}
+    for call in recording.calls:
+      self.calls.setdefault((call.method, call.args), []).append(call)
+    # target -> (method, args) -> answers given, least recently used first
+    self.answered = collections.OrderedDict()
+
+  def _call(self, method, target, *args):
+    calls = self.calls.get((method, args), None)
+    if not calls:
+      if method == 'get':
+        return {args[0]: snmp.ResultTuple('', 'NOSUCHOBJECT')}
+      if method == 'walk':
+        return {}
+      raise snmp.SnmpError('%s is not in the recording' % method)
+    with self.lock:
+      answered = self.answered.pop(target.full_host, {})
+      self.answered[target.full_host] = answered
+      while len(self.answered) > self.max_targets:
+        self.answered.popitem(last=False)
+      index = answered.get((method, args), 0)
+      answered[(method, args)] = index + 1
+    call = calls[min(index, len(calls) - 1)]
+    if self.speed:
+      time.sleep(call.seconds / self.speed)
+    if call.max_size is not None:
+      target.max_size = call.max_size
+    # Not in recordings made before requests were counted
+    target.requests += getattr(call, 'requests', None) or 0
+    if isinstance(call.result, Exception):
+      # A new one, the recorded one can be raised in several threads
+      raise type(call.result)(*call.result.args)
+    if method == 'walk':
+      return {oid: result for (oid, _), result in call.result.items()}
+    return call.result
+
+  def model(self, target):
+    return self._call('model', target)
+
+  def vlans(self, target):
+    return self._call('vlans', target)
+
+  def get(self, target, oid):
+    return self._call('get', target, oid)
+
+  def walk(self, target, oid, vlan=None):
+    return self._call('walk', target, oid, vlan)
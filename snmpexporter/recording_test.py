@@ -0,0 +1,123 @@
+import os
+import tempfile
+import time
+import unittest
+
+from snmpexporter import recording
+from snmpexporter import snmp
+from snmpexporter import target
+
+
+WALK = {
+  '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+  '.1.3.6.1.2.1.2.2.1.2.2': snmp.ResultTuple(b'\xff\xfe', 'OCTETSTR'),
+  '.1.3.6.1.2.1.2.2.1.10.1': snmp.ResultTuple('1000', 'COUNTER'),
+}
+
+
+class FakeImpl(object):
+
+  def __init__(self):
+    self.walks = 0
+
+  def model(self, target):
+    return 'WS-C2960'
+
+  def vlans(self, target):
+    return {1, 10}
+
+  def get(self, target, oid):
+    return {oid: snmp.ResultTuple('', 'NOSUCHOBJECT')}
+
+  def walk(self, target, oid, vlan=None):
+    self.walks += 1
+    if vlan == '20':
+      raise snmp.TimeoutError('Timeout getting %s' % oid)
+    # The first walk has to fall back to a smaller size
+    target.max_size = 16
+    time.sleep(0.05)
+    return WALK
+
+
+def make_target(host='1.2.3.4'):
+  return target.SnmpTarget(host, 'access', {
+    'access': {'version': 2, 'community': 'public'}})
+
+
+class TestRecording(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.filename = os.path.join(self.directory.name, 'walk.rec')
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def record(self):
+    rec = recording.Recording('1.2.3.4', 'access')
+    impl = recording.RecordingImpl(FakeImpl(), rec)
+    target = make_target()
+    self.assertEqual(impl.model(target), 'WS-C2960')
+    self.assertEqual(impl.vlans(target), {1, 10})
+    self.assertEqual(impl.walk(target, '.1.3.6.1.2.1.2.2.1', None), WALK)
+    with self.assertRaises(snmp.TimeoutError):
+      impl.walk(target, '.1.3.6.1.2.1.17.1.4.1.2', '20')
+    rec.timeline = [('poll', 0.1)]
+    rec.save(self.filename)
+    return recording.Recording.load(self.filename)
+
+  def testReplay(self):
+    rec = self.record()
+    self.assertEqual((rec.host, rec.layer), ('1.2.3.4', 'access'))
+    self.assertEqual(rec.timeline, [('poll', 0.1)])
+    self.assertEqual(len(rec.calls), 4)
+    impl = recording.ReplayImpl(rec, speed=0)
+    # Any target is answered from the recording
+    target = make_target('5.6.7.8')
+    self.assertEqual(impl.model(target), 'WS-C2960')
+    self.assertEqual(impl.vlans(target), {1, 10})
+    self.assertEqual(impl.walk(target, '.1.3.6.1.2.1.2.2.1', None), WALK)
+    self.assertEqual(target.max_size, 16)
+    with self.assertRaises(snmp.TimeoutError):
+      impl.walk(target, '.1.3.6.1.2.1.17.1.4.1.2', '20')
+    # Like an agent that does not have the OIDs
+    self.assertEqual(impl.get(target, '.1.3.6.1.2.1.1.3.0'), {
+        '.1.3.6.1.2.1.1.3.0': snmp.ResultTuple('', 'NOSUCHOBJECT')})
+    self.assertEqual(impl.walk(target, '.1.3.6.1.2.1.31', None), {})
+    # Requests can be replayed any number of times
+    self.assertEqual(impl.walk(target, '.1.3.6.1.2.1.2.2.1', None), WALK)
+
+  def testReplaySpeed(self):
+    rec = self.record()
+    impl = recording.ReplayImpl(rec, speed=1.0)
+    start = time.monotonic()
+    impl.walk(make_target(), '.1.3.6.1.2.1.2.2.1', None)
+    self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+  def testAnsweredBounded(self):
+    impl = recording.ReplayImpl(self.record(), speed=0)
+    impl.max_targets = 2
+    for host in ('1.1.1.1', '2.2.2.2', '1.1.1.1', '3.3.3.3'):
+      impl.model(make_target(host))
+    # Only the targets replayed most recently are kept
+    self.assertEqual(list(impl.answered), ['1.1.1.1:161', '3.3.3.3:161'])
+    self.assertEqual(impl.answered['1.1.1.1:161'], {('model', ()): 2})
+
+  def testNotRecorded(self):
+    impl = recording.ReplayImpl(recording.Recording(), speed=0)
+    with self.assertRaises(snmp.SnmpError):
+      impl.model(make_target())
+
+  def testInvalid(self):
+    with open(self.filename, 'wb') as f:
+      f.write(b'not a recording')
+    with self.assertRaises(recording.InvalidRecording):
+      recording.Recording.load(self.filename)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
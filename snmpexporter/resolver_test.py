@@ -0,0 +1,80 @@
+import os
+import threading
+import unittest
+
+import snmpexporter
+
+
+class FailingResolver(object):
+
+  def resolve_many(self, oids):
+    raise ValueError('broken')
+
+
+class DyingResolver(object):
+
+  def resolve_many(self, oids):
+    os._exit(1)
+
+
+class TestForkedResolver(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = snmpexporter.FakeResolver()
+
+  def testResolve(self):
+    resolver = snmpexporter.ForkedResolver(backend=self.fake)
+    self.assertEqual(
+        resolver.resolve('.1.2.3.4'), self.fake.resolve('.1.2.3.4'))
+
+  def testResolveManyChunked(self):
+    resolver = snmpexporter.ForkedResolver(chunk_size=7, backend=self.fake)
+    oids = ['.1.2.3.%d' % i for i in range(100)]
+    self.assertEqual(resolver.resolve_many(oids),
+                     [self.fake.resolve(oid) for oid in oids])
+
+  def testSharedMemory(self):
+    resolver = snmpexporter.ForkedResolver(
+        shared_memory=True, chunk_size=5000, backend=self.fake)
+    oids = ['.1.3.6.1.2.1.2.2.1.2.%d' % i for i in range(5000)]
+    self.assertEqual(resolver.resolve_many(oids),
+                     [self.fake.resolve(oid) for oid in oids])
+
+  def testConcurrentCallers(self):
+    resolver = snmpexporter.ForkedResolver(chunk_size=3, backend=self.fake)
+    results = {}
+
+    def run(n):
+      oids = ['.1.%d.%d' % (n, i) for i in range(50)]
+      results[n] = (resolver.resolve_many(oids) ==
+                    [self.fake.resolve(oid) for oid in oids])
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, {n: True for n in range(8)})
+
+  def testError(self):
+    resolver = snmpexporter.ForkedResolver(backend=FailingResolver())
+    with self.assertRaises(snmpexporter.Error):
+      resolver.resolve('.1.2.3')
+
+
+  def testResolverDied(self):
+    resolver = snmpexporter.ForkedResolver(backend=DyingResolver())
+    resolver.liveness_interval = 0.1
+    with self.assertRaises(snmpexporter.Error):
+      resolver.resolve('.1.2.3')
+    # Later lookups fail at once
+    with self.assertRaises(snmpexporter.Error):
+      resolver.resolve('.1.2.3')
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
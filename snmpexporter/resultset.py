@@ -0,0 +1,246 @@
+import array
+import collections.abc
+
+from snmpexporter import snmp
+
+
+# How the value of a row is stored
+_INT = 0
+_STR = 1
+_BYTES = 2
+
+_INT64_MIN = -2**63
+_INT64_MAX = 2**63 - 1
+
+
+def _as_int(value):
+  """Returns value as an int if it converts back to the same string."""
+  digits = value[1:] if value.startswith('-') else value
+  # Anything longer does not fit in 64 bits
+  if not digits.isdigit() or len(digits) > 19:
+    return None
+  try:
+    number = int(value)
+  except ValueError:
+    return None
+  if str(number) != value or not _INT64_MIN <= number <= _INT64_MAX:
+    return None
+  return number
+
+
+def _covers(outer, inner):
+  return inner == outer or inner.startswith(outer + '.')
+
+
+class _ItemsView(collections.abc.ItemsView):
+
+  def __iter__(self):
+    return self._mapping._items()
+
+
+class _ValuesView(collections.abc.ValuesView):
+
+  def __iter__(self):
+    for _, value in self._mapping._items():
+      yield value
+
+
+class ResultSet(collections.abc.Mapping):
+  """Poll results stored column by column.
+
+  Maps (oid, vlan) to snmp.ResultTuple like the dict it replaces, but rows
+  are kept in arrays instead of as a string and a tuple each. Results are
+  added a walked subtree at a time. The subtree OID and VLAN are stored
+  once, the rest of every OID goes into a bytes arena. Values that are
+  integers are stored as such, everything else in a second arena.
+
+  This keeps large polls small in memory, and cheap to pickle when they are
+  sent from a poller process or stored in a shared cache.
+
+  A subtree that is already part of a walked subtree in the same VLAN is
+  not added again, so that OIDs are unique like in a dict.
+  """
+
+  def __init__(self):
+    super(ResultSet, self).__init__()
+    self.prefixes = []
+    self.vlans = []
+    self.types = []
+    # Walked subtrees as [prefix id, vlan id, first row, end row]
+    self.segments = []
+    # Rows of subtrees replaced by a larger walk, dropped when pickled
+    self.dead = 0
+    self.suffixes = bytearray()
+    self.suffix_ends = array.array('L')
+    self.type_ids = array.array('B')
+    self.kinds = array.array('B')
+    self.ints = array.array('q')
+    self.values = bytearray()
+    self.value_ends = array.array('Q')
+    # (oid, vlan) -> row, built on first lookup
+    self._index = None
+
+  @classmethod
+  def from_walk(cls, oid, vlan, results):
+    """Make a ResultSet of a walk, results are {oid: snmp.ResultTuple}."""
+    result_set = cls()
+    result_set.add_walk(oid, vlan, results)
+    return result_set
+
+  def _id(self, table, value):
+    try:
+      return table.index(value)
+    except ValueError:
+      table.append(value)
+      return len(table) - 1
+
+  def _add_segment(self, prefix, vlan):
+    """Returns the VLAN id to add rows with, or None if already covered."""
+    vlan_id = self._id(self.vlans, vlan)
+    for prefix_id, segment_vlan_id, _, _ in self.segments:
+      if segment_vlan_id == vlan_id and _covers(
+          self.prefixes[prefix_id], prefix):
+        return None
+    segments = []
+    for segment in self.segments:
+      prefix_id, segment_vlan_id, start, end = segment
+      if segment_vlan_id == vlan_id and _covers(
+          prefix, self.prefixes[prefix_id]):
+        self.dead += end - start
+      else:
+        segments.append(segment)
+    self.segments = segments
+    self._index = None
+    return vlan_id
+
+  def add_walk(self, oid, vlan, results):
+    vlan_id = self._add_segment(oid, vlan)
+    if vlan_id is None:
+      return
+    start = len(self.kinds)
+    for key, result in results.items():
+      if not key.startswith(oid):
+        raise ValueError('%s is not in the walked subtree %s' % (key, oid))
+      self.suffixes += key[len(oid):].encode()
+      self.suffix_ends.append(len(self.suffixes))
+      self.type_ids.append(self._id(self.types, result.type))
+      value = result.value
+      if isinstance(value, bytes):
+        self.kinds.append(_BYTES)
+      else:
+        value = str(value)
+        number = _as_int(value)
+        if number is not None:
+          self.kinds.append(_INT)
+          self.ints.append(number)
+          self.value_ends.append(len(self.values))
+          continue
+        self.kinds.append(_STR)
+        value = value.encode()
+      self.ints.append(0)
+      self.values += value
+      self.value_ends.append(len(self.values))
+    self.segments.append(
+        [self._id(self.prefixes, oid), vlan_id, start, len(self.kinds)])
+
+  def update(self, other):
+    """Add the subtrees of another ResultSet."""
+    type_ids = [self._id(self.types, x) for x in other.types]
+    for prefix_id, vlan_id, start, end in other.segments:
+      prefix = other.prefixes[prefix_id]
+      new_vlan_id = self._add_segment(prefix, other.vlans[vlan_id])
+      if new_vlan_id is None:
+        continue
+      first = len(self.kinds)
+      suffix_start = other.suffix_ends[start - 1] if start else 0
+      value_start = other.value_ends[start - 1] if start else 0
+      suffix_base = len(self.suffixes) - suffix_start
+      value_base = len(self.values) - value_start
+      if end > start:
+        self.suffixes += other.suffixes[
+            suffix_start:other.suffix_ends[end - 1]]
+        self.values += other.values[value_start:other.value_ends[end - 1]]
+      self.suffix_ends.extend(
+          x + suffix_base for x in other.suffix_ends[start:end])
+      self.value_ends.extend(
+          x + value_base for x in other.value_ends[start:end])
+      self.type_ids.extend(type_ids[x] for x in other.type_ids[start:end])
+      self.kinds.extend(other.kinds[start:end])
+      self.ints.extend(other.ints[start:end])
+      self.segments.append([
+        self._id(self.prefixes, prefix), new_vlan_id, first, len(self.kinds)])
+
+  def override_types(self, overrides):
+    """Change the type of results, overrides is {parent OID: type}."""
+    for prefix_id, _, start, end in self.segments:
+      prefix = self.prefixes[prefix_id]
+      if not any(_covers(prefix, x) or prefix.startswith(x)
+                 for x in overrides):
+        continue
+      for row in range(start, end):
+        oid = prefix + self._suffix(row)
+        root = oid[:oid.rfind('.')]
+        if root in overrides:
+          self.type_ids[row] = self._id(self.types, overrides[root])
+
+  def _suffix(self, row):
+    start = self.suffix_ends[row - 1] if row else 0
+    return self.suffixes[start:self.suffix_ends[row]].decode()
+
+  def _result(self, row):
+    kind = self.kinds[row]
+    if kind == _INT:
+      value = str(self.ints[row])
+    else:
+      start = self.value_ends[row - 1] if row else 0
+      value = bytes(self.values[start:self.value_ends[row]])
+      if kind == _STR:
+        value = value.decode()
+    return snmp.ResultTuple(value, self.types[self.type_ids[row]])
+
+  def _items(self):
+    for prefix_id, vlan_id, start, end in self.segments:
+      prefix = self.prefixes[prefix_id]
+      vlan = self.vlans[vlan_id]
+      for row in range(start, end):
+        yield (prefix + self._suffix(row), vlan), self._result(row)
+
+  def __iter__(self):
+    for prefix_id, vlan_id, start, end in self.segments:
+      prefix = self.prefixes[prefix_id]
+      vlan = self.vlans[vlan_id]
+      for row in range(start, end):
+        yield prefix + self._suffix(row), vlan
+
+  def __len__(self):
+    return sum(end - start for _, _, start, end in self.segments)
+
+  def __getitem__(self, key):
+    if self._index is None:
+      self._index = {}
+      for prefix_id, vlan_id, start, end in self.segments:
+        prefix = self.prefixes[prefix_id]
+        vlan = self.vlans[vlan_id]
+        for row in range(start, end):
+          self._index[(prefix + self._suffix(row), vlan)] = row
+    return self._result(self._index[key])
+
+  def items(self):
+    return _ItemsView(self)
+
+  def values(self):
+    return _ValuesView(self)
+
+  def __getstate__(self):
+    result_set = self
+    if self.dead:
+      result_set = ResultSet()
+      result_set.update(self)
+    state = dict(result_set.__dict__)
+    state['_index'] = None
+    return state
+
+  def __repr__(self):
+    return 'ResultSet(%d results in %d subtrees)' % (
+        len(self), len(self.segments))
+
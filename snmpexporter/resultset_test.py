@@ -0,0 +1,98 @@
+import pickle
+import unittest
+
+from snmpexporter import resultset
+from snmpexporter import snmp
+
+
+IF_TABLE = {
+  '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+  '.1.3.6.1.2.1.2.2.1.2.2': snmp.ResultTuple(b'\xff\x00', 'OCTETSTR'),
+  '.1.3.6.1.2.1.2.2.1.10.1': snmp.ResultTuple('1000', 'COUNTER'),
+  '.1.3.6.1.2.1.2.2.1.10.2': snmp.ResultTuple('-5', 'INTEGER'),
+}
+HC_IN_OCTETS = {
+  '.1.3.6.1.2.1.31.1.1.1.6.1': snmp.ResultTuple(
+    '18446744073709551615', 'COUNTER64'),
+  '.1.3.6.1.2.1.31.1.1.1.6.2': snmp.ResultTuple('007', 'OCTETSTR'),
+}
+
+
+def expected(results, vlan=None):
+  return {(oid, vlan): result for oid, result in results.items()}
+
+
+class TestResultSet(unittest.TestCase):
+
+  def setUp(self):
+    self.results = resultset.ResultSet.from_walk(
+        '.1.3.6.1.2.1.2.2', None, IF_TABLE)
+    self.results.update(resultset.ResultSet.from_walk(
+        '.1.3.6.1.2.1.31.1.1.1.6', 10, HC_IN_OCTETS))
+    self.expected = expected(IF_TABLE)
+    self.expected.update(expected(HC_IN_OCTETS, 10))
+
+  def testMapping(self):
+    self.assertEqual(len(self.results), 6)
+    self.assertEqual(dict(self.results.items()), self.expected)
+    self.assertEqual(sorted(self.results.keys()), sorted(self.expected))
+    self.assertEqual(self.results, self.expected)
+    self.assertEqual(
+        self.results[('.1.3.6.1.2.1.2.2.1.10.2', None)],
+        snmp.ResultTuple('-5', 'INTEGER'))
+    self.assertNotIn(('.1.3.6.1.2.1.2.2.1.10.2', 10), self.results)
+    self.assertEqual(self.results.get(('.1.2', None)), None)
+
+  def testValuesKeepTheirType(self):
+    # Only values that are exactly an int are stored as one
+    self.assertEqual(list(self.results.kinds), [1, 2, 0, 0, 1, 1])
+    self.assertIsInstance(
+        self.results[('.1.3.6.1.2.1.2.2.1.2.2', None)].value, bytes)
+
+  def testCoveredSubtrees(self):
+    # ifDescr is part of the ifTable walk, and is not added twice
+    self.results.update(resultset.ResultSet.from_walk(
+        '.1.3.6.1.2.1.2.2.1.2', None,
+        {'.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR')}))
+    self.assertEqual(len(self.results), 6)
+    # ... but it is in another VLAN
+    self.results.update(resultset.ResultSet.from_walk(
+        '.1.3.6.1.2.1.2.2.1.2', 10,
+        {'.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR')}))
+    self.assertEqual(len(self.results), 7)
+
+    # A larger walk replaces the subtrees it covers
+    self.results.add_walk('.1.3.6.1.2.1', None, {
+      '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/2', 'OCTETSTR')})
+    self.assertEqual(len(self.results), 4)
+    self.assertEqual(self.results.dead, 4)
+    self.assertEqual(
+        self.results[('.1.3.6.1.2.1.2.2.1.2.1', None)].value, 'Gi0/2')
+
+    copy = pickle.loads(pickle.dumps(self.results))
+    self.assertEqual(copy.dead, 0)
+    self.assertEqual(copy, self.results)
+
+  def testOverrideTypes(self):
+    self.results.override_types({
+      '.1.3.6.1.2.1.2.2.1.10': 'COUNTER64', '.1.2.3': 'INTEGER'})
+    self.assertEqual(
+        self.results[('.1.3.6.1.2.1.2.2.1.10.1', None)].type, 'COUNTER64')
+    self.assertEqual(
+        self.results[('.1.3.6.1.2.1.2.2.1.2.1', None)].type, 'OCTETSTR')
+
+  def testPickle(self):
+    copy = pickle.loads(pickle.dumps(self.results))
+    self.assertEqual(copy, self.expected)
+
+  def testOutsideSubtree(self):
+    with self.assertRaises(ValueError):
+      resultset.ResultSet.from_walk('.1.3.6.1.2.1.2.2', None, HC_IN_OCTETS)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
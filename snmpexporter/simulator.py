@@ -0,0 +1,333 @@
+"""A simulated SNMP agent, to test and load test against without hardware.
+
+Agents answer GET, GETNEXT and GETBULK for SNMPv2c and SNMPv3 (USM) from a
+Dump, which is either recorded with snmpwalk or made up by synthetic().
+Some quirks of real devices can be turned on per agent:
+
+  - mtu: responses larger than this are silently dropped, like Nexus does
+    with responses that would be fragmented.
+  - delay: seconds to wait before answering, for slow agents.
+
+VLAN contexts are addressed like on Cisco devices, as community@vlan for
+SNMPv2c and as the context vlan-<vlan> for SNMPv3.
+"""
+import asyncio
+import bisect
+import random
+import re
+import threading
+
+from snmpexporter import ber
+from snmpexporter import usm
+
+
+ENGINE_ID = b'\x80\x00\x00\x09\x03simulator'
+
+# snmpwalk -On type names -> (BER tag, value parser)
+DUMP_TYPES = {
+  # Enumerations are printed as name(value) without -Oe
+  'INTEGER': (ber.INTEGER,
+              lambda x: int(re.sub(r'^\w*\((-?\d+)\)$', r'\1', x))),
+  'STRING': (ber.OCTET_STRING, lambda x: x.strip('"').encode()),
+  'Hex-STRING': (ber.OCTET_STRING, lambda x: bytes.fromhex(x)),
+  'OID': (ber.OBJECT_IDENTIFIER, lambda x: x),
+  'IpAddress': (ber.IP_ADDRESS, lambda x: x),
+  'Counter32': (ber.COUNTER32, int),
+  'Gauge32': (ber.GAUGE32, int),
+  'Counter64': (ber.COUNTER64, int),
+  'Timeticks': (ber.TIMETICKS, lambda x: int(x.split(')')[0].strip('('))),
+}
+
+# Columns of synthetic() interfaces as (OID, BER tag, value of ifIndex)
+INTERFACE_COLUMNS = (
+  ('.1.3.6.1.2.1.2.2.1.1', ber.INTEGER, lambda i: i),
+  ('.1.3.6.1.2.1.2.2.1.2', ber.OCTET_STRING,
+   lambda i: ('GigabitEthernet1/0/%d' % i).encode()),
+  ('.1.3.6.1.2.1.2.2.1.3', ber.INTEGER, lambda i: 6),
+  ('.1.3.6.1.2.1.2.2.1.7', ber.INTEGER, lambda i: 1),
+  ('.1.3.6.1.2.1.2.2.1.8', ber.INTEGER, lambda i: 1 + i % 2),
+  ('.1.3.6.1.2.1.2.2.1.10', ber.COUNTER32, lambda i: random.getrandbits(32)),
+  ('.1.3.6.1.2.1.2.2.1.14', ber.COUNTER32, lambda i: random.randrange(100)),
+  ('.1.3.6.1.2.1.2.2.1.16', ber.COUNTER32, lambda i: random.getrandbits(32)),
+  ('.1.3.6.1.2.1.2.2.1.20', ber.COUNTER32, lambda i: random.randrange(100)),
+  ('.1.3.6.1.2.1.31.1.1.1.1', ber.OCTET_STRING,
+   lambda i: ('Gi1/0/%d' % i).encode()),
+  ('.1.3.6.1.2.1.31.1.1.1.6', ber.COUNTER64,
+   lambda i: random.getrandbits(50)),
+  ('.1.3.6.1.2.1.31.1.1.1.10', ber.COUNTER64,
+   lambda i: random.getrandbits(50)),
+  ('.1.3.6.1.2.1.31.1.1.1.15', ber.GAUGE32, lambda i: 1000),
+  ('.1.3.6.1.2.1.31.1.1.1.18', ber.OCTET_STRING,
+   lambda i: ('port %d' % i).encode()),
+)
+
+VTP_VLAN_STATE = '.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1'
+BASE_PORT_IF_INDEX = '.1.3.6.1.2.1.17.1.4.1.2'
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class InvalidDump(Error):
+  """A recorded dump could not be parsed."""
+
+
+def oid_key(oid):
+  return tuple(int(x) for x in oid.strip('.').split('.'))
+
+
+class MibView(object):
+  """The values of one context, ordered for GETNEXT and GETBULK."""
+
+  def __init__(self, values):
+    super(MibView, self).__init__()
+    self.values = values
+    self.oids = sorted(values, key=oid_key)
+    self.keys = [oid_key(x) for x in self.oids]
+
+  def get(self, oid):
+    return (oid,) + self.values.get(oid, (ber.NO_SUCH_OBJECT, None))
+
+  def next(self, oid, count=1):
+    """The count values following oid, ending with endOfMibView if short."""
+    start = bisect.bisect_right(self.keys, oid_key(oid))
+    varbinds = [(x,) + self.values[x] for x in self.oids[start:start + count]]
+    if len(varbinds) < count:
+      varbinds.append((oid, ber.END_OF_MIB_VIEW, None))
+    return varbinds
+
+  def __len__(self):
+    return len(self.oids)
+
+
+class Dump(object):
+  """MIB views of an agent by context, None being the default context."""
+
+  def __init__(self, contexts):
+    super(Dump, self).__init__()
+    self.contexts = {
+        context: MibView(values) for context, values in contexts.items()}
+    self.contexts.setdefault(None, MibView({}))
+
+  def view(self, context):
+    return self.contexts.get(context or None, None)
+
+  @classmethod
+  def parse(cls, text):
+    """Parse the output of snmpwalk -On.
+
+    A line '# context: <vlan>' starts the values of a VLAN context. Values
+    that do not fit in one line are continued on the next ones, like
+    snmpwalk prints them.
+    """
+    contexts = {None: {}}
+    values = contexts[None]
+    last = last_type = None
+    for number, line in enumerate(text.splitlines(), 1):
+      if line.startswith('# context:'):
+        context = line.split(':', 1)[1].strip() or None
+        values = contexts.setdefault(context, {})
+        last = last_type = None
+        continue
+      if not line.strip() or line.startswith('#'):
+        continue
+      if not line.startswith('.'):
+        if last_type == 'STRING':
+          more = b'\n' + line.strip('"').encode()
+        elif last_type == 'Hex-STRING':
+          more = bytes.fromhex(line)
+        else:
+          raise InvalidDump('Line %d is not an OID: %s' % (number, line))
+        tag, value = values[last]
+        values[last] = (tag, value + more)
+        continue
+      oid, _, rest = line.partition(' = ')
+      type_name, _, value = rest.partition(': ')
+      if type_name not in DUMP_TYPES:
+        # Things like "No more variables left in this MIB View"
+        last = last_type = None
+        continue
+      tag, parser = DUMP_TYPES[type_name]
+      try:
+        values[oid] = (tag, parser(value.strip()))
+      except ValueError:
+        raise InvalidDump('Line %d has a bad %s: %s' % (
+            number, type_name, value))
+      last, last_type = oid, type_name
+    return cls(contexts)
+
+  @classmethod
+  def load(cls, path):
+    with open(path) as f:
+      return cls.parse(f.read())
+
+  @classmethod
+  def synthetic(cls, model='WS-C2960X-48TS-L', interfaces=48, vlans=(),
+                seed=0):
+    """A made up switch with interfaces and VLAN contexts."""
+    state = random.getstate()
+    random.seed(seed)
+    try:
+      values = {
+        '.1.3.6.1.2.1.1.1.0': (ber.OCTET_STRING, b'Simulated ' +
+                               model.encode()),
+        '.1.3.6.1.2.1.47.1.1.1.1.13.1': (ber.OCTET_STRING, model.encode()),
+      }
+      for index in range(1, interfaces + 1):
+        for oid, tag, value in INTERFACE_COLUMNS:
+          values['%s.%d' % (oid, index)] = (tag, value(index))
+      contexts = {None: values}
+      for vlan in vlans:
+        values['%s.%d' % (VTP_VLAN_STATE, vlan)] = (ber.INTEGER, 1)
+        contexts[str(vlan)] = {
+          '%s.%d' % (BASE_PORT_IF_INDEX, port): (ber.INTEGER, port)
+          for port in range(1, interfaces + 1)}
+    finally:
+      random.setstate(state)
+    return cls(contexts)
+
+
+class Agent(asyncio.DatagramProtocol):
+  """A simulated agent, one per endpoint."""
+
+  def __init__(self, dump, community='public', user=None,
+               engine_id=ENGINE_ID, delay=0, mtu=None):
+    super(Agent, self).__init__()
+    self.dump = dump
+    self.community = community
+    self.user = user
+    self.engine = usm.Engine(engine_id, 1, 0)
+    self.delay = delay
+    self.mtu = mtu
+    self.transport = None
+    self.requests = 0
+    # Requests that were not answered, and why
+    self.rejected = 0
+    self.dropped = 0
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def respond(self, pdu, view):
+    if pdu.type == ber.GET_REQUEST:
+      varbinds = [view.get(oid) for oid, _, _ in pdu.varbinds]
+    elif pdu.type == ber.GET_NEXT_REQUEST:
+      varbinds = [view.next(oid)[0] for oid, _, _ in pdu.varbinds]
+    elif pdu.type == ber.GET_BULK_REQUEST:
+      non_repeaters = max(0, pdu.error_status)
+      varbinds = [view.next(oid)[0]
+                  for oid, _, _ in pdu.varbinds[:non_repeaters]]
+      varbinds.extend(self._repetitions(
+          view, [oid for oid, _, _ in pdu.varbinds[non_repeaters:]],
+          max(1, pdu.error_index)))
+    else:
+      return None
+    return ber.Pdu(ber.RESPONSE, pdu.request_id, 0, 0, varbinds)
+
+  def _repetitions(self, view, oids, count):
+    """The GETBULK values of repeated OIDs, by repetition (RFC 3416 4.2.3).
+
+    Every repetition has one value per OID. An OID past the end of the MIB
+    view stays at endOfMibView, and the response ends after the first
+    repetition where all of them are.
+    """
+    columns = []
+    for oid in oids:
+      column = view.next(oid, count)
+      column.extend([column[-1][:1] + (ber.END_OF_MIB_VIEW, None)] * (
+          count - len(column)))
+      columns.append(column)
+    varbinds = []
+    for row in zip(*columns):
+      varbinds.extend(row)
+      if all(x[1] == ber.END_OF_MIB_VIEW for x in row):
+        break
+    return varbinds
+
+  def _v2c(self, data):
+    version, community, pdu = ber.decode_message(data)
+    community, _, context = community.decode().partition('@')
+    view = self.dump.view(context)
+    if community != self.community or view is None:
+      return None
+    response = self.respond(pdu, view)
+    if response is None:
+      return None
+    return ber.encode_message(version, self.community + (
+        '@' + context if context else ''), response)
+
+  def _v3(self, data):
+    request = usm.decode_message(data, self.user)
+    if not request.engine_id:
+      report = ber.Pdu(ber.REPORT, request.pdu.request_id, 0, 0, [
+        (usm.UNKNOWN_ENGINE_IDS, ber.COUNTER32, 1)])
+      return usm.encode_message(
+          request.msg_id, None, self.engine, b'', report, False)
+    if self.user is None or request.user != self.user.name:
+      return None
+    context = request.context.decode()
+    if context and not context.startswith('vlan-'):
+      return None
+    view = self.dump.view(context[len('vlan-'):])
+    if view is None:
+      return None
+    response = self.respond(request.pdu, view)
+    if response is None:
+      return None
+    return usm.encode_message(
+        request.msg_id, self.user, self.engine, request.context, response,
+        False)
+
+  def datagram_received(self, data, addr):
+    self.requests += 1
+    try:
+      version, _ = ber.message_id(data)
+      if version == ber.VERSION_3:
+        response = self._v3(data)
+      else:
+        response = self._v2c(data)
+    except (ber.Error, usm.Error, ValueError):
+      response = None
+    if response is None:
+      # Like a real agent, wrong credentials are not answered
+      self.rejected += 1
+      return
+    if self.mtu is not None and len(response) > self.mtu:
+      self.dropped += 1
+      return
+    if self.delay:
+      asyncio.get_running_loop().call_later(
+          self.delay, self.transport.sendto, response, addr)
+    else:
+      self.transport.sendto(response, addr)
+
+
+class Simulator(object):
+  """Runs agents on an event loop in a background thread."""
+
+  def __init__(self):
+    super(Simulator, self).__init__()
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+    self.thread.start()
+    self.transports = []
+
+  def start(self, agent, host='127.0.0.1', port=0):
+    """Start serving agent, returns the port it listens on."""
+    transport, _ = asyncio.run_coroutine_threadsafe(
+        self.loop.create_datagram_endpoint(
+          lambda: agent, local_addr=(host, port)), self.loop).result()
+    self.transports.append(transport)
+    return transport.get_extra_info('sockname')[1]
+
+  def stop(self):
+    async def shutdown():
+      for transport in self.transports:
+        transport.close()
+      await asyncio.sleep(0)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+    self.loop.close()
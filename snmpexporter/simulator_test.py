@@ -0,0 +1,185 @@
+import time
+import unittest
+
+from snmpexporter import ber
+from snmpexporter import simulator
+from snmpexporter import snmp
+from snmpexporter import snmpimpl
+from snmpexporter import target
+from snmpexporter import usm
+
+
+DUMP = '''\
+.1.3.6.1.2.1.1.1.0 = STRING: "Cisco IOS Software,
+Version 15.2"
+.1.3.6.1.2.1.1.3.0 = Timeticks: (123456) 0:20:34.56
+.1.3.6.1.2.1.2.2.1.2.1 = STRING: "Gi0/1"
+.1.3.6.1.2.1.2.2.1.6.1 = Hex-STRING: 00 11 22 33 FF FE
+.1.3.6.1.2.1.2.2.1.8.1 = INTEGER: up(1)
+.1.3.6.1.2.1.2.2.1.10.1 = Counter32: 1000
+.1.3.6.1.2.1.31.1.1.1.6.1 = Counter64: 18446744073709551615
+.1.3.6.1.2.1.47.1.1.1.1.13.1 = STRING: "WS-C2960"
+.1.3.6.1.2.1.4.20.1.1.10.0.0.1 = IpAddress: 10.0.0.1
+.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.10 = INTEGER: 1
+.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.10 = No more variables left in this MIB View
+# context: 10
+.1.3.6.1.2.1.17.1.4.1.2.1 = INTEGER: 10101
+'''
+
+
+class TestDump(unittest.TestCase):
+
+  def testParse(self):
+    dump = simulator.Dump.parse(DUMP)
+    values = dump.view(None).values
+    self.assertEqual(values['.1.3.6.1.2.1.1.1.0'], (
+        ber.OCTET_STRING, b'Cisco IOS Software,\nVersion 15.2'))
+    self.assertEqual(values['.1.3.6.1.2.1.1.3.0'], (ber.TIMETICKS, 123456))
+    self.assertEqual(values['.1.3.6.1.2.1.2.2.1.6.1'], (
+        ber.OCTET_STRING, b'\x00\x11\x22\x33\xff\xfe'))
+    self.assertEqual(values['.1.3.6.1.2.1.2.2.1.8.1'], (ber.INTEGER, 1))
+    self.assertEqual(values['.1.3.6.1.2.1.31.1.1.1.6.1'], (
+        ber.COUNTER64, 2**64 - 1))
+    self.assertEqual(values['.1.3.6.1.2.1.4.20.1.1.10.0.0.1'], (
+        ber.IP_ADDRESS, '10.0.0.1'))
+    self.assertEqual(len(dump.view(None)), 10)
+    self.assertEqual(dump.view('10').values, {
+        '.1.3.6.1.2.1.17.1.4.1.2.1': (ber.INTEGER, 10101)})
+    self.assertIsNone(dump.view('20'))
+
+  def testParseInvalid(self):
+    with self.assertRaises(simulator.InvalidDump):
+      simulator.Dump.parse('.1.3.6.1.2.1.1.3.0 = Counter32: lots\n')
+    with self.assertRaises(simulator.InvalidDump):
+      simulator.Dump.parse('junk\n')
+
+  def testNext(self):
+    view = simulator.Dump.parse(DUMP).view(None)
+    self.assertEqual(view.next('.1.3.6.1.2.1.2.2.1', 2), [
+      ('.1.3.6.1.2.1.2.2.1.2.1', ber.OCTET_STRING, b'Gi0/1'),
+      ('.1.3.6.1.2.1.2.2.1.6.1', ber.OCTET_STRING,
+       b'\x00\x11\x22\x33\xff\xfe'),
+    ])
+    self.assertEqual(view.next('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.1', 3), [
+      ('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.10', ber.INTEGER, 1),
+      ('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.1', ber.END_OF_MIB_VIEW, None),
+    ])
+
+  def testSynthetic(self):
+    dump = simulator.Dump.synthetic(interfaces=4, vlans=(10, 20))
+    self.assertEqual(dump.view(None).values[
+        '.1.3.6.1.2.1.47.1.1.1.1.13.1'], (ber.OCTET_STRING,
+                                           b'WS-C2960X-48TS-L'))
+    self.assertEqual(len(dump.view('20')), 4)
+    # The same seed gives the same device
+    self.assertEqual(
+        simulator.Dump.synthetic(interfaces=4, vlans=(10, 20)).view(
+            None).values,
+        dump.view(None).values)
+
+
+class TestAgent(unittest.TestCase):
+
+  def setUp(self):
+    self.simulator = simulator.Simulator()
+    self.impl = snmpimpl.AsyncioImpl()
+    self.dump = simulator.Dump.parse(DUMP)
+
+  def tearDown(self):
+    self.impl.close()
+    self.simulator.stop()
+
+  def target(self, port, **config):
+    config.update({'port': port})
+    return target.SnmpTarget('127.0.0.1', 'test', {'test': config})
+
+  def checkAgent(self, target):
+    self.assertEqual(self.impl.model(target), 'WS-C2960')
+    self.assertEqual(self.impl.vlans(target), {10})
+    self.assertEqual(self.impl.walk(target, '.1.3.6.1.2.1.2.2.1'), {
+      '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.6.1': snmp.ResultTuple(
+          b'\x00\x11\x22\x33\xff\xfe', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.8.1': snmp.ResultTuple('1', 'INTEGER'),
+      '.1.3.6.1.2.1.2.2.1.10.1': snmp.ResultTuple('1000', 'COUNTER'),
+    })
+    self.assertEqual(self.impl.walk(target, '.1.3.6.1.2.1.17.1.4.1.2', '10'),
+                     {'.1.3.6.1.2.1.17.1.4.1.2.1': snmp.ResultTuple(
+                         '10101', 'INTEGER')})
+
+  def testV2c(self):
+    port = self.simulator.start(simulator.Agent(self.dump))
+    self.checkAgent(self.target(port, version=2, community='public'))
+
+  def testV3(self):
+    user = usm.User('user', 'authNoPriv', 'SHA', 'authpass')
+    port = self.simulator.start(simulator.Agent(self.dump, user=user))
+    self.checkAgent(self.target(
+        port, version=3, user='user', sec_level='authNoPriv',
+        auth_proto='SHA', auth='authpass'))
+
+  def testGetBulk(self):
+    agent = simulator.Agent(self.dump)
+    request = ber.Pdu(ber.GET_BULK_REQUEST, 1, 1, 3, [
+      ('.1.3.6.1.2.1.1.1', ber.NULL, None),
+      ('.1.3.6.1.2.1.2.2.1.8', ber.NULL, None),
+      ('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.1', ber.NULL, None),
+    ])
+    response = agent.respond(request, self.dump.view(None))
+    # The non-repeater, then the repeated OIDs interleaved by repetition.
+    # An OID past the end of the MIB view stays there.
+    self.assertEqual(response.varbinds, [
+      ('.1.3.6.1.2.1.1.1.0', ber.OCTET_STRING,
+       b'Cisco IOS Software,\nVersion 15.2'),
+      ('.1.3.6.1.2.1.2.2.1.8.1', ber.INTEGER, 1),
+      ('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.10', ber.INTEGER, 1),
+      ('.1.3.6.1.2.1.2.2.1.10.1', ber.COUNTER32, 1000),
+      ('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.1', ber.END_OF_MIB_VIEW, None),
+      ('.1.3.6.1.2.1.4.20.1.1.10.0.0.1', ber.IP_ADDRESS, '10.0.0.1'),
+      ('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.1', ber.END_OF_MIB_VIEW, None),
+    ])
+    # The response ends once all of them are
+    request = request._replace(error_status=0, varbinds=request.varbinds[2:])
+    response = agent.respond(request, self.dump.view(None))
+    self.assertEqual(response.varbinds, [
+      ('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.10', ber.INTEGER, 1),
+      ('.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.1', ber.END_OF_MIB_VIEW, None),
+    ])
+
+  def testWrongCommunity(self):
+    agent = simulator.Agent(self.dump)
+    port = self.simulator.start(agent)
+    self.impl.GET_TIMEOUT = 0.1
+    self.impl.GET_RETRIES = 1
+    with self.assertRaises(snmp.TimeoutError):
+      self.impl.get(self.target(port, version=2, community='private'),
+                    '.1.3.6.1.2.1.1.1.0')
+    self.assertEqual(agent.rejected, agent.requests)
+
+  def testFragmentedResponsesDropped(self):
+    dump = simulator.Dump.synthetic(interfaces=48)
+    agent = simulator.Agent(dump, mtu=1500)
+    port = self.simulator.start(agent)
+    self.impl.WALK_TIMEOUT = 0.1
+    self.impl.WALK_RETRIES = 1
+    target = self.target(port, version=2, community='public')
+    results = self.impl.walk(target, '.1.3.6.1.2.1.2.2.1.2')
+    self.assertEqual(len(results), 48)
+    # The walk only completes after falling back to smaller responses
+    self.assertEqual(target.max_size, 16)
+    self.assertGreater(agent.dropped, 0)
+
+  def testDelay(self):
+    port = self.simulator.start(simulator.Agent(self.dump, delay=0.2))
+    target = self.target(port, version=2, community='public')
+    start = time.monotonic()
+    self.impl.get(target, '.1.3.6.1.2.1.1.1.0')
+    self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,10 +1,43 @@
+import asyncio
+import collections
+import contextlib
 import logging
 import os
 import sys
+import threading
+import time
 
+from snmpexporter import ber
 from snmpexporter import snmp
 
 
+MODEL_OIDS = [
+    '.1.3.6.1.2.1.47.1.1.1.1.13.1',     # Normal switches
+    '.1.3.6.1.2.1.47.1.1.1.1.13.1001',  # Stacked switches
+    '.1.3.6.1.2.1.47.1.1.1.1.13.10',    # Nexus
+    '.1.3.6.1.2.1.1.1.0',               # Other appliances (sysDescr)
+]
+
+VLAN_OID = '.1.3.6.1.4.1.9.9.46.1.3.1.1.2'  # vtpVlanState
+
+# Type names as reported by the netsnmp bindings
+TYPE_NAMES = {
+  ber.INTEGER: 'INTEGER',
+  ber.OCTET_STRING: 'OCTETSTR',
+  ber.NULL: 'NULL',
+  ber.OBJECT_IDENTIFIER: 'OBJECTID',
+  ber.IP_ADDRESS: 'IPADDR',
+  ber.COUNTER32: 'COUNTER',
+  ber.GAUGE32: 'GAUGE',
+  ber.TIMETICKS: 'TICKS',
+  ber.OPAQUE: 'OPAQUE',
+  ber.COUNTER64: 'COUNTER64',
+  ber.NO_SUCH_OBJECT: 'NOSUCHOBJECT',
+  ber.NO_SUCH_INSTANCE: 'NOSUCHINSTANCE',
+  ber.END_OF_MIB_VIEW: 'ENDOFMIBVIEW',
+}
+
+
 class Error(Exception):
   """Base error class for this module."""
   pass
@@ -12,6 +45,9 @@ class Error(Exception):
 
 class SnmpImpl(object):
 
+  # Whether walks against the same target can run in several threads
+  concurrent_walks = True
+
   def model(self):
     pass
 
@@ -25,12 +61,95 @@ class SnmpImpl(object):
     pass
 
 
+class SessionPool(object):
+  """Idle SNMP sessions kept for reuse.
+
+  Sessions are checked out for exclusive use and checked back in when done,
+  so concurrent walks against the same target each get their own session.
+  Sessions that have been idle for longer than idle_timeout seconds are
+  dropped, and so are the least recently used ones beyond max_sessions, as
+  every session holds a socket. Keys are kept in the order they were last
+  used, so that only the sessions to drop have to be looked at.
+  """
+
+  def __init__(self, idle_timeout=300, max_sessions=1000):
+    super(SessionPool, self).__init__()
+    self.idle_timeout = idle_timeout
+    self.max_sessions = max_sessions
+    self.lock = threading.Lock()
+    # key -> list of (last used, session), most recently used last. The
+    # least recently used key comes first.
+    self.idle = collections.OrderedDict()
+    # Number of sessions in idle
+    self.size = 0
+
+  def checkout(self, key):
+    with self.lock:
+      deadline = time.monotonic() - self.idle_timeout
+      self._evict(deadline)
+      sessions = self.idle.get(key, None)
+      if not sessions:
+        return None
+      _, session = sessions.pop()
+      self.size -= 1
+      # Older sessions of the key might have expired
+      while sessions and sessions[0][0] <= deadline:
+        sessions.pop(0)
+        self.size -= 1
+      if not sessions:
+        del self.idle[key]
+      return session
+
+  def checkin(self, key, session):
+    with self.lock:
+      self.idle.setdefault(key, []).append((time.monotonic(), session))
+      self.idle.move_to_end(key)
+      self.size += 1
+      while self.size > self.max_sessions:
+        # The oldest session of the least recently used key
+        oldest_key, sessions = next(iter(self.idle.items()))
+        sessions.pop(0)
+        self.size -= 1
+        if not sessions:
+          del self.idle[oldest_key]
+
+  def _evict(self, deadline):
+    while self.idle:
+      key, sessions = next(iter(self.idle.items()))
+      if sessions[-1][0] > deadline:
+        break
+      del self.idle[key]
+      self.size -= len(sessions)
+
+  def __len__(self):
+    with self.lock:
+      return self.size
+
+
 class NetsnmpImpl(SnmpImpl):
 
-  def __init__(self):
+  # The bindings do not behave well with threads, see snmpexporterd.py
+  concurrent_walks = False
+
+  def __init__(self, session_idle_timeout=300, max_sessions=1000):
     import netsnmp
     self.netsnmp = netsnmp
     self.first_load = True
+    # Creating a session is expensive for SNMPv3 as it does engine discovery
+    # and time synchronisation, so keep them around.
+    self.sessions = SessionPool(session_idle_timeout, max_sessions)
+
+  @contextlib.contextmanager
+  def _session(self, target, vlan=None, timeout=1000000, retries=3):
+    key = (target.full_host, target.version, target.community, target.user,
+           target.sec_level, target.auth_proto, target.auth,
+           target.priv_proto, target.priv, vlan, timeout, retries)
+    session = self.sessions.checkout(key)
+    if session is None:
+      session = self._snmp_session(target, vlan, timeout, retries)
+    # Not reached if the caller raised, sessions that failed are dropped
+    yield session
+    self.sessions.checkin(key, session)
 
   def _snmp_session(self, target, vlan=None, timeout=1000000, retries=3):
     try:
@@ -70,7 +189,10 @@ class NetsnmpImpl(SnmpImpl):
     return session
 
   def walk(self, target, oid, vlan=None):
-    sess = self._snmp_session(target, vlan)
+    with self._session(target, vlan) as sess:
+      return self._walk(sess, target, oid)
+
+  def _walk(self, sess, target, oid):
     ret = {}
     nextoid = oid
     offset = 0
@@ -78,6 +200,7 @@ class NetsnmpImpl(SnmpImpl):
     # Abort the walk when it exits the OID tree we are interested in
     while nextoid.startswith(oid):
       var_list = self.netsnmp.VarList(self.netsnmp.Varbind(nextoid, offset))
+      target.requests += 1
       sess.getbulk(nonrepeaters=0, maxrepetitions=target.max_size,
                    varlist=var_list)
 
@@ -87,9 +210,9 @@ class NetsnmpImpl(SnmpImpl):
       # to smaller one.
       if sess.ErrorStr == 'Timeout':
         if target.max_size == 1:
-          raise TimeoutError(
+          raise snmp.TimeoutError(
               'Timeout getting %s from %s' % (nextoid, target.host))
-        target.max_size = int(target.max_size / 16)
+        target.max_size = max(1, int(target.max_size / 16))
         logging.debug('Timeout getting %s from %s, lowering max size to %d' % (
           nextoid, target.host, target.max_size))
         continue
@@ -116,26 +239,21 @@ class NetsnmpImpl(SnmpImpl):
   def get(self, target, oid):
     # Nexus is quite slow sometimes to answer SNMP so use a high
     # timeout on these initial requests before failing out
-    sess = self._snmp_session(target, timeout=5000000, retries=2)
     var = self.netsnmp.Varbind(oid)
     var_list = self.netsnmp.VarList(var)
-    sess.get(var_list)
-    if sess.ErrorStr != '':
-      if sess.ErrorStr == 'Timeout':
-        raise TimeoutError('Timeout getting %s from %s' % (oid, target.host))
-      raise snmp.SnmpError('SNMP error while talking to host %s: %s' % (
-        target.host, sess.ErrorStr))
+    with self._session(target, timeout=5000000, retries=2) as sess:
+      sess.get(var_list)
+      if sess.ErrorStr != '':
+        if sess.ErrorStr == 'Timeout':
+          raise snmp.TimeoutError(
+              'Timeout getting %s from %s' % (oid, target.host))
+        raise snmp.SnmpError('SNMP error while talking to host %s: %s' % (
+          target.host, sess.ErrorStr))
 
     return {var.tag: snmp.ResultTuple(var.val.decode(), var.type)}
 
   def model(self, target):
-    model_oids = [
-        '.1.3.6.1.2.1.47.1.1.1.1.13.1',     # Normal switches
-        '.1.3.6.1.2.1.47.1.1.1.1.13.1001',  # Stacked switches
-        '.1.3.6.1.2.1.47.1.1.1.1.13.10',    # Nexus
-        '.1.3.6.1.2.1.1.1.0',               # Other appliances (sysDescr)
-    ]
-    for oid in model_oids:
+    for oid in MODEL_OIDS:
       model = self.get(target, oid)
       if not model:
         continue
@@ -146,9 +264,163 @@ class NetsnmpImpl(SnmpImpl):
 
   def vlans(self, target):
     try:
-      oids = list(self.walk(target, '.1.3.6.1.4.1.9.9.46.1.3.1.1.2').keys())
+      oids = list(self.walk(target, VLAN_OID).keys())
       vlans = {int(x.split('.')[-1]) for x in oids}
       return vlans
     except ValueError as e:
       logging.info('ValueError while parsing VLAN for %s: %s', target.host, e)
       return []
+
+
+class AsyncioImpl(SnmpImpl):
+  """SNMP implementation on top of asyncio, with its own BER/USM codec.
+
+  All requests are multiplexed over one event loop running in a background
+  thread, so the blocking methods can be called from any number of threads
+  at once. Coroutine versions are available as *_async.
+  """
+
+  # Same as the netsnmp sessions in NetsnmpImpl
+  WALK_TIMEOUT = 1.0
+  WALK_RETRIES = 3
+  GET_TIMEOUT = 5.0
+  GET_RETRIES = 2
+
+  def __init__(self, max_inflight=500):
+    self.max_inflight = max_inflight
+    self.lock = threading.Lock()
+    self.loop = None
+    self.client = None
+    self.thread = None
+
+  def event_loop(self):
+    """Returns the loop the *_async methods have to run on."""
+    with self.lock:
+      if self.loop is None:
+        # Started lazily so that the thread is created in the process that
+        # will use it, not in a parent that forks poller processes.
+        from snmpexporter import asyncsnmp
+        self.loop = asyncio.new_event_loop()
+        self.client = asyncsnmp.Client(self.max_inflight)
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+      return self.loop
+
+  def _run(self, coro):
+    return asyncio.run_coroutine_threadsafe(coro, self.event_loop()).result()
+
+  def close(self):
+    with self.lock:
+      if self.loop is None:
+        return
+      loop, client, thread = self.loop, self.client, self.thread
+      self.loop = self.client = self.thread = None
+
+    async def shutdown():
+      client.close()
+      # Let the transports finish closing
+      await asyncio.sleep(0)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+  def _result(self, tag, value):
+    if isinstance(value, bytes):
+      try:
+        value = value.decode()
+      except UnicodeDecodeError:
+        pass
+    elif value is None:
+      value = ''
+    else:
+      value = str(value)
+    return snmp.ResultTuple(value, TYPE_NAMES.get(tag, 'UNKNOWN'))
+
+  def walk(self, target, oid, vlan=None):
+    return self._run(self.walk_async(target, oid, vlan))
+
+  async def walk_async(self, target, oid, vlan=None):
+    ret = {}
+    prefix = oid + '.'
+    nextoid = oid
+    while True:
+      target.requests += 1
+      try:
+        pdu = await self.client.request(
+            target, ber.GET_BULK_REQUEST, [nextoid], context=vlan,
+            timeout=self.WALK_TIMEOUT, retries=self.WALK_RETRIES,
+            max_repetitions=target.max_size)
+      except snmp.TimeoutError:
+        # Nexus drops fragmented responses, see NetsnmpImpl.walk
+        if target.max_size == 1:
+          raise snmp.TimeoutError(
+              'Timeout getting %s from %s' % (nextoid, target.host))
+        target.max_size = max(1, int(target.max_size / 16))
+        logging.debug('Timeout getting %s from %s, lowering max size to %d',
+            nextoid, target.host, target.max_size)
+        continue
+
+      done = not pdu.varbinds
+      for currentoid, tag, value in pdu.varbinds:
+        # Abort the walk when it exits the OID tree we are interested in
+        if tag == ber.END_OF_MIB_VIEW or not currentoid.startswith(prefix):
+          done = True
+          break
+        ret[currentoid] = self._result(tag, value)
+      if done:
+        return ret
+
+      lastoid = pdu.varbinds[-1][0]
+      if _oid_key(lastoid) <= _oid_key(nextoid):
+        raise snmp.SnmpError('OID not increasing while walking host %s: %s' % (
+          target.host, lastoid))
+      nextoid = lastoid
+
+  def get(self, target, oid):
+    return self._run(self.get_async(target, oid))
+
+  async def get_async(self, target, oid):
+    # Nexus is quite slow sometimes to answer SNMP so use a high
+    # timeout on these initial requests before failing out
+    pdu = await self.client.request(
+        target, ber.GET_REQUEST, [oid], timeout=self.GET_TIMEOUT,
+        retries=self.GET_RETRIES)
+    return {tag_oid: self._result(tag, value)
+            for tag_oid, tag, value in pdu.varbinds}
+
+  def model(self, target):
+    return self._run(self.model_async(target))
+
+  async def model_async(self, target):
+    for oid in MODEL_OIDS:
+      model = await self.get_async(target, oid)
+      if not model:
+        continue
+      value = list(model.values()).pop().value
+      if value:
+        return value
+    raise snmp.NoModelOid('No model OID contained a model')
+
+  def vlans(self, target):
+    return self._run(self.vlans_async(target))
+
+  async def vlans_async(self, target):
+    try:
+      oids = list((await self.walk_async(target, VLAN_OID)).keys())
+      return {int(x.split('.')[-1]) for x in oids}
+    except ValueError as e:
+      logging.info('ValueError while parsing VLAN for %s: %s', target.host, e)
+      return []
+
+
+def _oid_key(oid):
+  return tuple(int(x) for x in oid.strip('.').split('.'))
+
+
+IMPLEMENTATIONS = {
+  'netsnmp': NetsnmpImpl,
+  'asyncio': AsyncioImpl,
+}
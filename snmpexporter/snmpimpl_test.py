@@ -0,0 +1,319 @@
+import asyncio
+import socket
+import sys
+import threading
+import types
+import unittest
+from unittest import mock
+
+from snmpexporter import ber
+from snmpexporter import snmp
+from snmpexporter import snmpimpl
+from snmpexporter import target
+from snmpexporter import usm
+
+
+ENGINE_ID = b'\x80\x00\x00\x09\x03testengine'
+
+DATA = {
+  None: {
+    '.1.3.6.1.2.1.1.1.0': (ber.OCTET_STRING, b'Cisco IOS'),
+    '.1.3.6.1.2.1.2.2.1.2.1': (ber.OCTET_STRING, b'Gi0/1'),
+    '.1.3.6.1.2.1.2.2.1.2.2': (ber.OCTET_STRING, b'\xff\xfe'),
+    '.1.3.6.1.2.1.2.2.1.10.1': (ber.COUNTER32, 1000),
+    '.1.3.6.1.2.1.2.2.1.10.2': (ber.COUNTER32, 2000),
+    '.1.3.6.1.2.1.31.1.1.1.6.1': (ber.COUNTER64, 2**63),
+    '.1.3.6.1.2.1.47.1.1.1.1.13.1': (ber.OCTET_STRING, b'WS-C2960'),
+    '.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.1': (ber.INTEGER, 1),
+    '.1.3.6.1.4.1.9.9.46.1.3.1.1.2.1.10': (ber.INTEGER, 1),
+  },
+  '10': {
+    '.1.3.6.1.2.1.17.1.4.1.2.1': (ber.INTEGER, 10101),
+  },
+}
+
+
+def oid_key(oid):
+  return tuple(int(x) for x in oid.strip('.').split('.'))
+
+
+class FakeAgent(asyncio.DatagramProtocol):
+
+  def __init__(self, user=None):
+    self.user = user
+    self.engine = usm.Engine(ENGINE_ID, 1, 100)
+    self.requests = 0
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def respond(self, pdu, context):
+    data = DATA.get(context or None, {})
+    oids = sorted(data, key=oid_key)
+    varbinds = []
+    if pdu.type == ber.GET_REQUEST:
+      for oid, _, _ in pdu.varbinds:
+        tag, value = data.get(oid, (ber.NO_SUCH_OBJECT, None))
+        varbinds.append((oid, tag, value))
+    else:
+      start = oid_key(pdu.varbinds[0][0])
+      following = [x for x in oids if oid_key(x) > start]
+      for oid in following[:pdu.error_index]:
+        varbinds.append((oid,) + data[oid])
+      if len(following) < pdu.error_index:
+        varbinds.append((pdu.varbinds[0][0], ber.END_OF_MIB_VIEW, None))
+    return ber.Pdu(ber.RESPONSE, pdu.request_id, 0, 0, varbinds)
+
+  def datagram_received(self, data, addr):
+    self.requests += 1
+    version, _ = ber.message_id(data)
+    if version != ber.VERSION_3:
+      _, community, pdu = ber.decode_message(data)
+      community = community.decode()
+      context = community.split('@', 1)[1] if '@' in community else None
+      self.transport.sendto(ber.encode_message(
+          version, community, self.respond(pdu, context)), addr)
+      return
+    request = usm.decode_message(data, self.user)
+    if not request.engine_id:
+      report = ber.Pdu(ber.REPORT, request.pdu.request_id, 0, 0, [
+        (usm.UNKNOWN_ENGINE_IDS, ber.COUNTER32, 1)])
+      self.transport.sendto(usm.encode_message(
+          request.msg_id, None, self.engine, b'', report, False), addr)
+      return
+    context = request.context.decode()
+    context = context[len('vlan-'):] if context else None
+    self.transport.sendto(usm.encode_message(
+        request.msg_id, self.user, self.engine, request.context,
+        self.respond(request.pdu, context), False), addr)
+
+
+class TestAsyncioImpl(unittest.TestCase):
+
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+    self.thread.start()
+    self.transports = []
+    self.impl = snmpimpl.AsyncioImpl()
+
+  def tearDown(self):
+    self.impl.close()
+
+    async def shutdown():
+      for transport in self.transports:
+        transport.close()
+      await asyncio.sleep(0)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+    self.loop.close()
+
+  def startAgent(self, user=None):
+    agent = FakeAgent(user)
+    transport, _ = asyncio.run_coroutine_threadsafe(
+        self.loop.create_datagram_endpoint(
+          lambda: agent, local_addr=('127.0.0.1', 0)), self.loop).result()
+    self.transports.append(transport)
+    return transport.get_extra_info('sockname')[1]
+
+  def target(self, port, **config):
+    config.update({'port': port})
+    return target.SnmpTarget('127.0.0.1', 'test', {'test': config})
+
+  def checkImpl(self, target):
+    impl = self.impl
+    self.assertEqual(impl.model(target), 'WS-C2960')
+    self.assertEqual(impl.vlans(target), {1, 10})
+    target.max_size = 1
+    self.assertEqual(impl.walk(target, '.1.3.6.1.2.1.2.2.1'), {
+      '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.2.2': snmp.ResultTuple(b'\xff\xfe', 'OCTETSTR'),
+      '.1.3.6.1.2.1.2.2.1.10.1': snmp.ResultTuple('1000', 'COUNTER'),
+      '.1.3.6.1.2.1.2.2.1.10.2': snmp.ResultTuple('2000', 'COUNTER'),
+    })
+    target.max_size = 256
+    self.assertEqual(impl.walk(target, '.1.3.6.1.2.1.31.1.1.1.6'), {
+      '.1.3.6.1.2.1.31.1.1.1.6.1': snmp.ResultTuple(str(2**63), 'COUNTER64'),
+    })
+    self.assertEqual(impl.walk(target, '.1.3.6.1.2.1.17.1.4.1.2', '10'), {
+      '.1.3.6.1.2.1.17.1.4.1.2.1': snmp.ResultTuple('10101', 'INTEGER'),
+    })
+    self.assertEqual(impl.walk(target, '.1.3.6.1.2.1.17.1.4.1.2'), {})
+    self.assertEqual(impl.get(target, '.1.3.6.1.2.1.1.2.0'), {
+      '.1.3.6.1.2.1.1.2.0': snmp.ResultTuple('', 'NOSUCHOBJECT'),
+    })
+
+  def testV2c(self):
+    port = self.startAgent()
+    self.checkImpl(self.target(port, version=2, community='public'))
+
+  def testV3Auth(self):
+    user = usm.User('user', 'authNoPriv', 'SHA', 'authpass')
+    port = self.startAgent(user)
+    self.checkImpl(self.target(
+        port, version=3, user='user', sec_level='authNoPriv',
+        auth_proto='SHA', auth='authpass'))
+
+  def testV3Priv(self):
+    try:
+      import cryptography
+    except ImportError:
+      self.skipTest('cryptography is not installed')
+    user = usm.User('user', 'authPriv', 'MD5', 'authpass', 'AES', 'privpass')
+    port = self.startAgent(user)
+    self.checkImpl(self.target(
+        port, version=3, user='user', sec_level='authPriv', auth_proto='MD5',
+        auth='authpass', priv_proto='AES', priv='privpass'))
+
+  def testTimeout(self):
+    # Nothing is listening on the port after the socket is closed
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    target = self.target(port, version=2, community='public')
+    self.impl.GET_TIMEOUT = 0.1
+    self.impl.GET_RETRIES = 1
+    with self.assertRaises(snmp.TimeoutError):
+      self.impl.get(target, '.1.3.6.1.2.1.1.1.0')
+
+  def testConcurrentWalks(self):
+    port = self.startAgent()
+    target = self.target(port, version=2, community='public')
+    impl = self.impl
+
+    async def walks():
+      return await asyncio.gather(*[
+        impl.walk_async(target, '.1.3.6.1.2.1.2.2.1') for _ in range(200)])
+
+    results = impl._run(walks())
+    self.assertEqual(len(results), 200)
+    self.assertEqual(len(set(len(x) for x in results)), 1)
+
+
+class FakeVarbind(object):
+
+  def __init__(self, tag, iid=None, val=None, type=None):
+    self.tag = tag
+    self.iid = iid
+    self.val = val
+    self.type = type
+
+
+class FakeSession(object):
+
+  def __init__(self, **kwargs):
+    self.kwargs = kwargs
+    self.ErrorStr = ''
+    self.error = ''
+
+  def get(self, var_list):
+    self.ErrorStr = self.error
+    var_list[0].val = b'WS-C2960'
+    var_list[0].type = 'OCTETSTR'
+
+  def getbulk(self, nonrepeaters, maxrepetitions, varlist):
+    self.ErrorStr = self.error
+    varlist[:] = [
+      FakeVarbind('.1.3.6.1.2.1.2.2.1.2', '1', b'Gi0/1', 'OCTETSTR'),
+      FakeVarbind('.1.3.6.1.2.1.2.2.1.3', '1', b'6', 'INTEGER'),
+    ]
+
+
+class TestNetsnmpImpl(unittest.TestCase):
+
+  def setUp(self):
+    self.sessions = []
+
+    def session(**kwargs):
+      self.sessions.append(FakeSession(**kwargs))
+      return self.sessions[-1]
+
+    netsnmp = types.ModuleType('netsnmp')
+    netsnmp.Session = session
+    netsnmp.Varbind = FakeVarbind
+    netsnmp.VarList = lambda *x: list(x)
+    netsnmp.Error = Exception
+    with mock.patch.dict(sys.modules, {'netsnmp': netsnmp}):
+      self.impl = snmpimpl.NetsnmpImpl()
+    self.target = target.SnmpTarget(
+        'dummy', 'test', {'test': {'version': 2, 'community': 'public'}})
+
+  def testSessionReuse(self):
+    self.assertEqual(self.impl.model(self.target), 'WS-C2960')
+    expected = {
+      '.1.3.6.1.2.1.2.2.1.2.1': snmp.ResultTuple('Gi0/1', 'OCTETSTR'),
+    }
+    self.assertEqual(self.impl.walk(self.target, '.1.3.6.1.2.1.2.2.1.2'),
+                     expected)
+    self.assertEqual(self.impl.walk(self.target, '.1.3.6.1.2.1.2.2.1.2'),
+                     expected)
+    self.impl.walk(self.target, '.1.3.6.1.2.1.2.2.1.2', vlan=10)
+    # One session for get, one for walks and one for the VLAN context
+    self.assertEqual(len(self.sessions), 3)
+    self.assertEqual(self.sessions[2].kwargs['Community'], 'public@10')
+    self.assertEqual(len(self.impl.sessions), 3)
+
+  def testFailedSessionIsDropped(self):
+    self.impl.walk(self.target, '.1.3.6.1.2.1.2.2.1.2')
+    self.sessions[0].error = 'Some error'
+    with self.assertRaises(snmp.SnmpError):
+      self.impl.walk(self.target, '.1.3.6.1.2.1.2.2.1.2')
+    self.assertEqual(len(self.impl.sessions), 0)
+    self.impl.walk(self.target, '.1.3.6.1.2.1.2.2.1.2')
+    self.assertEqual(len(self.sessions), 2)
+
+
+class TestSessionPool(unittest.TestCase):
+
+  def testCheckout(self):
+    pool = snmpimpl.SessionPool()
+    self.assertIsNone(pool.checkout('a'))
+    pool.checkin('a', 1)
+    pool.checkin('a', 2)
+    self.assertEqual(pool.checkout('a'), 2)
+    self.assertEqual(pool.checkout('a'), 1)
+    self.assertIsNone(pool.checkout('a'))
+
+  def testIdleTimeout(self):
+    pool = snmpimpl.SessionPool(idle_timeout=-1)
+    pool.checkin('a', 1)
+    self.assertIsNone(pool.checkout('a'))
+    self.assertEqual(len(pool), 0)
+
+  def testEvictLeastRecentlyUsed(self):
+    pool = snmpimpl.SessionPool(idle_timeout=60)
+    pool.checkin('a', 1)
+    pool.checkin('b', 2)
+    pool.checkin('a', 3)
+    self.assertEqual(list(pool.idle.keys()), ['b', 'a'])
+    # b and the first session of a have been idle for too long
+    pool.idle['b'] = [(0, 2)]
+    pool.idle['a'][0] = (0, 1)
+    self.assertEqual(pool.checkout('a'), 3)
+    self.assertEqual(len(pool), 0)
+
+  def testMaxSessions(self):
+    pool = snmpimpl.SessionPool(max_sessions=3)
+    pool.checkin('a', 1)
+    pool.checkin('b', 2)
+    pool.checkin('a', 3)
+    # b was used less recently than a, so its session goes
+    pool.checkin('c', 4)
+    self.assertEqual(len(pool), 3)
+    self.assertEqual(list(pool.idle.keys()), ['a', 'c'])
+    # Then the oldest session of a
+    pool.checkin('c', 5)
+    self.assertEqual(pool.checkout('a'), 3)
+    self.assertIsNone(pool.checkout('a'))
+    self.assertEqual(len(pool), 2)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,6 +1,15 @@
+import collections
 import time
 
 
+# Time spent on a request of a poll, like a model lookup or a subtree walk.
+# oid and vlan are None if they do not apply, as are the walk statistics:
+# the number of values, SNMP requests sent and the GETBULK size ended with.
+Span = collections.namedtuple('Span', (
+  'step', 'oid', 'vlan', 'seconds', 'varbinds', 'requests',
+  'max_repetitions'))
+
+
 class Error(Exception):
   """Generic error class for this module"""
 
@@ -18,9 +27,15 @@ class SnmpTarget(object):
     self.layer = layer
     self.full_host = "%s:%s" % (self.host, self.port)
     self.max_size = 256
+    # Subtree -> GETBULK max-repetitions the last walk completed with
+    self.max_repetitions = {}
     self.timeouts = 0
     self.errors = 0
     self.markers = []
+    # Spans of the poll, shared with copies made for concurrent walks
+    self.spans = []
+    # SNMP requests sent, counted by the SNMP implementations
+    self.requests = 0
 
   def _read_config(self, version, community=None,
       user=None, auth_proto=None, auth=None, priv_proto=None, priv=None,
@@ -47,6 +62,11 @@ class SnmpTarget(object):
   def done(self):
     self.markers.append(('done', time.time()))
 
+  def add_span(self, step, seconds, oid=None, vlan=None, varbinds=None,
+               requests=None, max_repetitions=None):
+    self.spans.append(
+        Span(step, oid, vlan, seconds, varbinds, requests, max_repetitions))
+
   def timeline(self):
     return [
         (fro[0], to[1] - fro[1])
@@ -0,0 +1,56 @@
+import urllib.request
+import yaml
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class InvalidTargets(Error):
+  """The target list could not be parsed."""
+
+
+# Labels that can carry the layer, the latter is what Prometheus would use
+# to pass it on as the layer parameter to /probe
+LAYER_LABELS = ('layer', '__param_layer')
+
+
+def parse(data, default_layer=None):
+  """Parse a target list, returns a sorted list of (host, layer).
+
+  The format is that of Prometheus file_sd and http_sd: a list of groups,
+  each with a list of targets and the labels that apply to them. JSON and
+  YAML are both accepted.
+  """
+  try:
+    groups = yaml.safe_load(data)
+  except yaml.YAMLError as e:
+    raise InvalidTargets('Could not parse target list: %s' % e)
+  if groups is None:
+    return []
+  if not isinstance(groups, list):
+    raise InvalidTargets('Target list is not a list of target groups')
+  targets = set()
+  for group in groups:
+    if not isinstance(group, dict) or 'targets' not in group:
+      raise InvalidTargets('Target group without targets: %s' % group)
+    labels = group.get('labels', None) or {}
+    layer = default_layer
+    for label in LAYER_LABELS:
+      layer = labels.get(label, layer)
+    if layer is None:
+      raise InvalidTargets('Target group without layer: %s' % group)
+    for host in group['targets']:
+      targets.add((str(host), str(layer)))
+  return sorted(targets)
+
+
+def load(source, default_layer=None, timeout=10):
+  """Load a target list from a file or a http(s) URL."""
+  if source.startswith('http://') or source.startswith('https://'):
+    with urllib.request.urlopen(source, timeout=timeout) as response:
+      data = response.read()
+  else:
+    with open(source, 'rb') as f:
+      data = f.read()
+  return parse(data, default_layer)
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+from snmpexporter import targets
+
+
+class TestTargets(unittest.TestCase):
+
+  def testParseJson(self):
+    self.assertEqual(targets.parse(
+      '[{"targets": ["sw2", "sw1"], "labels": {"layer": "access"}},'
+      ' {"targets": ["fw1"], "labels": {"__param_layer": "firewall"}}]'), [
+        ('fw1', 'firewall'), ('sw1', 'access'), ('sw2', 'access')])
+
+  def testParseYaml(self):
+    self.assertEqual(targets.parse(
+      '- targets: [sw1]\n'
+      '- targets: [sw1, sw2]\n'
+      '  labels: {layer: core}\n', default_layer='access'), [
+        ('sw1', 'access'), ('sw1', 'core'), ('sw2', 'core')])
+
+  def testInvalid(self):
+    for data in ('{"targets": []}', '[{"labels": {}}]', '[{"targets": [1]}]',
+                 '[{'):
+      with self.assertRaises(targets.InvalidTargets):
+        targets.parse(data)
+    self.assertEqual(targets.parse(''), [])
+
+  def testLoadFile(self):
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+      f.write('[{"targets": ["sw1"], "labels": {"layer": "access"}}]')
+    try:
+      self.assertEqual(targets.load(f.name), [('sw1', 'access')])
+    finally:
+      os.unlink(f.name)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,303 @@
+import collections
+import hashlib
+import hmac
+import itertools
+import os
+import time
+
+from snmpexporter import ber
+
+
+# (hash, length of the truncated HMAC) as per RFC 3414 and RFC 7860
+AUTH_PROTOCOLS = {
+  'MD5': (hashlib.md5, 12),
+  'SHA': (hashlib.sha1, 12),
+  'SHA-224': (hashlib.sha224, 16),
+  'SHA-256': (hashlib.sha256, 24),
+  'SHA-384': (hashlib.sha384, 32),
+  'SHA-512': (hashlib.sha512, 48),
+}
+
+PRIV_PROTOCOLS = set(['DES', 'AES'])
+
+SEC_LEVELS = {
+  'noAuthNoPriv': (False, False),
+  'authNoPriv': (True, False),
+  'authPriv': (True, True),
+}
+
+# msgFlags
+FLAG_AUTH = 0x01
+FLAG_PRIV = 0x02
+FLAG_REPORTABLE = 0x04
+
+USM_SECURITY_MODEL = 3
+MAX_MESSAGE_SIZE = 65507
+
+# Report OIDs in usmStats
+UNSUPPORTED_SEC_LEVELS = '.1.3.6.1.6.3.15.1.1.1.0'
+NOT_IN_TIME_WINDOWS = '.1.3.6.1.6.3.15.1.1.2.0'
+UNKNOWN_USER_NAMES = '.1.3.6.1.6.3.15.1.1.3.0'
+UNKNOWN_ENGINE_IDS = '.1.3.6.1.6.3.15.1.1.4.0'
+WRONG_DIGESTS = '.1.3.6.1.6.3.15.1.1.5.0'
+DECRYPTION_ERRORS = '.1.3.6.1.6.3.15.1.1.6.0'
+
+
+Message = collections.namedtuple('Message', (
+  'msg_id', 'flags', 'engine_id', 'engine_boots', 'engine_time', 'user',
+  'context_engine_id', 'context', 'pdu'))
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+class AuthenticationError(Error):
+  """A message failed authentication or decryption."""
+
+
+# Salts only have to be unique per key, so one counter for the process is
+# enough. Start somewhere random to not repeat salts across restarts.
+_salts = itertools.count(int.from_bytes(os.urandom(4), 'big'))
+
+
+def password_to_key(password, auth_proto):
+  """Turn a password into a key (RFC 3414 A.2)."""
+  hash_fn, _ = AUTH_PROTOCOLS[auth_proto]
+  password = password.encode() if isinstance(password, str) else password
+  if not password:
+    raise Error('Empty USM password')
+  repeated = password * (1048576 // len(password) + 1)
+  return hash_fn(repeated[:1048576]).digest()
+
+
+def localize_key(key, engine_id, auth_proto):
+  hash_fn, _ = AUTH_PROTOCOLS[auth_proto]
+  return hash_fn(key + engine_id + key).digest()
+
+
+class Engine(object):
+  """What we know about an authoritative SNMP engine."""
+
+  def __init__(self, engine_id=b'', boots=0, engine_time=0):
+    self.engine_id = engine_id
+    self.update(boots, engine_time)
+
+  def update(self, boots, engine_time):
+    self.boots = boots
+    self.time_base = time.monotonic() - engine_time
+
+  @property
+  def time(self):
+    return int(time.monotonic() - self.time_base)
+
+
+class User(object):
+  """USM user with its keys, localized per authoritative engine."""
+
+  def __init__(self, name, sec_level=None, auth_proto=None, auth=None,
+               priv_proto=None, priv=None):
+    if sec_level is None:
+      sec_level = 'authPriv' if priv else ('authNoPriv' if auth else
+                                           'noAuthNoPriv')
+    if sec_level not in SEC_LEVELS:
+      raise Error('Unknown security level %s' % sec_level)
+    self.name = name.encode() if isinstance(name, str) else name
+    self.use_auth, self.use_priv = SEC_LEVELS[sec_level]
+    self.auth_proto = (auth_proto or 'MD5').upper()
+    self.priv_proto = (priv_proto or 'DES').upper()
+    if self.use_auth and self.auth_proto not in AUTH_PROTOCOLS:
+      raise Error('Unsupported authentication protocol %s' % auth_proto)
+    if self.use_priv and self.priv_proto not in PRIV_PROTOCOLS:
+      raise Error('Unsupported privacy protocol %s' % priv_proto)
+    self.auth_key = password_to_key(auth, self.auth_proto) if (
+        self.use_auth) else None
+    self.priv_key = password_to_key(priv, self.auth_proto) if (
+        self.use_priv) else None
+    self.localized = {}
+
+  @property
+  def flags(self):
+    return (FLAG_AUTH if self.use_auth else 0) | (
+        FLAG_PRIV if self.use_priv else 0)
+
+  @property
+  def auth_length(self):
+    return AUTH_PROTOCOLS[self.auth_proto][1] if self.use_auth else 0
+
+  def keys(self, engine_id):
+    if engine_id not in self.localized:
+      self.localized[engine_id] = (
+        localize_key(self.auth_key, engine_id, self.auth_proto) if (
+          self.auth_key) else None,
+        localize_key(self.priv_key, engine_id, self.auth_proto) if (
+          self.priv_key) else None)
+    return self.localized[engine_id]
+
+  def sign(self, auth_key, data):
+    hash_fn, length = AUTH_PROTOCOLS[self.auth_proto]
+    return hmac.new(auth_key, data, hash_fn).digest()[:length]
+
+  def encrypt(self, priv_key, boots, engine_time, data):
+    salt = next(_salts)
+    if self.priv_proto == 'DES':
+      salt = (boots.to_bytes(4, 'big') +
+              (salt & 0xffffffff).to_bytes(4, 'big'))
+      iv = bytes(a ^ b for a, b in zip(priv_key[8:16], salt))
+      data = data + bytes(-len(data) % 8)
+      encryptor = _cipher(self.priv_proto, priv_key, iv).encryptor()
+    else:
+      salt = (salt & 0xffffffffffffffff).to_bytes(8, 'big')
+      iv = boots.to_bytes(4, 'big') + engine_time.to_bytes(4, 'big') + salt
+      encryptor = _cipher(self.priv_proto, priv_key, iv).encryptor()
+    return encryptor.update(data) + encryptor.finalize(), salt
+
+  def decrypt(self, priv_key, boots, engine_time, salt, data):
+    if len(salt) != 8:
+      raise AuthenticationError('Bad privacy parameters')
+    if self.priv_proto == 'DES':
+      if len(data) % 8:
+        raise AuthenticationError('Encrypted data is not a multiple of 8')
+      iv = bytes(a ^ b for a, b in zip(priv_key[8:16], salt))
+    else:
+      iv = boots.to_bytes(4, 'big') + engine_time.to_bytes(4, 'big') + salt
+    decryptor = _cipher(self.priv_proto, priv_key, iv).decryptor()
+    return decryptor.update(data) + decryptor.finalize()
+
+
+def _cipher(priv_proto, priv_key, iv):
+  # Privacy is optional so only require cryptography when it is used
+  from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+  # DES and CFB are only available as "decrepit" in newer versions
+  try:
+    from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+  except ImportError:
+    TripleDES = algorithms.TripleDES
+  try:
+    from cryptography.hazmat.decrepit.ciphers.modes import CFB
+  except ImportError:
+    CFB = modes.CFB
+  if priv_proto == 'DES':
+    # 3DES with K1 = K2 = K3 is single DES
+    return Cipher(TripleDES(priv_key[:8]), modes.CBC(iv))
+  return Cipher(algorithms.AES(priv_key[:16]), CFB(iv))
+
+
+def encode_message(msg_id, user, engine, context, pdu, reportable=True):
+  """Encode a SNMPv3 USM message.
+
+  An unauthenticated message for engine discovery is sent if user is None.
+  """
+  flags = user.flags if user else 0
+  if reportable:
+    flags |= FLAG_REPORTABLE
+  scoped_pdu = ber.encode_sequence(
+      ber.encode_octets(engine.engine_id), ber.encode_octets(context or b''),
+      ber.encode_pdu(pdu))
+
+  # The engine time moves on, so read it once. The agent decrypts with the
+  # values in the message.
+  boots, engine_time = engine.boots, engine.time
+  auth_key = priv_key = None
+  if user and (user.use_auth or user.use_priv):
+    auth_key, priv_key = user.keys(engine.engine_id)
+  priv_params = b''
+  if flags & FLAG_PRIV:
+    encrypted, priv_params = user.encrypt(
+        priv_key, boots, engine_time, scoped_pdu)
+    data = ber.encode_octets(encrypted)
+  else:
+    data = scoped_pdu
+
+  auth_length = user.auth_length if user else 0
+  security_prefix = b''.join((
+      ber.encode_octets(engine.engine_id),
+      ber.encode_integer(boots),
+      ber.encode_integer(engine_time),
+      ber.encode_octets(user.name if user else b'')))
+  auth_params = ber.encode_octets(bytes(auth_length))
+  security_items = b''.join(
+      (security_prefix, auth_params, ber.encode_octets(priv_params)))
+  security = ber.encode_sequence(security_items)
+  security_octets = ber.encode_octets(security)
+
+  version = ber.encode_integer(ber.VERSION_3)
+  header = ber.encode_sequence(
+      ber.encode_integer(msg_id), ber.encode_integer(MAX_MESSAGE_SIZE),
+      ber.encode_octets(bytes((flags,))),
+      ber.encode_integer(USM_SECURITY_MODEL))
+  body = b''.join((version, header, security_octets, data))
+  message = ber.encode_tlv(ber.SEQUENCE, body)
+
+  if not flags & FLAG_AUTH:
+    return message
+
+  # Calculate where the zeroed authentication parameters ended up and
+  # replace them with the HMAC of the whole message.
+  offset = (len(message) - len(body) + len(version) + len(header) +
+            len(security_octets) - len(security) +
+            len(security) - len(security_items) +
+            len(security_prefix) + len(auth_params) - auth_length)
+  signature = user.sign(auth_key, message)
+  return b''.join(
+      (message[:offset], signature, message[offset + auth_length:]))
+
+
+def decode_message(data, user):
+  """Decode, authenticate and decrypt a SNMPv3 USM message."""
+  message = ber.decode_tlv(data)
+  items = ber.decode_sequence(data, message[1], message[2])
+  if len(items) != 4:
+    raise ber.DecodeError('SNMPv3 message has %d fields' % len(items))
+  version, header, security, scoped = items
+  if ber.decode_integer(ber.expect(data, version, ber.INTEGER)) != 3:
+    raise ber.DecodeError('Not a SNMPv3 message')
+
+  header = ber.decode_sequence(data, header[1], header[2])
+  msg_id = ber.decode_integer(ber.expect(data, header[0], ber.INTEGER))
+  flags = ber.expect(data, header[2], ber.OCTET_STRING)
+  flags = flags[0] if flags else 0
+
+  ber.expect(data, security, ber.OCTET_STRING)
+  security = ber.decode_tlv(data, security[1])
+  params = ber.decode_sequence(data, security[1], security[2])
+  if len(params) != 6:
+    raise ber.DecodeError('USM parameters have %d fields' % len(params))
+  engine_id = bytes(ber.expect(data, params[0], ber.OCTET_STRING))
+  boots = ber.decode_integer(ber.expect(data, params[1], ber.INTEGER))
+  engine_time = ber.decode_integer(ber.expect(data, params[2], ber.INTEGER))
+  user_name = bytes(ber.expect(data, params[3], ber.OCTET_STRING))
+  auth_params = bytes(ber.expect(data, params[4], ber.OCTET_STRING))
+  priv_params = bytes(ber.expect(data, params[5], ber.OCTET_STRING))
+
+  auth_key = priv_key = None
+  if flags & (FLAG_AUTH | FLAG_PRIV):
+    if user is None or user.name != user_name or not user.use_auth:
+      raise AuthenticationError('Unexpected authenticated message')
+    auth_key, priv_key = user.keys(engine_id)
+
+  if flags & FLAG_AUTH:
+    zeroed = bytearray(data)
+    zeroed[params[4][1]:params[4][2]] = bytes(len(auth_params))
+    if not hmac.compare_digest(user.sign(auth_key, bytes(zeroed)),
+                               auth_params):
+      raise AuthenticationError('Wrong digest')
+
+  if flags & FLAG_PRIV:
+    if not user.use_priv:
+      raise AuthenticationError('Unexpected encrypted message')
+    plain = user.decrypt(priv_key, boots, engine_time, priv_params,
+                         bytes(ber.expect(data, scoped, ber.OCTET_STRING)))
+    scoped_data = plain
+    scoped = ber.decode_tlv(plain)
+  else:
+    scoped_data = data
+
+  fields = ber.decode_sequence(scoped_data, scoped[1], scoped[2])
+  if len(fields) != 3:
+    raise ber.DecodeError('Scoped PDU has %d fields' % len(fields))
+  return Message(
+      msg_id, flags, engine_id, boots, engine_time, user_name,
+      bytes(ber.expect(scoped_data, fields[0], ber.OCTET_STRING)),
+      bytes(ber.expect(scoped_data, fields[1], ber.OCTET_STRING)),
+      ber.decode_pdu(scoped_data, fields[2]))
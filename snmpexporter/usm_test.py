@@ -0,0 +1,100 @@
+import unittest
+
+from snmpexporter import ber
+from snmpexporter import usm
+
+
+ENGINE_ID = bytes.fromhex('000000000000000000000002')
+
+
+class TestKeys(unittest.TestCase):
+
+  def testRfc3414Md5(self):
+    key = usm.password_to_key('maplesyrup', 'MD5')
+    self.assertEqual(key.hex(), '9faf3283884e92834ebc9847d8edd963')
+    self.assertEqual(usm.localize_key(key, ENGINE_ID, 'MD5').hex(),
+                     '526f5eed9fcce26f8964c2930787d82b')
+
+  def testRfc3414Sha(self):
+    key = usm.password_to_key('maplesyrup', 'SHA')
+    self.assertEqual(key.hex(), '9fb5cc0381497b3793528939ff788d5d79145211')
+    self.assertEqual(usm.localize_key(key, ENGINE_ID, 'SHA').hex(),
+                     '6695febc9288e36282235fc7151f128497b38f3f')
+
+
+class TestMessages(unittest.TestCase):
+
+  def roundtrip(self, user):
+    engine = usm.Engine(ENGINE_ID, 3, 1000)
+    pdu = ber.Pdu(ber.GET_BULK_REQUEST, 42, 0, 10, [
+      ('.1.3.6.1.2.1.2.2.1.2', ber.NULL, None)])
+    message = usm.encode_message(42, user, engine, b'vlan-10', pdu)
+    self.assertEqual(ber.message_id(message), (ber.VERSION_3, 42))
+    decoded = usm.decode_message(message, user)
+    self.assertEqual(decoded.pdu, pdu)
+    self.assertEqual(decoded.context, b'vlan-10')
+    self.assertEqual(decoded.engine_id, ENGINE_ID)
+    self.assertEqual(decoded.engine_boots, 3)
+    return message
+
+  def testNoAuth(self):
+    self.roundtrip(usm.User('user'))
+
+  def testAuth(self):
+    for proto in usm.AUTH_PROTOCOLS:
+      user = usm.User('user', 'authNoPriv', proto, 'authpass')
+      message = bytearray(self.roundtrip(user))
+      # Flip a bit in the PDU
+      message[-1] ^= 1
+      with self.assertRaises(usm.AuthenticationError):
+        usm.decode_message(bytes(message), user)
+
+  def testWrongPassword(self):
+    user = usm.User('user', 'authNoPriv', 'SHA', 'authpass')
+    message = self.roundtrip(user)
+    with self.assertRaises(usm.AuthenticationError):
+      usm.decode_message(
+          message, usm.User('user', 'authNoPriv', 'SHA', 'wrongpass'))
+
+  def testPriv(self):
+    try:
+      import cryptography
+    except ImportError:
+      self.skipTest('cryptography is not installed')
+    for proto in usm.PRIV_PROTOCOLS:
+      user = usm.User('user', 'authPriv', 'SHA', 'authpass', proto,
+                      'privpass')
+      message = self.roundtrip(user)
+      self.assertNotIn(b'vlan-10', message)
+
+  def testPrivTimeMovesOn(self):
+    try:
+      import cryptography
+    except ImportError:
+      self.skipTest('cryptography is not installed')
+    user = usm.User('user', 'authPriv', 'SHA', 'authpass', 'AES', 'privpass')
+    pdu = ber.Pdu(ber.GET_REQUEST, 42, 0, 0, [
+      ('.1.3.6.1.2.1.1.3.0', ber.NULL, None)])
+    ticks = iter(range(1000, 2000))
+
+    class MovingEngine(usm.Engine):
+      # A second passes every time the time is read
+      @property
+      def time(self):
+        return next(ticks)
+
+    message = usm.encode_message(
+        42, user, MovingEngine(ENGINE_ID, 3, 1000), b'', pdu)
+    self.assertEqual(usm.decode_message(message, user).pdu, pdu)
+
+  def testUnsupported(self):
+    with self.assertRaises(usm.Error):
+      usm.User('user', 'authPriv', 'SHA', 'authpass', 'AES256', 'privpass')
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
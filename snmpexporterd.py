@@ -1,25 +1,144 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import collections
 from concurrent import futures
-import functools
+import itertools
 import logging
+import multiprocessing
 import objgraph
+import random
+import signal
 import sys
-import threading
+import time
 
 import snmpexporter
+import snmpexporter.cache
+import snmpexporter.compression
 import snmpexporter.config
+import snmpexporter.exposition
+import snmpexporter.metrics
+import snmpexporter.mibcache
 import snmpexporter.prometheus
+import snmpexporter.recording
+import snmpexporter.targets
 
-from twisted.internet import reactor, task, endpoints
-from twisted.python import log
+from twisted.internet import reactor, task, endpoints, interfaces
+from twisted.internet import defer, threads
+from twisted.python import failure, log
 from twisted.web import server, resource
+from zope.interface import implementer
+
+
+class Error(Exception):
+  """Base error class for this module."""
+
+
+# The SNMP implementation, walk plan cache, GETBULK sizes and cached subtrees
+# used by poll().
+# Poller processes get their own through init_poller, poller threads all
+# share the ones in the daemon.
+snmpimpl = None
+plan_cache = None
+repetitions = None
+subtrees = None
+backoff = None
+
+# MIB resolver, and the annotator and exporter of the current generation,
+# for processes that annotate, see --annotate-in
+resolver = None
+annotator_snapshot = (0, None, None)
+
+# The daemon publishes the current (generation, config, collections hash)
+# in config_store, and poll() fetches it from there once per generation.
+config_store = None
+config_snapshot = (0, None, None)
+
+# How long to remember GETBULK sizes of hosts that are no longer polled
+REPETITIONS_TTL = 24 * 3600
+# Seconds between removing expired subtrees from the cache
+SUBTREE_EXPIRE_INTERVAL = 300
+# Seconds to keep counting bytes sent to a target after its last response,
+# and between looking for targets past that
+RESPONSE_BYTES_TTL = 3600
+RESPONSE_BYTES_EXPIRE_INTERVAL = 300
+
+# Metrics of the daemon itself, served on /metrics
+METRICS = snmpexporter.metrics.Registry()
+STAGE_SECONDS = METRICS.histogram(
+    'snmp_export_stage_duration_seconds',
+    'Time taken by a stage of a scrape: poll, annotate or render',
+    ('stage',))
+EXECUTOR_WAIT = METRICS.histogram(
+    'snmp_export_executor_wait_seconds',
+    'Time tasks waited for a free worker', ('executor',))
+EXECUTOR_TASKS = METRICS.gauge(
+    'snmp_export_executor_tasks',
+    'Tasks submitted to an executor that are queued or running. A process '
+    'pool runs the task it hands to a process next as well',
+    ('executor', 'state'))
+EXECUTOR_WORKERS = METRICS.gauge(
+    'snmp_export_executor_workers', 'Workers of an executor', ('executor',))
+INFLIGHT_SCRAPES = METRICS.gauge(
+    'snmp_export_inflight_scrapes', 'Scrapes being polled or annotated')
+SCRAPES = METRICS.counter(
+    'snmp_export_scrapes_total', 'Finished scrapes by result',
+    ('layer', 'result'))
+SNMP_TIMEOUTS = METRICS.counter(
+    'snmp_export_snmp_timeouts_total', 'SNMP timeouts while polling',
+    ('layer',))
+SNMP_ERRORS = METRICS.counter(
+    'snmp_export_snmp_errors_total', 'SNMP errors while polling', ('layer',))
+RESPONSE_BYTES = METRICS.counter(
+    'snmp_export_response_bytes_total',
+    'Bytes of /probe responses written, after compression',
+    ('target', 'layer'))
+
+
+def init_poller(snmp_impl, store, plan_store, plan_cache_ttl,
+                repetitions_store, subtree_stores, backoff_store,
+                resolver_cache_size=None, replay=None):
+  global snmpimpl
+  global config_store
+  global plan_cache
+  global repetitions
+  global subtrees
+  global backoff
+  global resolver
+  config_store = store
+  if replay is not None:
+    filename, speed = replay
+    logging.debug('Replaying %s at speed %s', filename, speed)
+    snmpimpl = snmpexporter.recording.ReplayImpl(
+        snmpexporter.recording.Recording.load(filename), speed)
+  else:
+    logging.debug('Initializing %s SNMP implemention', snmp_impl)
+    snmpimpl = snmpexporter.snmpimpl.IMPLEMENTATIONS[snmp_impl]()
+  if plan_cache_ttl > 0:
+    plan_cache = snmpexporter.cache.TtlCache(plan_cache_ttl, plan_store)
+  repetitions = snmpexporter.poller.MaxRepetitions(
+      snmpexporter.cache.TtlCache(REPETITIONS_TTL, repetitions_store))
+  subtrees = snmpexporter.cache.TtlCache(0, *subtree_stores)
+  backoff = snmpexporter.poller.VlanBackoff(backoff_store)
+  if resolver_cache_size is not None:
+    # Annotating in the poller. The MIB resolver cannot share a process
+    # with net-snmp, see ForkedResolver.
+    if snmp_impl == 'netsnmp':
+      mibs = snmpexporter.ForkedResolver()
+    else:
+      import mibresolver as mibs
+    resolver = snmpexporter.mibcache.MibCache(
+        mibs, max_size=resolver_cache_size)
 
 
-# As we're using multiprocessing it's probably not needed for this to be
-# thread-local, but why not.
-tls = threading.local()
-tls.snmpimpl = None
+def init_annotator(store, resolver_cache_size):
+  global config_store
+  global resolver
+  logging.debug('Initializing annotator process')
+  config_store = store
+  import mibresolver
+  resolver = snmpexporter.mibcache.MibCache(
+      mibresolver, max_size=resolver_cache_size)
 
 
 # Used to test health of the executors
@@ -27,115 +146,584 @@ def do_nothing():
   pass
 
 
-def poll(config, host, layer):
-  try:
-    if not tls.snmpimpl:
-      logging.debug('Initializing Net-SNMP implemention')
-      tls.snmpimpl = snmpexporter.snmpimpl.NetsnmpImpl()
+def poller_snapshot(generation):
+  """Returns (generation, config, collections hash), in a poller."""
+  global config_snapshot
+  if config_snapshot[0] < generation:
+    config_snapshot = config_store['snapshot']
+    logging.debug('Using configuration generation %d', config_snapshot[0])
+  return config_snapshot
+
+
+def poller_config(generation):
+  return poller_snapshot(generation)[1]
+
+
+def worker_annotator(generation):
+  """Returns the annotator of a generation, in a poller or annotator."""
+  global annotator_snapshot
+  if annotator_snapshot[0] != generation:
+    config = poller_config(generation)
+    logging.debug('Creating annotator for generation %d', generation)
+    annotator_snapshot = (
+        generation,
+        snmpexporter.annotator.Annotator(config['annotator'], resolver),
+        snmpexporter.prometheus.Exporter(config['exporter']))
+  return annotator_snapshot[1]
+
 
-    collections = config['collection']
-    overrides = config['override']
-    snmp_creds = config['snmp']
+def worker_exporter(generation):
+  """Returns the exporter of a generation, in an annotator."""
+  worker_annotator(generation)
+  return annotator_snapshot[2]
 
-    logging.debug('Constructing SNMP target')
-    target = snmpexporter.target.SnmpTarget(host, layer, snmp_creds)
 
-    target.start('poll')
+def make_poller(config, collections_hash, host, layer):
+  """Returns (poller, target) for polling a target."""
+  collections = config['collection']
+  overrides = config['override']
+  snmp_creds = config['snmp']
 
-    logging.debug('Creating SNMP poller')
-    poller = snmpexporter.poller.Poller(collections, overrides, tls.snmpimpl)
+  logging.debug('Constructing SNMP target')
+  target = snmpexporter.target.SnmpTarget(host, layer, snmp_creds)
+
+  target.start('poll')
+
+  logging.debug('Creating SNMP poller')
+  poller = snmpexporter.poller.Poller(
+      collections, overrides, snmpimpl, backoff=backoff,
+      plan_cache=plan_cache, repetitions=repetitions, subtrees=subtrees,
+      collections_hash=collections_hash)
+  return poller, target
+
+
+def poll(generation, host, layer):
+  try:
+    _, config, collections_hash = poller_snapshot(generation)
+    poller, target = make_poller(config, collections_hash, host, layer)
 
     logging.debug('Starting poll')
     data, timeouts, errors = poller.poll(target)
     target.add_timeouts(timeouts)
     target.add_errors(errors)
+    return target, data
+  except:
+    logging.exception('Poll exception')
+    raise
+
+
+async def poll_async(config, collections_hash, host, layer):
+  """Like poll, on the event loop of an asynchronous SNMP implementation."""
+  try:
+    poller, target = make_poller(config, collections_hash, host, layer)
 
+    logging.debug('Starting poll')
+    data, timeouts, errors = await poller.poll_async(target)
+    target.add_timeouts(timeouts)
+    target.add_errors(errors)
     return target, data
+  except asyncio.CancelledError:
+    raise
   except:
     logging.exception('Poll exception')
     raise
 
 
-def annotate(config, resolver, f):
+def annotate(annotator, f):
   try:
     target, data = f
 
-    annotator_config = config['annotator']
-    exporter_config = config['exporter']
-
     target.start('annotate')
 
-    logging.debug('Creating result annotator')
-    annotator = snmpexporter.annotator.Annotator(annotator_config, resolver)
-
     logging.debug('Starting annotation')
     result = annotator.annotate(data)
 
     target.done()
 
-    exporter = snmpexporter.prometheus.Exporter(exporter_config)
-    return exporter.export(target, result)
+    return target, result
   except:
     logging.exception('Annotate exception')
     raise
 
 
-class PollerResource(resource.Resource):
-  isLeaf = True
+def poll_and_annotate(generation, host, layer):
+  return annotate(worker_annotator(generation),
+                  poll(generation, host, layer))
 
-  def __init__(self, config_file, poller_pool, annotator_pool):
-    super(PollerResource).__init__()
-    # Use process pollers as netsnmp is not behaving well using just threads
-    logging.debug('Starting poller pool ...')
-    self.poller_executor = futures.ProcessPoolExecutor(
-        max_workers=poller_pool)
-    # Start MIB resolver after processes above (or it will fork it as well)
-    logging.debug('Initializing MIB resolver ...')
-    import mibresolver
-    self.resolver = mibresolver
 
-    logging.debug('Starting annotation pool ...')
-    # .. but annotators are just CPU, so use lightweight threads.
-    self.annotator_executor = futures.ThreadPoolExecutor(
-        max_workers=annotator_pool)
-    self.config_file = config_file
+def annotate_in_worker(generation, f):
+  return annotate(worker_annotator(generation), f)
 
-  def _response_failed(self, err, f):
-    logging.debug('Request cancelled, cancelling future %s', f)
-    f.cancel()
 
-  def _reactor_annotate_done(self, request, f):
-    reactor.callFromThread(self._annotate_done, request, f)
+def render_chunks(exporter, target, result, encoder, encoding, level,
+                  extra=()):
+  """Returns the chunks of a response, encoded and compressed."""
+  chunks = encoder.chunks(
+      itertools.chain(exporter.families(target, result), extra))
+  if encoding is not None:
+    chunks = snmpexporter.compression.compress_chunks(
+        chunks, snmpexporter.compression.compressor(encoding, level))
+  return chunks
 
-  def _annotate_done(self, request, f):
-    if f.exception():
-      logging.error('Annotator failed: %s', repr(f.exception()))
-      request.setResponseCode(500, message=(
-          'Annotator failed: %s' % repr(f.exception())).encode())
-      request.finish()
+
+def annotate_and_render(generation, f, content_type, encoding, level):
+  """Annotates and renders poll results in an annotator process.
+
+  Returns (target, chunks, seconds spent rendering). Only the bytes of
+  the response go back to the daemon, not the annotated results.
+  """
+  target, result = annotate_in_worker(generation, f)
+  start = time.monotonic()
+  chunks = list(render_chunks(
+      worker_exporter(generation), target, result,
+      snmpexporter.exposition.encoder_for(content_type), encoding, level))
+  return target, chunks, time.monotonic() - start
+
+
+def drain(chunks):
+  """Yields the chunks of a list, letting go of each once yielded."""
+  chunks = collections.deque(chunks)
+  while chunks:
+    yield chunks.popleft()
+
+
+# What a scrape results in. If several requests wait for the scrape, the
+# responses rendered from it are shared through renders, (content type,
+# encoding) -> snmpexporter.exposition.SharedChunks. Otherwise it is None.
+# Responses rendered by an annotator process are only in renders, and
+# exporter and result are None.
+Scraped = collections.namedtuple(
+  'Scraped', ('exporter', 'target', 'result', 'renders'))
+
+
+# Executor -> {future of a task that is not done: whether it runs on an
+# event loop}, to count the tasks in EXECUTOR_TASKS when rendering. Futures
+# of coroutines only tell they ran once done, and never wait in a queue.
+pending_tasks = {}
+
+
+def executor_tasks(pool):
+  """Returns the dict to add the futures of an executor's tasks to."""
+  if pool not in pending_tasks:
+    tasks = pending_tasks[pool] = {}
+    EXECUTOR_TASKS.labels(pool, 'queued').set_function(lambda: sum(
+        1 for f, on_loop in tasks.items()
+        if not on_loop and not f.running() and not f.done()))
+    EXECUTOR_TASKS.labels(pool, 'running').set_function(lambda: sum(
+        1 for f, on_loop in tasks.items() if on_loop or f.running()))
+  return pending_tasks[pool]
+
+
+def call_timed(fn, *args):
+  """Returns (when fn started, its result), to measure executor waits."""
+  return time.time(), fn(*args)
+
+
+def submit(executor, fn, *args, pool=None):
+  """Run fn in an executor, returns a Deferred firing in the reactor.
+
+  Cancelling the Deferred cancels the call if it has not started yet. The
+  executor metrics are labelled with pool.
+  """
+  submitted = time.time()
+  tasks = executor_tasks(pool or 'other')
+  f = executor.submit(call_timed, fn, *args)
+  tasks[f] = False
+  d = defer.Deferred(canceller=lambda d: f.cancel())
+
+  def done(f):
+    tasks.pop(f, None)
+    if not f.cancelled() and f.exception() is None:
+      started, result = f.result()
+      EXECUTOR_WAIT.labels(pool or 'other').observe(
+          max(0.0, started - submitted))
+    # The Deferred has already failed if it was cancelled
+    if d.called:
       return
+    if f.cancelled():
+      d.cancel()
+    elif f.exception() is not None:
+      d.errback(f.exception())
+    else:
+      d.callback(result)
 
-    for row in f.result():
-      request.write(row.encode())
-      request.write('\n'.encode())
-    request.finish()
+  f.add_done_callback(lambda f: reactor.callFromThread(done, f))
+  return d
 
-  def _reactor_poll_done(self, config, request, f):
-    reactor.callFromThread(self._poll_done, config, request, f)
 
-  def _poll_done(self, config, request, f):
-    if f.exception():
-      logging.error('Poller failed: %s', repr(f.exception()))
-      request.setResponseCode(500, message=(
-          'Poller failed: %s' % repr(f.exception())).encode())
-      request.finish()
+def run_on_loop(loop, coro, pool=None):
+  """Run a coroutine on an asyncio loop, returns a Deferred like submit.
+
+  Cancelling the Deferred cancels the coroutine.
+  """
+  tasks = executor_tasks(pool or 'other')
+  f = asyncio.run_coroutine_threadsafe(coro, loop)
+  tasks[f] = True
+  d = defer.Deferred(canceller=lambda d: f.cancel())
+
+  def done(f):
+    tasks.pop(f, None)
+    # The Deferred has already failed if it was cancelled
+    if d.called:
       return
+    if f.cancelled():
+      d.cancel()
+    elif f.exception() is not None:
+      d.errback(f.exception())
+    else:
+      d.callback(f.result())
+
+  f.add_done_callback(lambda f: reactor.callFromThread(done, f))
+  return d
+
+
+@implementer(interfaces.IPullProducer)
+class ChunkProducer(object):
+  """Writes chunks of bytes to a request as fast as the client reads them.
+
+  The chunks are produced lazily, so a slow client never makes us hold
+  more than a chunk or so of its response in memory.
+  """
 
+  def __init__(self, request, chunks, written=None):
+    super(ChunkProducer, self).__init__()
+    self.request = request
+    self.chunks = iter(chunks)
+    # Counter of the bytes written
+    self.written = written
+
+  def start(self):
+    # Twisted calls resumeProducing whenever it wants more data
+    self.request.registerProducer(self, False)
+
+  def resumeProducing(self):
+    try:
+      chunk = next(self.chunks)
+    except StopIteration:
+      self.request.unregisterProducer()
+      self.request.finish()
+      return
+    except Exception:
+      # Too late to change the response code, cut the response short
+      logging.exception('Failed to produce response')
+      self.request.unregisterProducer()
+      self.request.loseConnection()
+      return
+    self.request.write(chunk)
+    if self.written is not None:
+      self.written.inc(len(chunk))
+
+  def stopProducing(self):
+    logging.debug('Client went away, dropping the rest of the response')
+    if hasattr(self.chunks, 'close'):
+      self.chunks.close()
+
+
+class PollerResource(resource.Resource):
+  isLeaf = True
+
+  def __init__(self, config_file, poller_pool, annotator_pool,
+               resolver_cache_size, snmp_impl, plan_cache_ttl,
+               compression=(), compression_levels=None,
+               annotate_in='thread', replay=None, openmetrics=False):
+    super(PollerResource).__init__()
+    # Response formats offered to clients
+    self.encoders = snmpexporter.exposition.ENCODERS
+    if openmetrics:
+      self.encoders = snmpexporter.exposition.OPENMETRICS_ENCODERS
+    # Content-Encodings we offer, in order of preference
+    self.compression = compression
+    # Content-Encoding -> level, the default of the encoding if missing
+    self.compression_levels = compression_levels or {}
+    # Where results are annotated: 'thread', 'poller' or 'process'
+    self.annotate_in = annotate_in
+    poller_resolver_cache_size = (
+        resolver_cache_size if annotate_in == 'poller' else None)
+    logging.debug('Loading configuration ...')
+    self.config = snmpexporter.config.ConfigWatcher(config_file)
+    # Generation last published to the pollers, and annotator and exporter
+    # built from it
+    self.published = 0
+    self.compiled = (0, None, None)
+
+    if snmp_impl == 'netsnmp' or annotate_in == 'process':
+      # Share the configuration with the worker processes
+      self.manager = multiprocessing.Manager()
+      self.config_store = self.manager.dict()
+    else:
+      self.config_store = {}
+
+    logging.debug('Starting poller pool ...')
+    if snmp_impl == 'netsnmp':
+      # Share what we learn about targets between the poller processes
+      plan_store = self.manager.dict()
+      repetitions_store = self.manager.dict()
+      # Subtrees and their expiry times, so that expiring them does not
+      # have to load every subtree over the manager connection
+      subtree_stores = (self.manager.dict(), self.manager.dict())
+      # VLANs that timed out, so that every poller process skips them
+      backoff_store = self.manager.dict()
+      # Use process pollers as netsnmp is not behaving well using just threads
+      self.poller_executor = futures.ProcessPoolExecutor(
+          max_workers=poller_pool, initializer=init_poller,
+          initargs=(snmp_impl, self.config_store, plan_store, plan_cache_ttl,
+                    repetitions_store, subtree_stores, backoff_store,
+                    poller_resolver_cache_size, replay))
+    else:
+      # The other implementations are fine to share between threads, and
+      # spend most of their time waiting for the network.
+      subtree_stores = ({}, {})
+      init_poller(snmp_impl, self.config_store, {}, plan_cache_ttl, {},
+                  subtree_stores, {}, poller_resolver_cache_size, replay)
+      self.poller_executor = futures.ThreadPoolExecutor(
+          max_workers=poller_pool)
+    # Polls with an asynchronous SNMP implementation all run on its event
+    # loop, the poller pool is then only used for health checks
+    self.poll_loop = None
+    if hasattr(snmpimpl, 'event_loop'):
+      self.poll_loop = snmpimpl.event_loop()
+    else:
+      EXECUTOR_WORKERS.labels('poller').set(poller_pool)
+    # To drop cached subtrees of targets that are no longer polled
+    self.subtrees = snmpexporter.cache.TtlCache(0, *subtree_stores)
+    # Start MIB resolver after processes above (or it will fork it as well)
+    logging.debug('Initializing MIB resolver ...')
+    import mibresolver
+    # Resolutions are kept across requests as the MIBs do not change
+    self.resolver = snmpexporter.mibcache.MibCache(
+        mibresolver, max_size=resolver_cache_size)
+    # Its metrics would only show an idle cache when annotating elsewhere
+    if annotate_in == 'thread' or (
+        annotate_in == 'poller' and self.poll_loop is not None):
+      METRICS.register(self.resolver.metrics)
+
+    logging.debug('Starting annotation pool ...')
+    if annotate_in == 'process':
+      # Annotation is CPU bound, so to use more than one core it needs
+      # processes. They load their own MIB resolver, away from net-snmp.
+      self.annotator_executor = futures.ProcessPoolExecutor(
+          max_workers=annotator_pool, initializer=init_annotator,
+          initargs=(self.config_store, resolver_cache_size))
+    else:
+      # .. otherwise annotators are just CPU, so use lightweight threads.
+      self.annotator_executor = futures.ThreadPoolExecutor(
+          max_workers=annotator_pool)
+    EXECUTOR_WORKERS.labels('annotator').set(annotator_pool)
+
+    # (host, layer, generation) -> ([waiting Deferreds], scrape Deferred)
+    self.inflight = {}
+    INFLIGHT_SCRAPES.set_function(lambda: len(self.inflight))
+    # Set to serve results polled in the background, see Scheduler
+    self.scheduler = None
+    # (host, layer) -> reactor.seconds() of the last response, to stop
+    # exporting RESPONSE_BYTES of targets no longer scraped
+    self.responded = {}
+
+  def forget_target(self, host, layer):
+    """Stop exporting the bytes sent to a target."""
+    self.responded.pop((host, layer), None)
+    RESPONSE_BYTES.remove(host, layer)
+
+  def expire_responses(self):
+    """Forget targets that have not been responded to in a while."""
+    deadline = reactor.seconds() - RESPONSE_BYTES_TTL
+    for key, responded in list(self.responded.items()):
+      if responded < deadline:
+        self.forget_target(*key)
+
+  def _publish(self):
+    """Returns the current (generation, config, collections hash).
+
+    It is published to the pollers if new.
+    """
+    snapshot = self.config.poller_snapshot()
+    if snapshot[0] != self.published:
+      self.config_store['snapshot'] = snapshot
+      self.published = snapshot[0]
+    return snapshot
+
+  def _compile(self, generation, config):
+    """Returns (annotator, exporter) for a configuration generation."""
+    compiled_generation, annotator, exporter = self.compiled
+    if compiled_generation != generation:
+      logging.debug('Creating annotator for generation %d', generation)
+      annotator = snmpexporter.annotator.Annotator(
+          config['annotator'], self.resolver)
+      exporter = snmpexporter.prometheus.Exporter(config['exporter'])
+      self.compiled = (generation, annotator, exporter)
+    return annotator, exporter
+
+  def scrape(self, host, layer, render=None):
+    """Poll and annotate a target.
+
+    Returns a Deferred firing with a Scraped tuple. Scrapes of the same
+    target and configuration generation that overlap share one poll, and
+    their responses are only rendered once per format. Cancelling the
+    Deferred only cancels the poll if nobody else is waiting for it.
+
+    render is the (content type, encoding) of the response wanted, if
+    any. Annotator processes then render the response themselves, and
+    only scrapes wanting the same response share a poll.
+    """
+    generation, config, collections_hash = self._publish()
+    if self.annotate_in != 'process':
+      render = None
+    key = (host, layer, generation)
+    if render is not None:
+      key += render
+    waiter = defer.Deferred(canceller=lambda w: self._cancel_scrape(key, w))
+    if key in self.inflight:
+      logging.debug('Joining in-flight scrape of %s', key)
+      self.inflight[key][0].append(waiter)
+      return waiter
+    if self.poll_loop is not None:
+      # There is no poller to annotate in, so 'poller' annotates in threads
+      d = run_on_loop(
+          self.poll_loop, poll_async(config, collections_hash, host, layer),
+          pool='poller')
+      d.addErrback(self._scrape_failed, 'Poller')
+      d.addCallback(self._annotate, generation, config, render)
+    elif self.annotate_in == 'poller':
+      d = submit(self.poller_executor, poll_and_annotate, generation, host,
+                 layer, pool='poller')
+      d.addErrback(self._scrape_failed, 'Poller')
+      d.addCallback(self._annotated, generation, config)
+    else:
+      d = submit(self.poller_executor, poll, generation, host, layer,
+                 pool='poller')
+      d.addErrback(self._scrape_failed, 'Poller')
+      d.addCallback(self._annotate, generation, config, render)
+    self.inflight[key] = ([waiter], d)
+    d.addBoth(self._scrape_done, key)
+    return waiter
+
+  def _annotate(self, polled, generation, config, render=None):
     logging.debug('Poller done, starting annotation')
-    f = self.annotator_executor.submit(
-        annotate, config, self.resolver, f.result())
-    f.add_done_callback(functools.partial(self._reactor_annotate_done, request))
-    request.notifyFinish().addErrback(self._response_failed, f)
+    if render is not None:
+      content_type, encoding = render
+      d = submit(self.annotator_executor, annotate_and_render, generation,
+                 polled, content_type, encoding,
+                 self.compression_levels.get(encoding), pool='annotator')
+      d.addErrback(self._scrape_failed, 'Annotator')
+      d.addCallback(self._rendered, render)
+      return d
+    try:
+      annotator, exporter = self._compile(generation, config)
+    except Exception as e:
+      logging.exception('Invalid annotator or exporter configuration')
+      raise Error('Annotator failed: %s' % repr(e))
+    if self.annotate_in == 'process':
+      d = submit(self.annotator_executor, annotate_in_worker, generation,
+                 polled, pool='annotator')
+    else:
+      d = submit(self.annotator_executor, annotate, annotator, polled,
+                 pool='annotator')
+    d.addErrback(self._scrape_failed, 'Annotator')
+    d.addCallback(lambda annotated: Scraped(exporter, *annotated, None))
+    return d
+
+  def _annotated(self, annotated, generation, config):
+    # Annotated by the poller, only the exporter is needed
+    try:
+      _, exporter = self._compile(generation, config)
+    except Exception as e:
+      logging.exception('Invalid annotator or exporter configuration')
+      raise Error('Annotator failed: %s' % repr(e))
+    return Scraped(exporter, *annotated, None)
+
+  def _rendered(self, rendered, render):
+    target, chunks, seconds = rendered
+    STAGE_SECONDS.labels('render').observe(seconds)
+    return Scraped(None, target, None, {
+        render: snmpexporter.exposition.SharedChunks(drain(chunks))})
+
+  def _scrape_failed(self, err, step):
+    if err.check(Error, defer.CancelledError):
+      return err
+    logging.error('%s failed: %s', step, repr(err.value))
+    raise Error('%s failed: %s' % (step, repr(err.value)))
+
+  def _scrape_done(self, result, key):
+    waiters, _ = self.inflight.pop(key)
+    self._count_scrape(result, key[1])
+    failed = isinstance(result, failure.Failure)
+    if not failed and result.renders is None and len(waiters) > 1:
+      result = result._replace(renders={})
+    for waiter in waiters:
+      if failed:
+        waiter.errback(result)
+      else:
+        waiter.callback(result)
+    if not failed and result.renders is not None:
+      # Every waiter has started rendering, so chunks all readers have had
+      # can be dropped from now on
+      for shared in result.renders.values():
+        shared.seal()
+
+  def _count_scrape(self, result, layer):
+    if isinstance(result, failure.Failure):
+      if not result.check(defer.CancelledError):
+        SCRAPES.labels(layer, 'failure').inc()
+      return
+    SCRAPES.labels(layer, 'success').inc()
+    target = result.target
+    SNMP_TIMEOUTS.labels(layer).inc(target.timeouts)
+    SNMP_ERRORS.labels(layer).inc(target.errors)
+    for step, seconds in target.timeline():
+      if step in ('poll', 'annotate'):
+        STAGE_SECONDS.labels(step).observe(seconds)
+
+  def _cancel_scrape(self, key, waiter):
+    if key not in self.inflight:
+      return
+    waiters, d = self.inflight[key]
+    waiters.remove(waiter)
+    if not waiters:
+      logging.debug('Request cancelled, cancelling scrape of %s', key)
+      d.cancel()
+
+  def _negotiate(self, request):
+    """Returns the (content type, encoding) of the response to a request."""
+    encoder = snmpexporter.exposition.negotiate(
+        request.getHeader('accept'), self.encoders)
+    encoding = snmpexporter.compression.negotiate(
+        request.getHeader('accept-encoding'), self.compression)
+    return encoder.content_type, encoding
+
+  def _render(self, request, exporter, target, result, renders=None,
+              extra=()):
+    """Stream a result to a request.
+
+    Requests sharing a renders dict get the same encoded bytes, which are
+    only produced once per content type and encoding.
+    """
+    key = self._negotiate(request)
+    content_type, encoding = key
+    encoder = snmpexporter.exposition.encoder_for(content_type)
+    request.setHeader('Content-Type', content_type)
+    request.setHeader('Vary', 'Accept, Accept-Encoding')
+    if encoding is not None:
+      request.setHeader('Content-Encoding', encoding)
+    self.responded[(target.host, target.layer)] = reactor.seconds()
+    written = RESPONSE_BYTES.labels(target.host, target.layer)
+    if renders is not None and key in renders:
+      ChunkProducer(request, renders[key].reader(), written).start()
+      return
+    chunks = render_chunks(
+        exporter, target, result, encoder, encoding,
+        self.compression_levels.get(encoding), extra)
+    chunks = snmpexporter.metrics.timed(chunks, STAGE_SECONDS.labels('render'))
+    if renders is not None:
+      renders[key] = snmpexporter.exposition.SharedChunks(chunks)
+      chunks = renders[key].reader()
+    ChunkProducer(request, chunks, written).start()
+
+  def _render_failed(self, err, request):
+    if err.check(defer.CancelledError):
+      # The client went away
+      return
+    request.setResponseCode(500, message=str(err.value).encode())
+    request.finish()
 
   def render_GET(self, request):
     path = request.path.decode()
@@ -146,6 +734,8 @@ class PollerResource(resource.Resource):
       return self.healthy(request)
     elif path == '/objects':
       return self.objects(request)
+    elif path == '/metrics':
+      return self.metrics(request)
     else:
       logging.info('Not found: %s', path)
       request.setResponseCode(404)
@@ -160,6 +750,13 @@ class PollerResource(resource.Resource):
               ('objgraph_objects{name="%s"} %s\n' % (name, count)).encode())
     return bytes()
 
+  def metrics(self, request):
+    request.setHeader(
+        'Content-Type', snmpexporter.exposition.TextEncoder.content_type)
+    ChunkProducer(request, snmpexporter.exposition.encode_chunks(
+        METRICS.lines())).start()
+    return server.NOT_DONE_YET
+
   def _annotator_executor_healthy(self, request, completed_f):
     if completed_f.exception() or completed_f.cancelled():
       request.setResponseCode(500, message=(
@@ -189,7 +786,7 @@ class PollerResource(resource.Resource):
     f.add_done_callback(
             lambda f: reactor.callFromThread(
                 self._poller_executor_healthy, request, f))
-    request.notifyFinish().addErrback(self._response_failed, f)
+    request.notifyFinish().addErrback(lambda _: f.cancel())
     return server.NOT_DONE_YET
 
   def probe(self, request):
@@ -203,17 +800,103 @@ class PollerResource(resource.Resource):
     layer = layer.decode()
     target = target.decode()
 
-    config = snmpexporter.config.load(self.config_file)
-
-    f = self.poller_executor.submit(poll, config, target, layer)
-    f.add_done_callback(
-        functools.partial(self._reactor_poll_done, config, request))
+    if self.scheduler is not None:
+      cached = self.scheduler.result(target, layer)
+      if cached is not None:
+        polled, exporter, snmp_target, result = cached
+        self._render(request, exporter, snmp_target, result, extra=[
+          snmpexporter.exposition.Family(
+            'snmp_export_result_age_seconds',
+            'Seconds since the served result was polled', 'gauge',
+            [({}, time.time() - polled)])])
+        return server.NOT_DONE_YET
 
     logging.debug('Starting poll')
-    request.notifyFinish().addErrback(self._response_failed, f)
+    d = self.scrape(target, layer, self._negotiate(request))
+    request.notifyFinish().addErrback(lambda _: d.cancel())
+    d.addCallback(lambda scraped: self._render(request, *scraped))
+    d.addErrback(self._render_failed, request)
     return server.NOT_DONE_YET
 
 
+class Scheduler(object):
+  """Polls a list of targets in the background and keeps the results.
+
+  Every target is polled every interval seconds, plus or minus jitter (a
+  fraction of the interval) so that polls spread out over time. The first
+  polls are spread over the whole interval. The target list is a
+  Prometheus file_sd or http_sd document, see snmpexporter.targets, and is
+  reloaded every refresh seconds.
+  """
+
+  def __init__(self, resource, source, interval=60, jitter=0.1, refresh=60,
+               default_layer=None):
+    super(Scheduler, self).__init__()
+    self.resource = resource
+    self.source = source
+    self.interval = interval
+    self.jitter = jitter
+    self.refresh = refresh
+    self.default_layer = default_layer
+    # (host, layer) -> time of the next poll, in reactor.seconds()
+    self.schedule = {}
+    self.polling = set()
+    # (host, layer) -> (time polled, exporter, target, result)
+    self.results = {}
+
+  def start(self):
+    task.LoopingCall(self.load_targets).start(self.refresh)
+    task.LoopingCall(self.tick).start(1.0)
+
+  def result(self, host, layer):
+    return self.results.get((host, layer), None)
+
+  def load_targets(self):
+    d = threads.deferToThread(
+        snmpexporter.targets.load, self.source, self.default_layer)
+    d.addCallback(self.set_targets)
+    d.addErrback(lambda err: logging.error(
+        'Failed to load targets from %s: %s', self.source, err.value))
+    return d
+
+  def set_targets(self, targets):
+    now = reactor.seconds()
+    targets = set(targets)
+    for key in targets - set(self.schedule.keys()):
+      self.schedule[key] = now + random.uniform(0, self.interval)
+    for key in set(self.schedule.keys()) - targets:
+      del self.schedule[key]
+      self.results.pop(key, None)
+      self.resource.forget_target(*key)
+    logging.info('Scheduling %d targets', len(self.schedule))
+
+  def tick(self):
+    now = reactor.seconds()
+    for key, due in list(self.schedule.items()):
+      if due > now or key in self.polling:
+        continue
+      self.polling.add(key)
+      d = self.resource.scrape(*key)
+      d.addCallbacks(self._polled, self._failed, (key,), errbackArgs=(key,))
+
+  def _next(self, key):
+    self.polling.discard(key)
+    if key in self.schedule:
+      self.schedule[key] = reactor.seconds() + self.interval * random.uniform(
+          1 - self.jitter, 1 + self.jitter)
+
+  def _polled(self, scraped, key):
+    self._next(key)
+    if key in self.schedule:
+      self.results[key] = (
+          time.time(), scraped.exporter, scraped.target, scraped.result)
+
+  def _failed(self, err, key):
+    # The previous result is kept and will show its age
+    logging.warning('Scheduled poll of %s failed: %s', key, err.value)
+    self._next(key)
+
+
 if __name__ == '__main__':
   import argparse
 
@@ -223,13 +906,76 @@ if __name__ == '__main__':
   parser.add_argument('--log-level', dest='log_level', type=str,
           help='log level', default='INFO')
   parser.add_argument('--poller-pool', dest='poller_pool', type=int,
-          help='number of simultaneous polls to do', default=10)
+          help='number of simultaneous polls to do. With --snmp-impl asyncio '
+          'polls are not limited by this, they all run on one event loop',
+          default=10)
   parser.add_argument('--annotator-pool', dest='annotator_pool', type=int,
           help='number of threads to use to annotate', default=5)
+  parser.add_argument('--resolver-cache-size', dest='resolver_cache_size',
+          type=int, help='number of OID columns to keep resolved',
+          default=10000)
+  parser.add_argument('--snmp-impl', dest='snmp_impl', type=str,
+          help='SNMP implementation to use', default='netsnmp',
+          choices=sorted(snmpexporter.snmpimpl.IMPLEMENTATIONS.keys()))
+  parser.add_argument('--plan-cache-ttl', dest='plan_cache_ttl', type=int,
+          help='seconds to remember the model and walk plan of a target, '
+          '0 to detect it on every poll', default=3600)
+  parser.add_argument('--config-check-interval',
+          dest='config_check_interval', type=float,
+          help='seconds between checking the config for changes, 0 to only '
+          'reload on SIGHUP', default=10)
+  parser.add_argument('--compression', dest='compression', type=str,
+          help='comma separated list of response encodings to offer, in '
+          'order of preference (%s), or "none"' % ', '.join(
+            snmpexporter.compression.available()),
+          default=','.join(snmpexporter.compression.available()))
+  for encoding in ('gzip', 'zstd'):
+    levels = snmpexporter.compression.compressor_class(encoding).levels
+    parser.add_argument('--%s-level' % encoding, dest='%s_level' % encoding,
+            type=int, choices=levels, metavar='LEVEL',
+            help='%s compression level, %d to %d' % (
+              encoding, levels[0], levels[-1]), default=None)
+  parser.add_argument('--openmetrics', dest='openmetrics',
+          action='store_true', help='offer the OpenMetrics format, which '
+          'Prometheus prefers. It adds _total to the names of counters, '
+          'renaming their series')
+  parser.add_argument('--annotate-in', dest='annotate_in', type=str,
+          help='where to annotate results: a thread pool in the daemon, the '
+          'poller that polled them (the thread pool with --snmp-impl '
+          'asyncio), or a pool of --annotator-pool processes that also render '
+          'the responses',
+          default='thread', choices=['thread', 'poller', 'process'])
+  parser.add_argument('--targets', dest='targets', type=str,
+          help='file or http(s) URL with targets, in Prometheus file_sd or '
+          'http_sd format, to poll in the background. /probe will serve '
+          'the last result of these', default=None)
+  parser.add_argument('--targets-refresh', dest='targets_refresh',
+          type=float, help='seconds between reloading the targets',
+          default=60)
+  parser.add_argument('--default-layer', dest='default_layer', type=str,
+          help='layer of targets without a layer label', default=None)
+  parser.add_argument('--scrape-interval', dest='scrape_interval',
+          type=float, help='seconds between polls of the targets',
+          default=60)
+  parser.add_argument('--scrape-jitter', dest='scrape_jitter', type=float,
+          help='fraction of the interval to randomly vary polls with',
+          default=0.1)
+  parser.add_argument('--replay', dest='replay', type=str,
+          help='answer every target from a snmpexport.py --record file '
+          'instead of polling it', default=None)
+  parser.add_argument('--replay-speed', dest='replay_speed', type=float,
+          help='speed up replay by this factor, 0 for no delays',
+          default=1.0)
   parser.add_argument('--port', dest='port', type=int,
           help='port to listen to', default=9190)
   args = parser.parse_args()
 
+  compression = [x.strip() for x in args.compression.split(',')
+                 if x.strip() and x.strip() != 'none']
+  unsupported = set(compression) - set(snmpexporter.compression.available())
+  if unsupported:
+    parser.error('unsupported compression: %s' % ', '.join(sorted(unsupported)))
+
   # Logging setup
   observer = log.PythonLoggingObserver()
   observer.start()
@@ -243,7 +989,31 @@ if __name__ == '__main__':
   root.setLevel(logging.getLevelName(args.log_level))
 
   pr = PollerResource(
-      args.config_file, args.poller_pool, args.annotator_pool)
+      args.config_file, args.poller_pool, args.annotator_pool,
+      args.resolver_cache_size, args.snmp_impl, args.plan_cache_ttl,
+      compression, {'gzip': args.gzip_level, 'zstd': args.zstd_level},
+      args.annotate_in,
+      (args.replay, args.replay_speed) if args.replay else None,
+      args.openmetrics)
+
+  if args.targets:
+    pr.scheduler = Scheduler(
+        pr, args.targets, interval=args.scrape_interval,
+        jitter=args.scrape_jitter, refresh=args.targets_refresh,
+        default_layer=args.default_layer)
+    pr.scheduler.start()
+
+  # Pick up configuration changes without re-reading it for every poll
+  signal.signal(signal.SIGHUP,
+      lambda signum, frame: reactor.callFromThread(pr.config.reload))
+  # The subtrees might be in a manager process, keep the reactor out of it
+  task.LoopingCall(threads.deferToThread, pr.subtrees.expire).start(
+      SUBTREE_EXPIRE_INTERVAL, now=False)
+  task.LoopingCall(pr.expire_responses).start(
+      RESPONSE_BYTES_EXPIRE_INTERVAL, now=False)
+  if args.config_check_interval > 0:
+    task.LoopingCall(pr.config.check).start(
+        args.config_check_interval, now=False)
 
   factory = server.Site(pr)
 
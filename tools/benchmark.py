@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the poll -> annotate -> export pipeline.
+
+Synthetic walk results for a few device profiles are pushed through the
+same code the daemon runs, using a deterministic resolver instead of the
+MIBs. Nothing talks to the network. Timings and memory are written as JSON,
+and a previous run can be given to flag regressions:
+
+  tools/benchmark.py --output before.json
+  (apply change)
+  tools/benchmark.py --compare before.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import snmpexporter.annotator
+import snmpexporter.config
+import snmpexporter.mibcache
+import snmpexporter.prometheus
+import snmpexporter.resultset
+import snmpexporter.snmp
+import snmpexporter.target
+
+
+UP_DOWN = {'1': 'up', '2': 'down', '3': 'testing'}
+STP_STATES = {'1': 'disabled', '2': 'blocking', '3': 'listening',
+              '4': 'learning', '5': 'forwarding', '6': 'broken'}
+AP_STATES = {'1': 'associated', '2': 'disassociating', '3': 'downloading'}
+
+# Column OID -> (MIB, object, type, enum)
+COLUMNS = {
+  '.1.3.6.1.2.1.2.2.1.2': ('IF-MIB', 'ifDescr', 'OCTETSTR', None),
+  '.1.3.6.1.2.1.2.2.1.7': ('IF-MIB', 'ifAdminStatus', 'INTEGER', UP_DOWN),
+  '.1.3.6.1.2.1.2.2.1.8': ('IF-MIB', 'ifOperStatus', 'INTEGER', UP_DOWN),
+  '.1.3.6.1.2.1.2.2.1.14': ('IF-MIB', 'ifInErrors', 'COUNTER', None),
+  '.1.3.6.1.2.1.2.2.1.20': ('IF-MIB', 'ifOutErrors', 'COUNTER', None),
+  '.1.3.6.1.2.1.31.1.1.1.6': ('IF-MIB', 'ifHCInOctets', 'COUNTER64', None),
+  '.1.3.6.1.2.1.31.1.1.1.10': ('IF-MIB', 'ifHCOutOctets', 'COUNTER64', None),
+  '.1.3.6.1.2.1.31.1.1.1.15': ('IF-MIB', 'ifHighSpeed', 'GAUGE', None),
+  '.1.3.6.1.2.1.31.1.1.1.18': ('IF-MIB', 'ifAlias', 'OCTETSTR', None),
+  '.1.3.6.1.2.1.17.1.4.1.2': (
+    'BRIDGE-MIB', 'dot1dBasePortIfIndex', 'INTEGER', None),
+  '.1.3.6.1.2.1.17.2.15.1.3': (
+    'BRIDGE-MIB', 'dot1dStpPortState', 'INTEGER', STP_STATES),
+  '.1.3.6.1.2.1.47.1.1.1.1.2': (
+    'ENTITY-MIB', 'entPhysicalDesc', 'OCTETSTR', None),
+  '.1.3.6.1.2.1.47.1.1.1.1.4': (
+    'ENTITY-MIB', 'entPhysicalContainedIn', 'INTEGER', None),
+  '.1.3.6.1.2.1.47.1.1.1.1.11': (
+    'ENTITY-MIB', 'entPhysicalSerialNum', 'OCTETSTR', None),
+  '.1.3.6.1.2.1.47.1.1.1.1.13': (
+    'ENTITY-MIB', 'entPhysicalModelName', 'OCTETSTR', None),
+  '.1.3.6.1.4.1.9.9.91.1.1.1.1.1': (
+    'CISCO-ENTITY-SENSOR-MIB', 'entSensorType', 'INTEGER', None),
+  '.1.3.6.1.4.1.9.9.91.1.1.1.1.2': (
+    'CISCO-ENTITY-SENSOR-MIB', 'entSensorScale', 'INTEGER', None),
+  '.1.3.6.1.4.1.9.9.91.1.1.1.1.4': (
+    'CISCO-ENTITY-SENSOR-MIB', 'entSensorValue', 'INTEGER', None),
+  '.1.3.6.1.4.1.14179.2.2.1.1.3': (
+    'AIRESPACE-WIRELESS-MIB', 'bsnAPName', 'OCTETSTR', None),
+  '.1.3.6.1.4.1.14179.2.2.1.1.6': (
+    'AIRESPACE-WIRELESS-MIB', 'bsnAPOperationStatus', 'INTEGER', AP_STATES),
+  '.1.3.6.1.4.1.14179.2.2.2.1.15': (
+    'AIRESPACE-WIRELESS-MIB', 'bsnApIfNoOfUsers', 'COUNTER', None),
+  '.1.3.6.1.4.1.9.9.513.1.1.1.1.5': (
+    'CISCO-LWAPP-AP-MIB', 'cLApName', 'OCTETSTR', None),
+  '.1.3.6.1.4.1.9.9.513.1.1.1.1.6': (
+    'CISCO-LWAPP-AP-MIB', 'cLApUpTime', 'TICKS', None),
+}
+
+STAGES = ('build', 'annotate', 'export')
+
+
+class ProfileResolver(object):
+  """Resolves the synthetic columns like mibresolver would, but quickly."""
+
+  def __init__(self):
+    # Longest first so that a column is not mistaken for its table
+    self.columns = sorted(COLUMNS.keys(), key=len, reverse=True)
+
+  def resolve(self, oid):
+    for column in self.columns:
+      if oid.startswith(column + '.'):
+        mib, obj, _, enum = COLUMNS[column]
+        return '%s::%s.%s' % (mib, obj, oid[len(column) + 1:]), enum or {}
+    return oid, {}
+
+  def resolve_many(self, oids):
+    return [self.resolve(oid) for oid in oids]
+
+
+class Profile(object):
+  """Walk results of a device, built from a seed so runs are comparable."""
+
+  def __init__(self, seed=0):
+    self.random = random.Random(seed)
+    # (walked OID, VLAN) -> {oid: snmp.ResultTuple}
+    self.walks = {}
+
+  def add(self, column, index, value, vlan=None):
+    _, _, result_type, _ = COLUMNS[column]
+    self.walks.setdefault((column, vlan), {})['%s.%s' % (column, index)] = (
+        snmpexporter.snmp.ResultTuple(str(value), result_type))
+
+  def interfaces(self, count, vlans=0):
+    for i in range(1, count + 1):
+      up = self.random.random() < 0.7
+      self.add('.1.3.6.1.2.1.2.2.1.2', i, 'GigabitEthernet%d/0/%d' % (
+        i // 48 + 1, i % 48 + 1))
+      self.add('.1.3.6.1.2.1.2.2.1.7', i, 1)
+      self.add('.1.3.6.1.2.1.2.2.1.8', i, 1 if up else 2)
+      self.add('.1.3.6.1.2.1.2.2.1.14', i, self.random.randrange(100))
+      self.add('.1.3.6.1.2.1.2.2.1.20', i, self.random.randrange(100))
+      self.add('.1.3.6.1.2.1.31.1.1.1.6', i, self.random.randrange(2**64))
+      self.add('.1.3.6.1.2.1.31.1.1.1.10', i, self.random.randrange(2**64))
+      self.add('.1.3.6.1.2.1.31.1.1.1.15', i, 1000 if up else 0)
+      self.add('.1.3.6.1.2.1.31.1.1.1.18', i, 'port %d' % i)
+    for vlan in range(2, vlans + 2):
+      for port in range(1, count + 1):
+        self.add('.1.3.6.1.2.1.17.1.4.1.2', port, port, vlan)
+        self.add('.1.3.6.1.2.1.17.2.15.1.3', port,
+                 self.random.choice(['2', '5']), vlan)
+
+  def inventory(self, entities, sensors):
+    for i in range(1, entities + 1):
+      self.add('.1.3.6.1.2.1.47.1.1.1.1.2', i, 'Module %d' % i)
+      self.add('.1.3.6.1.2.1.47.1.1.1.1.4', i, max(0, i // 10))
+      self.add('.1.3.6.1.2.1.47.1.1.1.1.11', i, 'FOC%08d' % i)
+      self.add('.1.3.6.1.2.1.47.1.1.1.1.13', i, 'WS-X%d' % (4000 + i % 10))
+    for i in range(1, sensors + 1):
+      self.add('.1.3.6.1.2.1.47.1.1.1.1.2', 10000 + i, 'Sensor %d' % i)
+      self.add('.1.3.6.1.4.1.9.9.91.1.1.1.1.1', 10000 + i, 8)
+      self.add('.1.3.6.1.4.1.9.9.91.1.1.1.1.2', 10000 + i, 9)
+      self.add('.1.3.6.1.4.1.9.9.91.1.1.1.1.4', 10000 + i,
+               self.random.randrange(20, 60))
+
+  def access_points(self, count):
+    for i in range(count):
+      mac = '0.11.34.%d.%d.%d' % (i // 65536, i // 256 % 256, i % 256)
+      self.add('.1.3.6.1.4.1.14179.2.2.1.1.3', mac, 'ap-%04d' % i)
+      self.add('.1.3.6.1.4.1.14179.2.2.1.1.6', mac, 1)
+      for radio in (0, 1):
+        self.add('.1.3.6.1.4.1.14179.2.2.2.1.15', '%s.%d' % (mac, radio),
+                 self.random.randrange(50))
+      self.add('.1.3.6.1.4.1.9.9.513.1.1.1.1.5', mac, 'ap-%04d' % i)
+      self.add('.1.3.6.1.4.1.9.9.513.1.1.1.1.6', mac,
+               self.random.randrange(10**8))
+
+  def varbinds(self):
+    return sum(len(x) for x in self.walks.values())
+
+
+def access_switch():
+  profile = Profile()
+  profile.interfaces(52, vlans=20)
+  profile.inventory(10, 10)
+  return profile
+
+
+def chassis():
+  profile = Profile()
+  profile.interfaces(2000)
+  profile.inventory(600, 300)
+  return profile
+
+
+def wlc():
+  profile = Profile()
+  profile.interfaces(8)
+  profile.access_points(1000)
+  return profile
+
+
+PROFILES = {
+  'access-switch': access_switch,
+  'chassis': chassis,
+  'wlc': wlc,
+}
+
+
+def build(profile):
+  results = snmpexporter.resultset.ResultSet()
+  for (oid, vlan), walk in profile.walks.items():
+    results.update(snmpexporter.resultset.ResultSet.from_walk(oid, vlan, walk))
+  return results
+
+
+def make_target():
+  return snmpexporter.target.SnmpTarget(
+      'benchmark', 'access', {'access': {'version': 2, 'community': 'public'}})
+
+
+def percentile(values, percent):
+  """Nearest-rank percentile."""
+  values = sorted(values)
+  rank = max(1, int(round(percent / 100.0 * len(values))))
+  return values[rank - 1]
+
+
+def run_profile(profile, annotator, exporter, iterations, warmup):
+  """Returns {stage: [seconds per iteration]} and {stage: peak bytes}."""
+  steps = {
+    'build': lambda _: build(profile),
+    'annotate': annotator.annotate,
+    'export': lambda annotated: list(
+      exporter.export(make_target(), annotated)),
+  }
+  timings = {stage: [] for stage in STAGES}
+  for i in range(warmup + iterations):
+    data = None
+    for stage in STAGES:
+      start = time.perf_counter()
+      data = steps[stage](data)
+      elapsed = time.perf_counter() - start
+      if i >= warmup:
+        timings[stage].append(elapsed)
+
+  # Separate pass as tracing allocations slows everything down
+  memory = {}
+  data = None
+  tracemalloc.start()
+  for stage in STAGES:
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    data = steps[stage](data)
+    memory[stage] = tracemalloc.get_traced_memory()[1] - before
+  tracemalloc.stop()
+  return timings, memory
+
+
+def git_commit():
+  try:
+    commit = subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL)
+    return commit.decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run(config_file, profiles, iterations, warmup):
+  config = snmpexporter.config.load(config_file)
+  resolver = snmpexporter.mibcache.MibCache(ProfileResolver())
+  annotator = snmpexporter.annotator.Annotator(config['annotator'], resolver)
+  exporter = snmpexporter.prometheus.Exporter(config['exporter'])
+
+  report = {
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    'iterations': iterations,
+    'profiles': {},
+  }
+  for name in profiles:
+    profile = PROFILES[name]()
+    varbinds = profile.varbinds()
+    logging.info('Running %s (%d varbinds)', name, varbinds)
+    timings, memory = run_profile(
+        profile, annotator, exporter, iterations, warmup)
+    stages = {}
+    for stage in STAGES:
+      p50 = percentile(timings[stage], 50)
+      stages[stage] = {
+        'p50_seconds': p50,
+        'p99_seconds': percentile(timings[stage], 99),
+        'mean_seconds': sum(timings[stage]) / len(timings[stage]),
+        'varbinds_per_second': varbinds / p50 if p50 else None,
+        'peak_memory_bytes': memory[stage],
+      }
+    report['profiles'][name] = {'varbinds': varbinds, 'stages': stages}
+  # ru_maxrss is in kilobytes on Linux
+  report['max_rss_bytes'] = resource.getrusage(
+      resource.RUSAGE_SELF).ru_maxrss * 1024
+  return report
+
+
+def compare(baseline, report, threshold):
+  """Prints the change of p50 per stage, returns True on regressions."""
+  regressed = False
+  for name, profile in sorted(report['profiles'].items()):
+    old_profile = baseline.get('profiles', {}).get(name, None)
+    if old_profile is None:
+      continue
+    for stage, result in sorted(profile['stages'].items()):
+      old = old_profile['stages'].get(stage, None)
+      if old is None or not old['p50_seconds']:
+        continue
+      change = result['p50_seconds'] / old['p50_seconds'] - 1
+      flag = ''
+      if change > threshold:
+        flag = ' REGRESSION'
+        regressed = True
+      print('%-15s %-9s %9.2fms -> %9.2fms %+7.1f%%%s' % (
+        name, stage, old['p50_seconds'] * 1000,
+        result['p50_seconds'] * 1000, change * 100, flag))
+  return regressed
+
+
+def print_report(report):
+  print('%-15s %-9s %9s %12s %12s %14s %12s' % (
+    'profile', 'stage', 'varbinds', 'p50', 'p99', 'varbinds/s', 'peak mem'))
+  for name, profile in sorted(report['profiles'].items()):
+    for stage in STAGES:
+      result = profile['stages'][stage]
+      print('%-15s %-9s %9d %10.2fms %10.2fms %14.0f %10.1fMB' % (
+        name, stage, profile['varbinds'], result['p50_seconds'] * 1000,
+        result['p99_seconds'] * 1000, result['varbinds_per_second'] or 0,
+        result['peak_memory_bytes'] / 1e6))
+  print('max RSS %.1fMB' % (report['max_rss_bytes'] / 1e6))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Benchmark the poll -> annotate -> export pipeline.')
+  parser.add_argument('--config', dest='config_file', type=str,
+          help='config file with the annotator and exporter to use',
+          default='etc/snmpexporter.yaml')
+  parser.add_argument('--profile', dest='profiles', action='append',
+          choices=sorted(PROFILES.keys()),
+          help='device profile to run, can be repeated (default: all)')
+  parser.add_argument('--iterations', dest='iterations', type=int,
+          help='timed iterations per profile', default=20)
+  parser.add_argument('--warmup', dest='warmup', type=int,
+          help='untimed iterations before timing', default=2)
+  parser.add_argument('--output', dest='output', type=str,
+          help='file to write the results to as JSON', default=None)
+  parser.add_argument('--compare', dest='compare', type=str,
+          help='JSON results of an earlier run to compare with', default=None)
+  parser.add_argument('--threshold', dest='threshold', type=float,
+          help='p50 slowdown, as a fraction, reported as a regression',
+          default=0.1)
+  parser.add_argument('--log-level', dest='log_level', type=str,
+          help='log level', default='WARNING')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.getLevelName(args.log_level))
+
+  report = run(args.config_file, args.profiles or sorted(PROFILES.keys()),
+               args.iterations, args.warmup)
+  print_report(report)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    if compare(baseline, report, args.threshold):
+      sys.exit(1)
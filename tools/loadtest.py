@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Load test snmpexporterd against simulated SNMP agents.
+
+Starts one simulated agent per target, each on its own loopback address,
+and has a number of concurrent clients scrape them through /probe for a
+while. Reports scrape latency and throughput, to find where the poller
+and annotator pools of the daemon top out.
+
+The daemon is started with the given arguments and a copy of the config
+that has a layer pointing at the agents:
+
+  tools/loadtest.py --targets 200 --concurrency 50 \\
+      --daemon-args '--snmp-impl asyncio --poller-pool 20'
+
+Without --daemon-args an already running daemon at --exporter is used, its
+config needs a layer like the one written by --write-config.
+"""
+import argparse
+import concurrent.futures
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import yaml
+
+import snmpexporter.config
+import snmpexporter.simulator
+
+
+def percentile(values, percent):
+  """Nearest-rank percentile."""
+  values = sorted(values)
+  rank = max(1, int(round(percent / 100.0 * len(values))))
+  return values[rank - 1]
+
+
+def hosts(count):
+  """Loopback addresses to run agents on, skipping .0 and .255."""
+  address = ipaddress.IPv4Address('127.0.0.1')
+  while count:
+    if address.packed[-1] not in (0, 255):
+      yield str(address)
+      count -= 1
+    address += 1
+
+
+def start_agents(args):
+  """Returns the simulator and {host: agent}."""
+  if args.dump:
+    dump = snmpexporter.simulator.Dump.load(args.dump)
+  else:
+    dump = snmpexporter.simulator.Dump.synthetic(
+        interfaces=args.interfaces, vlans=range(1, args.vlans + 1))
+  simulator = snmpexporter.simulator.Simulator()
+  agents = {}
+  for i, host in enumerate(hosts(args.targets)):
+    agent = snmpexporter.simulator.Agent(
+        dump, community=args.community,
+        delay=args.delay if i < args.slow_agents else 0,
+        mtu=args.mtu if i >= args.targets - args.nexus_agents else None)
+    simulator.start(agent, host, args.agent_port)
+    agents[host] = agent
+  return simulator, agents
+
+
+def write_config(config_file, layer, community, port, output):
+  config = snmpexporter.config.load(config_file)
+  config['snmp'] = dict(config['snmp'] or {})
+  config['snmp'][layer] = {
+    'version': 2, 'community': community, 'port': port}
+  with open(output, 'w') as f:
+    yaml.safe_dump(config, f)
+
+
+def start_daemon(args, config_file):
+  port = int(args.exporter.rsplit(':', 1)[1])
+  command = [sys.executable, os.path.join(
+      os.path.dirname(__file__), '..', 'snmpexporterd.py'),
+    '--config', config_file, '--port', str(port)]
+  command.extend(shlex.split(args.daemon_args))
+  logging.info('Starting %s', ' '.join(command))
+  daemon = subprocess.Popen(command)
+  deadline = time.monotonic() + 30
+  while time.monotonic() < deadline:
+    if daemon.poll() is not None:
+      raise SystemExit('snmpexporterd exited with %d' % daemon.returncode)
+    try:
+      urllib.request.urlopen(args.exporter + '/healthy', timeout=1).read()
+      return daemon
+    except (OSError, urllib.error.URLError):
+      time.sleep(0.2)
+  daemon.terminate()
+  raise SystemExit('snmpexporterd did not become healthy')
+
+
+def scrape(url, timeout):
+  """Returns (seconds, response bytes or None on errors)."""
+  start = time.perf_counter()
+  try:
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+      size = len(response.read())
+  except (OSError, urllib.error.URLError) as e:
+    logging.debug('Scraping %s failed: %s', url, e)
+    size = None
+  return time.perf_counter() - start, size
+
+
+def run(args, targets):
+  urls = ['%s/probe?target=%s&layer=%s' % (args.exporter, host, args.layer)
+          for host in targets]
+  order = itertools.cycle(urls)
+  deadline = time.monotonic() + args.duration
+  latencies = []
+  errors = 0
+  size = 0
+
+  def client():
+    results = []
+    while time.monotonic() < deadline:
+      results.append(scrape(next(order), args.timeout))
+    return results
+
+  start = time.monotonic()
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=args.concurrency) as executor:
+    for future in [executor.submit(client) for _ in range(args.concurrency)]:
+      for seconds, response_size in future.result():
+        if response_size is None:
+          errors += 1
+          continue
+        latencies.append(seconds)
+        size += response_size
+  elapsed = time.monotonic() - start
+
+  report = {
+    'targets': len(targets),
+    'concurrency': args.concurrency,
+    'daemon_args': args.daemon_args,
+    'seconds': elapsed,
+    'scrapes': len(latencies),
+    'errors': errors,
+    'scrapes_per_second': len(latencies) / elapsed,
+    'response_bytes': size,
+  }
+  if latencies:
+    report.update({
+      'p50_seconds': percentile(latencies, 50),
+      'p90_seconds': percentile(latencies, 90),
+      'p99_seconds': percentile(latencies, 99),
+      'max_seconds': max(latencies),
+    })
+  return report
+
+
+def print_report(report, agents):
+  print('%d targets, %d clients, %.1fs' % (
+    report['targets'], report['concurrency'], report['seconds']))
+  print('%d scrapes, %d errors, %.1f scrapes/s, %.1fMB' % (
+    report['scrapes'], report['errors'], report['scrapes_per_second'],
+    report['response_bytes'] / 1e6))
+  if report['scrapes']:
+    print('latency p50 %.0fms p90 %.0fms p99 %.0fms max %.0fms' % tuple(
+      report[x] * 1000 for x in (
+        'p50_seconds', 'p90_seconds', 'p99_seconds', 'max_seconds')))
+  print('agents: %d requests, %d dropped, %d rejected' % (
+    sum(x.requests for x in agents.values()),
+    sum(x.dropped for x in agents.values()),
+    sum(x.rejected for x in agents.values())))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Load test snmpexporterd against simulated SNMP agents.')
+  parser.add_argument('--targets', dest='targets', type=int,
+          help='number of simulated agents', default=50)
+  parser.add_argument('--concurrency', dest='concurrency', type=int,
+          help='concurrent /probe requests', default=10)
+  parser.add_argument('--duration', dest='duration', type=float,
+          help='seconds to run for', default=30)
+  parser.add_argument('--timeout', dest='timeout', type=float,
+          help='seconds to wait for a scrape', default=60)
+  parser.add_argument('--exporter', dest='exporter', type=str,
+          help='base URL of snmpexporterd', default='http://127.0.0.1:9190')
+  parser.add_argument('--layer', dest='layer', type=str,
+          help='layer the agents are configured as', default='loadtest')
+  parser.add_argument('--config', dest='config_file', type=str,
+          help='config to add the agent layer to',
+          default='/etc/snmpexporter.yaml')
+  parser.add_argument('--write-config', dest='write_config', type=str,
+          help='write the config with the agent layer here and exit',
+          default=None)
+  parser.add_argument('--daemon-args', dest='daemon_args', type=str,
+          help='start snmpexporterd with these arguments', default=None)
+  parser.add_argument('--agent-port', dest='agent_port', type=int,
+          help='UDP port the agents listen on', default=16161)
+  parser.add_argument('--community', dest='community', type=str,
+          help='community of the agents', default='public')
+  parser.add_argument('--dump', dest='dump', type=str,
+          help='snmpwalk -On output to serve instead of a synthetic switch',
+          default=None)
+  parser.add_argument('--interfaces', dest='interfaces', type=int,
+          help='interfaces of the synthetic switch', default=48)
+  parser.add_argument('--vlans', dest='vlans', type=int,
+          help='VLAN contexts of the synthetic switch', default=0)
+  parser.add_argument('--slow-agents', dest='slow_agents', type=int,
+          help='agents that wait --delay before answering', default=0)
+  parser.add_argument('--delay', dest='delay', type=float,
+          help='seconds slow agents wait', default=0.5)
+  parser.add_argument('--nexus-agents', dest='nexus_agents', type=int,
+          help='agents that drop responses larger than --mtu', default=0)
+  parser.add_argument('--mtu', dest='mtu', type=int,
+          help='largest response of Nexus agents', default=1500)
+  parser.add_argument('--output', dest='output', type=str,
+          help='file to write the results to as JSON', default=None)
+  parser.add_argument('--log-level', dest='log_level', type=str,
+          help='log level', default='WARNING')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.getLevelName(args.log_level))
+
+  if args.write_config:
+    write_config(args.config_file, args.layer, args.community,
+                 args.agent_port, args.write_config)
+    sys.exit(0)
+
+  simulator, agents = start_agents(args)
+  daemon = None
+  with tempfile.NamedTemporaryFile(suffix='.yaml') as config:
+    if args.daemon_args is not None:
+      write_config(args.config_file, args.layer, args.community,
+                   args.agent_port, config.name)
+      daemon = start_daemon(args, config.name)
+    try:
+      report = run(args, list(agents.keys()))
+    finally:
+      if daemon is not None:
+        daemon.terminate()
+        daemon.wait()
+      simulator.stop()
+  print_report(report, agents)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)